@@ -0,0 +1,97 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module measures what BotClient's create_message interceptor costs for
+each message discord.py builds, like every message of a history backfill.
+It compares the current interceptor, which reads interface.sending_message,
+with the inspect.stack() check it replaced, and with no interceptor at all.
+
+    python -m benchmarks.create_message_hook
+"""
+
+import argparse
+import asyncio
+import contextlib
+import discord
+import inspect
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import FIRST_CHANNEL_ID, FIRST_USER_ID, message_data, synthetic_traffic, user_data
+from main import BotClient
+
+def _stack_inspecting(bot: BotClient, original: Callable[..., discord.Message], /) -> Callable[..., discord.Message]:
+    """The interceptor from before interface.mark_sends, which looked for Messageable.send among its callers."""
+    def create_message(*, channel: Any, data: Any) -> discord.Message:
+        caller = inspect.stack()[1]
+        is_send = caller.function == 'send' and caller.filename.endswith('abc.py')
+        if not is_send:
+            for hook in bot._create_message_hooks:
+                hook(data)
+        return original(channel=channel, data=data)
+    return create_message
+
+def _at_depth(depth: int, function: Callable[[], float], /) -> float:
+    """Call function from depth frames further down the stack, since inspect.stack() walks all of them."""
+    if depth == 0:
+        return function()
+    return _at_depth(depth - 1, function)
+
+def _time_per_call(create_message: Callable[..., discord.Message], channel: Any, data: dict[str, Any], number: int, depth: int, /) -> float:
+    def run() -> float:
+        start = time.perf_counter()
+        for _ in range(number):
+            create_message(channel=channel, data=data)
+        return (time.perf_counter() - start) / number
+    # The best of a few runs, since anything else running only ever makes it slower
+    return min(_at_depth(depth, run) for _ in range(5))
+
+async def measure(depths: list[int], number: int, /) -> dict[str, dict[int, float]]:
+    """Seconds per created message of each interceptor, at each call depth."""
+    bot = BotClient()
+    await bot._async_setup_hook()
+    frames, _ = synthetic_traffic(0, 1, 1, 0, 1)
+    bot._connection.parsers['GUILD_CREATE'](frames[0]['d'])
+    bot.register_create_message_hook(lambda data: None)
+    channel = bot.get_channel(FIRST_CHANNEL_ID)
+    data = message_data(discord.utils.time_snowflake(discord.utils.utcnow()), FIRST_CHANNEL_ID, user_data(FIRST_USER_ID), 'hello')
+
+    state = bot._connection
+    original: Callable[..., discord.Message] = lambda *, channel, data: type(state).create_message(state, channel=channel, data=data)
+    interceptors = {
+        'none': original,
+        'contextvar': state.create_message,
+        'inspect.stack': _stack_inspecting(bot, original),
+    }
+    results: dict[str, dict[int, float]] = {}
+    for name, create_message in interceptors.items():
+        # inspect.stack() is slow enough that fewer calls give a stable number
+        calls = max(1, number // 1000) if name == 'inspect.stack' else number
+        results[name] = {depth: _time_per_call(create_message, channel, data, calls, depth) for depth in depths}
+    await bot.close()
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.create_message_hook', description=(__doc__ or '').split('\n\n')[0].strip())
+    parser.add_argument('--depth', type=int, action='append', help='stack depth to create messages at, can be repeated (default: 10 and 25)')
+    parser.add_argument('--number', type=int, default=20000, help='messages to create per measurement (default: %(default)s)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory, contextlib.chdir(directory):
+        results = asyncio.run(measure(args.depth or [10, 25], args.number))
+
+    for depth in args.depth or [10, 25]:
+        baseline = results['none'][depth]
+        print(f'depth {depth}: ' + ', '.join(
+            f'{name} {(by_depth[depth] - baseline) * 1e6:.3f} us/msg'
+            for name, by_depth in results.items() if name != 'none'
+        ) + f' (creating the message itself: {baseline * 1e6:.1f} us)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module compares SQLite settings for the history database (see
+database.Profile) by ingesting messages through History while looking up
+stored ones, the way live traffic and logging do at the same time.
+
+    python -m benchmarks.database_profile
+    python -m benchmarks.database_profile --profile '{"history_journal_mode": "wal", "history_synchronous": "off"}'
+
+For each profile, a fresh database is filled with --messages messages in
+one go, then --messages more are written in commits of --commit-size while
+--lookups random stored messages are looked up. The message cache is
+turned off, so every lookup reads the database. Results depend a lot on
+the filesystem, so use --directory to run on the disk the bot uses.
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import discord
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from fakes import FIRST_CHANNEL_ID, FIRST_USER_ID, WORDS, message_data, user_data
+from main import BotClient
+
+PROFILES: dict[str, dict[str, Any]] = {
+    'delete/full': {'history_journal_mode': 'delete', 'history_synchronous': 'full', 'history_cache_size_mib': 2, 'history_mmap_size_mib': 0},
+    'wal/full': {'history_journal_mode': 'wal', 'history_synchronous': 'full', 'history_cache_size_mib': 2, 'history_mmap_size_mib': 0},
+    'wal/normal': {'history_journal_mode': 'wal', 'history_synchronous': 'normal', 'history_cache_size_mib': 2, 'history_mmap_size_mib': 0},
+    'wal/normal+cache/mmap': {'history_journal_mode': 'wal', 'history_synchronous': 'normal', 'history_cache_size_mib': 64, 'history_mmap_size_mib': 256},
+}
+
+def synthetic_messages(count: int, seed: int, /) -> list[dict[str, Any]]:
+    rng = random.Random(seed)
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+    return [
+        message_data(
+            discord.utils.time_snowflake(start + datetime.timedelta(seconds=i)),
+            FIRST_CHANNEL_ID + rng.randrange(20),
+            user_data(FIRST_USER_ID + rng.randrange(500)),
+            ' '.join(rng.choices(WORDS, k=rng.randint(3, 30))),
+        )
+        for i in range(count)
+    ]
+
+async def measure(profile: dict[str, Any], messages: list[dict[str, Any]], args: argparse.Namespace, /) -> dict[str, float]:
+    """Ingest speed and lookup latencies with profile, in the current directory."""
+    with open('config.json', 'w') as file:
+        json.dump({**profile, 'history_message_cache_size': 0, 'history_maintenance_interval': 0}, file)
+    bot = BotClient()
+    await bot._async_setup_hook()
+    await bot.load_extension('cogs.history')
+    history: Any = bot.get_cog('History')
+
+    half = len(messages) // 2
+    for data in messages[:half]:
+        history._update_message(data)
+    await history._flush_messages()
+
+    rng = random.Random(args.seed)
+    latencies: list[float] = []
+    async def look_up() -> None:
+        for _ in range(args.lookups):
+            data = messages[rng.randrange(half)]
+            start = time.perf_counter()
+            found = await history.get_message(int(data['id']))
+            latencies.append(time.perf_counter() - start)
+            assert(found is not None and found['id'] == data['id'])
+
+    lookups = asyncio.create_task(look_up())
+    start = time.perf_counter()
+    for i in range(half, len(messages), args.commit_size):
+        for data in messages[i:i + args.commit_size]:
+            history._update_message(data)
+        await history._flush_messages()
+    ingest_time = time.perf_counter() - start
+    await lookups
+    await bot.close()
+
+    latencies.sort()
+    return {
+        'messages_per_second': (len(messages) - half) / ingest_time,
+        'lookup_p50_ms': latencies[len(latencies) // 2] * 1000,
+        'lookup_p99_ms': latencies[int(len(latencies) * 0.99)] * 1000,
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.database_profile', description=(__doc__ or '').split('\n\n')[0].strip())
+    parser.add_argument('--profile', action='append', help='JSON object of history_* settings to compare, can be repeated (default: a few common ones)')
+    parser.add_argument('--messages', type=int, default=20000, help='messages to store before, and to ingest during, the lookups (default: %(default)s)')
+    parser.add_argument('--commit-size', type=int, default=20, help='messages per commit while looking up (default: %(default)s)')
+    parser.add_argument('--lookups', type=int, default=3000, help='(default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--directory', help='where to create the databases (default: the system temporary directory)')
+    args = parser.parse_args()
+
+    profiles = {profile: json.loads(profile) for profile in args.profile} if args.profile else PROFILES
+    messages = synthetic_messages(args.messages * 2, args.seed)
+    for name, profile in profiles.items():
+        directory = tempfile.mkdtemp(prefix='database-profile-', dir=args.directory)
+        try:
+            # BotClient prints every message it sees
+            with contextlib.chdir(directory), open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+                results = asyncio.run(measure(profile, messages, args))
+        finally:
+            shutil.rmtree(directory)
+        print(f'{name:<24} ingest {results["messages_per_second"]:8.0f} msg/s  '
+              f'lookup p50 {results["lookup_p50_ms"]:6.2f} ms  p99 {results["lookup_p99_ms"]:6.2f} ms')
+
+if __name__ == '__main__':
+    main()
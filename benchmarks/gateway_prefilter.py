@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module measures how long History.on_socket_raw_receive takes to decide
+whether a gateway frame is a MESSAGE_CREATE, on a mix of frames like the
+bot receives with every intent enabled. It compares parsing every frame
+with json.loads against the string prefilter History uses, followed by
+json.loads or (if it's installed) orjson.loads for the frames that pass.
+
+    python -m benchmarks.gateway_prefilter
+    python -m benchmarks.gateway_prefilter --traffic recorded.jsonl
+
+Recorded traffic is a file of gateway payloads, one JSON object per line,
+like the ones benchmarks/replay.py reads.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+from typing import Any, Callable
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cogs.history import _may_be_message_create
+
+# Share of each kind of frame in the generated mix, in percent
+FRAME_MIX = {
+    'PRESENCE_UPDATE': 55,
+    'TYPING_START': 15,
+    'MESSAGE_CREATE': 10,
+    'MESSAGE_REACTION_ADD': 10,
+    'GUILD_MEMBER_UPDATE': 8,
+    None: 2, # heartbeat ACKs
+}
+
+def _frame(event: str | None, data: Any, /, *, op: int = 0) -> str:
+    # Discord sends compact JSON with "t" first
+    return json.dumps({'t': event, 's': 1 if event else None, 'op': op, 'd': data}, separators=(',', ':'))
+
+def synthetic_frames(count: int, seed: int, /) -> list[str]:
+    user = {'id': '123456789012345678', 'username': 'someone', 'global_name': 'Some One', 'avatar': 'a' * 32, 'discriminator': '0', 'public_flags': 0}
+    member = {'roles': ['1' * 18, '2' * 18], 'nick': None, 'joined_at': '2023-01-01T00:00:00.000000+00:00', 'deaf': False, 'mute': False, 'flags': 0, 'avatar': None}
+    examples = {
+        'PRESENCE_UPDATE': _frame('PRESENCE_UPDATE', {
+            'user': {'id': '1' * 18}, 'status': 'online', 'guild_id': '9' * 18, 'client_status': {'desktop': 'online'},
+            'activities': [{'type': 0, 'name': 'A Game', 'created_at': 1700000000000, 'timestamps': {'start': 1700000000000},
+                            'assets': {'large_image': 'x' * 20, 'large_text': 'y' * 30}}],
+        }),
+        'TYPING_START': _frame('TYPING_START', {
+            'user_id': '1' * 18, 'timestamp': 1700000000, 'channel_id': '2' * 18, 'guild_id': '9' * 18, 'member': {**member, 'user': user},
+        }),
+        'MESSAGE_CREATE': _frame('MESSAGE_CREATE', {
+            'id': '3' * 18, 'channel_id': '2' * 18, 'guild_id': '9' * 18, 'author': user, 'member': member, 'content': 'hello world ' * 5,
+            'timestamp': '2024-01-01T00:00:00.000000+00:00', 'edited_timestamp': None, 'attachments': [], 'embeds': [],
+            'mentions': [], 'mention_roles': [], 'pinned': False, 'tts': False, 'type': 0, 'flags': 0,
+        }),
+        'MESSAGE_REACTION_ADD': _frame('MESSAGE_REACTION_ADD', {
+            'user_id': '1' * 18, 'message_id': '3' * 18, 'channel_id': '2' * 18, 'guild_id': '9' * 18,
+            'emoji': {'name': 'x', 'id': None}, 'member': {**member, 'user': user},
+        }),
+        'GUILD_MEMBER_UPDATE': _frame('GUILD_MEMBER_UPDATE', {**member, 'user': user, 'guild_id': '9' * 18}),
+        None: _frame(None, None, op=11),
+    }
+    rng = random.Random(seed)
+    return rng.choices([examples[event] for event in FRAME_MIX], weights=list(FRAME_MIX.values()), k=count)
+
+def _time_per_frame(frames: list[str], handle: Callable[[str], object], /) -> float:
+    best = float('inf')
+    for _ in range(5):
+        start = time.perf_counter()
+        for frame in frames:
+            handle(frame)
+        best = min(best, (time.perf_counter() - start) / len(frames))
+    return best
+
+def measure(frames: list[str], /) -> dict[str, float]:
+    """Seconds per frame of each way of finding the MESSAGE_CREATE frames."""
+    def parse_all(frame: str) -> bool:
+        return json.loads(frame)['t'] == 'MESSAGE_CREATE'
+
+    def prefiltered(loads: Callable[[str], Any], /) -> Callable[[str], bool]:
+        def handle(frame: str) -> bool:
+            return _may_be_message_create(frame) and loads(frame)['t'] == 'MESSAGE_CREATE'
+        return handle
+
+    results = {
+        'json.loads every frame': _time_per_frame(frames, parse_all),
+        'prefilter + json': _time_per_frame(frames, prefiltered(json.loads)),
+    }
+    try:
+        import orjson
+    except ModuleNotFoundError:
+        pass
+    else:
+        results['prefilter + orjson'] = _time_per_frame(frames, prefiltered(orjson.loads))
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.gateway_prefilter', description=(__doc__ or '').split('\n\n')[0].strip())
+    parser.add_argument('--traffic', help='use the gateway payloads in this JSON lines file instead of generating them')
+    parser.add_argument('--frames', type=int, default=10000, help='frames to generate (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.traffic is not None:
+        with open(args.traffic, 'r') as file:
+            # Serialized again the way Discord sends them, keeping the order of their keys
+            frames = [json.dumps(json.loads(line), separators=(',', ':'), ensure_ascii=False) for line in file if line.strip()]
+    else:
+        frames = synthetic_frames(args.frames, args.seed)
+
+    creates = sum(json.loads(frame)['t'] == 'MESSAGE_CREATE' for frame in frames)
+    print(f'{len(frames)} frames, {creates} MESSAGE_CREATE')
+    for name, per_frame in measure(frames).items():
+        print(f'{name:<24} {per_frame * 1e6:.2f} us/frame')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module measures how long Logs takes to find the log channels of an
+event, for guilds with few and with many log channels. It compares the
+routing index Logs keeps up to date when configs change with going through
+every log channel of the guild for each event, as the handlers used to.
+
+    python -m benchmarks.log_routing
+    python -m benchmarks.log_routing --channels 200
+"""
+
+import argparse
+import asyncio
+import contextlib
+import discord
+import os
+import sys
+import tempfile
+import time
+from typing import Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cogs.logs import VALID_LOG_ITEMS
+from fakes import GUILD_ID, synthetic_traffic
+from main import BotClient
+
+def _scan(logs: Any, guild_id: int, item: str, /) -> list[discord.TextChannel]:
+    """How the handlers found their log channels before the routing index."""
+    log_channels: list[discord.TextChannel] = []
+    for log_channel_id, log_channel_config in logs.configs.get(guild_id, {}).items():
+        if not log_channel_config.get(item, False):
+            continue
+        log_channel = logs.bot.get_channel(log_channel_id)
+        if not isinstance(log_channel, discord.TextChannel):
+            continue
+        if log_channel.guild.id != guild_id:
+            continue
+        log_channels.append(log_channel)
+    return log_channels
+
+def _config(index: int, /) -> dict[str, bool]:
+    # Edits go to every log channel, deletes to a few and leaves to half, like a guild that splits its logs up
+    return {
+        'message_delete': index % 10 == 0,
+        'message_edit': True,
+        'member_join': False,
+        'member_remove': index % 2 == 0,
+    }
+
+async def measure(channels: int, number: int, /) -> dict[str, float]:
+    """Seconds per event of each way of finding its log channels, averaged over the log items."""
+    bot = BotClient()
+    await bot._async_setup_hook()
+    frames, _ = synthetic_traffic(0, channels, 1, 0, 1)
+    bot._connection.parsers['GUILD_CREATE'](frames[0]['d'])
+    await bot.load_extension('cogs.logs')
+    logs: Any = bot.get_cog('Logs')
+
+    guild = bot.get_guild(GUILD_ID)
+    assert(guild is not None)
+    logs.configs[GUILD_ID] = {channel.id: _config(i) for i, channel in enumerate(guild.text_channels)}
+    logs._loaded_guild_ids.add(GUILD_ID)
+    logs._update_routes(GUILD_ID)
+
+    results = {'scan every log channel': float('inf'), 'routing index': float('inf')}
+    for _ in range(5):
+        for item in VALID_LOG_ITEMS:
+            assert(list(await logs._log_channels(GUILD_ID, item)) == _scan(logs, GUILD_ID, item))
+
+        # Both are awaited from the handlers, so both are timed from a coroutine
+        start = time.perf_counter()
+        for _ in range(number):
+            for item in VALID_LOG_ITEMS:
+                _scan(logs, GUILD_ID, item)
+        results['scan every log channel'] = min(results['scan every log channel'], (time.perf_counter() - start) / number / len(VALID_LOG_ITEMS))
+
+        start = time.perf_counter()
+        for _ in range(number):
+            for item in VALID_LOG_ITEMS:
+                await logs._log_channels(GUILD_ID, item)
+        results['routing index'] = min(results['routing index'], (time.perf_counter() - start) / number / len(VALID_LOG_ITEMS))
+
+    await bot.close()
+    return results
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.log_routing', description=(__doc__ or '').split('\n\n')[0].strip())
+    parser.add_argument('--channels', type=int, action='append', help='log channels in the guild, can be repeated (default: 3 and 50)')
+    parser.add_argument('--number', type=int, default=20000, help='events of each log item per measurement (default: %(default)s)')
+    args = parser.parse_args()
+
+    for channels in args.channels or [3, 50]:
+        # synthetic_traffic adds a log channel to the ones it's asked for
+        with tempfile.TemporaryDirectory() as directory, contextlib.chdir(directory):
+            results = asyncio.run(measure(channels - 1, args.number))
+        print(f'{channels} log channels: ' + ', '.join(f'{name} {per_event * 1e9:.0f} ns/event' for name, per_event in results.items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module replays gateway traffic through BotClient with the History and
+Logs cogs loaded, and reports how fast it was handled. Discord's HTTP API is
+answered by a stub, so nothing goes over the network, and a run can be
+repeated anywhere to compare a change against a baseline.
+
+    python -m benchmarks.replay --messages 20000
+    python -m benchmarks.replay --traffic recorded.jsonl
+
+Traffic is either generated (message bursts, edits, deletes, bulk deletes
+and member churn in one guild, plus history to backfill), or read from a file
+of gateway payloads, one JSON object per line, like {"t": ..., "op": 0, "d": ...}.
+Recorded traffic should start with the GUILD_CREATE of its guilds.
+"""
+
+import argparse
+import asyncio
+import collections
+import contextlib
+import discord
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from typing import Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import interface
+from fakes import BOT_USER_ID, LOG_CHANNEL_ID, StubHTTP, synthetic_traffic, user_data
+from main import BotClient
+
+def _percentile(samples: list[float], fraction: float, /) -> float:
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+async def replay(frames: list[dict[str, Any]], backfill: dict[int, list[dict[str, Any]]], args: argparse.Namespace, /) -> dict[str, Any]:
+    bot = BotClient()
+    await bot._async_setup_hook()
+    http = StubHTTP(args.http_latency, backfill)
+    interface.stub_http(bot, http)
+    bot._connection.user = discord.ClientUser(state=bot._connection, data=user_data(BOT_USER_ID)) # type: ignore
+
+    # Time from when each listener is scheduled until it's done, by event
+    latencies: dict[str, list[float]] = collections.defaultdict(list)
+    listeners: set[asyncio.Task[Any]] = set()
+    schedule_event = bot._schedule_event
+    def timed_schedule_event(coro: Any, event_name: str, *event_args: Any, **kwargs: Any) -> asyncio.Task[Any]:
+        scheduled_at = time.perf_counter()
+        task = schedule_event(coro, event_name, *event_args, **kwargs)
+        listeners.add(task)
+        def done(task: asyncio.Task[Any]) -> None:
+            listeners.discard(task)
+            latencies[event_name].append(time.perf_counter() - scheduled_at)
+        task.add_done_callback(done)
+        return task
+    bot._schedule_event = timed_schedule_event # type: ignore
+
+    raw_frames = [json.dumps(frame, separators=(',', ':'), ensure_ascii=False) for frame in frames]
+    parsers = bot._connection.parsers
+    def receive(raw: str) -> str:
+        # What DiscordWebSocket.received_message does with each frame
+        bot.dispatch('socket_raw_receive', raw)
+        payload = discord.utils._from_json(raw)
+        parsers[payload['t']](payload['d'])
+        return payload['t']
+
+    # The guilds have to be there before the cogs load, like when the bot starts
+    setup_count = 0
+    while setup_count < len(raw_frames) and frames[setup_count]['t'] == 'GUILD_CREATE':
+        receive(raw_frames[setup_count])
+        setup_count += 1
+    if args.log_channel is not None:
+        os.makedirs('logs', exist_ok=True)
+        guild = bot.get_channel(args.log_channel).guild # type: ignore
+        with open(f'logs/{guild.id}.json', 'w') as file:
+            json.dump({str(args.log_channel): {item: True for item in ('message_delete', 'message_edit', 'member_join', 'member_remove')}}, file)
+    await bot.load_extension('cogs.logs')
+    await bot.load_extension('cogs.history')
+    history = bot.get_cog('History')
+    logs = bot.get_cog('Logs')
+    assert(history is not None and logs is not None)
+
+    parse_times: dict[str, list[float]] = collections.defaultdict(list)
+    created = 0
+    start = time.perf_counter()
+    for i in range(setup_count, len(raw_frames)):
+        parse_start = time.perf_counter()
+        event = receive(raw_frames[i])
+        parse_times[event].append(time.perf_counter() - parse_start)
+        created += event == 'MESSAGE_CREATE'
+        if i % args.burst == 0:
+            # The end of a burst, when the gateway would wait for more data
+            delay = start + (i - setup_count) / args.rate - time.perf_counter() if args.rate else 0
+            await asyncio.sleep(max(delay, 0))
+    while listeners:
+        await asyncio.gather(*listeners, return_exceptions=True)
+    await history._flush_messages() # type: ignore
+    live_time = time.perf_counter() - start
+
+    # Backfill runs alongside the live traffic, and is done once nothing is queued or being fetched
+    while history._channel_ids_queue.qsize() or history._fetching_channel_ids: # type: ignore
+        await asyncio.sleep(0.01)
+    await history._flush_messages() # type: ignore
+    backfill_time = time.perf_counter() - start
+    while logs._log_sender.depth() or logs._log_sender.busy_channels(): # type: ignore
+        await asyncio.sleep(0.01)
+    total_time = time.perf_counter() - start
+    log_entries = logs._log_sender.sent_entries # type: ignore
+
+    await bot.close()
+
+    database_sizes = {
+        name: sum(os.path.getsize(f'databases/{name}{suffix}') for suffix in ('', '-wal') if os.path.exists(f'databases/{name}{suffix}'))
+        for name in sorted(os.listdir('databases')) if name.endswith('.sqlite')
+    }
+    backfilled = sum(len(messages) for messages in backfill.values())
+    return {
+        'frames': len(raw_frames) - setup_count,
+        'messages_created': created,
+        'messages_backfilled': backfilled,
+        'live_seconds': live_time,
+        'live_messages_per_second': created / live_time if live_time else 0.0,
+        'backfill_seconds': backfill_time,
+        'total_messages_per_second': (created + backfilled) / backfill_time if backfill_time else 0.0,
+        'log_entries': log_entries,
+        'log_seconds': total_time,
+        'http_requests': dict(http.requests),
+        'parse_ms': {
+            event: {'count': len(samples), 'p50': _percentile(sorted(samples), 0.5) * 1000, 'p99': _percentile(sorted(samples), 0.99) * 1000}
+            for event, samples in sorted(parse_times.items())
+        },
+        'listener_ms': {
+            event: {'count': len(samples), 'p50': _percentile(sorted(samples), 0.5) * 1000, 'p99': _percentile(sorted(samples), 0.99) * 1000}
+            for event, samples in sorted(latencies.items())
+        },
+        'database_bytes': database_sizes,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+def print_report(results: dict[str, Any], /) -> None:
+    print(f'{results["frames"]} frames, {results["messages_created"]} new messages, {results["messages_backfilled"]} backfilled')
+    print(f'live ingest: {results["live_seconds"]:.2f} s, {results["live_messages_per_second"]:.0f} messages/s')
+    print(f'with backfill: {results["backfill_seconds"]:.2f} s, {results["total_messages_per_second"]:.0f} messages/s')
+    print(f'log delivery: {results["log_entries"]} entries, done after {results["log_seconds"]:.2f} s')
+    print()
+    print(f'{"event":<40} {"count":>8} {"p50 ms":>8} {"p99 ms":>8}')
+    for kind in ('parse', 'listener'):
+        for event, stats in results[f'{kind}_ms'].items():
+            print(f'{kind + " " + event:<40} {stats["count"]:>8} {stats["p50"]:>8.3f} {stats["p99"]:>8.3f}')
+    print()
+    for name, size in results['database_bytes'].items():
+        print(f'{name}: {size / 1024 / 1024:.1f} MiB')
+    print(f'peak RSS: {results["peak_rss_mib"]:.0f} MiB')
+
+def main() -> None:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.replay', description=(__doc__ or '').split('\n\n')[0].strip())
+    parser.add_argument('--traffic', help='replay gateway payloads from this JSON lines file instead of generating them')
+    parser.add_argument('--record', help='also write the generated traffic to this JSON lines file')
+    parser.add_argument('--messages', type=int, default=20000, help='new messages to generate (default: %(default)s)')
+    parser.add_argument('--backfill', type=int, default=20000, help='messages to generate for history fetching (default: %(default)s)')
+    parser.add_argument('--channels', type=int, default=20, help='channels to generate (default: %(default)s)')
+    parser.add_argument('--users', type=int, default=500, help='users to generate (default: %(default)s)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--burst', type=int, default=50, help='frames handled before yielding to the event loop (default: %(default)s)')
+    parser.add_argument('--rate', type=float, default=0.0, help='frames per second to replay at, 0 for as fast as possible (default: %(default)s)')
+    parser.add_argument('--http-latency', type=float, default=0.0, help='seconds each stubbed request takes (default: %(default)s)')
+    parser.add_argument('--log-channel', type=int, help='log everything to this channel (default: a generated one)')
+    parser.add_argument('--config', default='{}', help='JSON object of config.json settings to use')
+    parser.add_argument('--json', help='also write the results to this file, to compare runs')
+    parser.add_argument('--keep', action='store_true', help="keep the run's directory (databases, logs) and print where it is")
+    args = parser.parse_args()
+
+    if args.traffic is not None:
+        with open(args.traffic, 'r') as file:
+            frames = [json.loads(line) for line in file if line.strip()]
+        backfill: dict[int, list[dict[str, Any]]] = {}
+    else:
+        frames, backfill = synthetic_traffic(args.messages, args.channels, args.users, args.backfill, args.seed)
+        if args.log_channel is None:
+            args.log_channel = LOG_CHANNEL_ID
+        if args.record is not None:
+            with open(args.record, 'w') as file:
+                file.writelines(json.dumps(frame) + '\n' for frame in frames)
+    json_path = os.path.abspath(args.json) if args.json is not None else None
+
+    directory = tempfile.mkdtemp(prefix='replay-')
+    os.chdir(directory)
+    with open('config.json', 'w') as file:
+        # Stubbed history requests aren't rate limited, so only the configured limit would slow them down
+        json.dump({'history_fetch_requests_per_second': 1000.0, **json.loads(args.config)}, file)
+
+    try:
+        # BotClient prints every message it sees, which would bury the report
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            results = asyncio.run(replay(frames, backfill, args))
+    finally:
+        if args.keep:
+            print(f'kept {directory}')
+        else:
+            shutil.rmtree(directory)
+
+    print_report(results)
+    if json_path is not None:
+        with open(json_path, 'w') as file:
+            json.dump(results, file, indent=4)
+
+if __name__ == '__main__':
+    main()
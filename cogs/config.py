@@ -0,0 +1,29 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import interface
+from discord.ext import commands
+from main import BotClient
+
+class Config(commands.Cog):
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+
+    @commands.is_owner()
+    @commands.group()
+    async def config(self, ctx: commands.Context[commands.Bot]) -> None:
+        pass
+
+    @config.command()
+    async def reload(self, ctx: commands.Context[commands.Bot]) -> None:
+        """Read config.json again, without restarting."""
+        try:
+            self.bot.reload_configs()
+        # Invalid JSON raises json.JSONDecodeError, which is a ValueError
+        except (OSError, ValueError) as e:
+            await interface.reply(ctx, f'Could not load config.json, keeping the current config: {e}')
+            return
+
+        await interface.reply(ctx, 'Reloaded config.json.')
+
+async def setup(bot: BotClient):
+    await bot.add_cog(Config(bot))
@@ -1,57 +1,230 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import aiohttp
 import asyncio
+import collections
+import database
+import datetime
 import discord
+import functools
+import hashlib
+import interface
+import itertools
 import json
 import logging
+import mimetypes
 import os
 import pathlib
 import sqlite3
+import tarfile
+import time
+from compression import COMPRESSION_KINDS, HAS_ZSTD, Codec, CompressionKind, StreamKind, open_compressed, train_dictionary
 from discord.ext import commands
-from main import BotClient
-from typing import Any, Optional
-
+from main import BotClient, BotConfig
+from metrics import REGISTRY
+from typing import Any, AsyncIterator, BinaryIO, Callable, Collection, Iterator, Literal, Optional, TypedDict
+
+try:
+    import orjson
+except ModuleNotFoundError:
+    _json_loads: Callable[[str], Any] = json.loads
+else:
+    _json_loads = orjson.loads
+
+DATABASE_PATH = 'databases/history.sqlite'
+
+# Exports made with "b!history export" are written here.
+EXPORTS_DIRECTORY = 'exports'
+
+# Message writes are buffered and committed together, either once this many
+# are pending or after MESSAGE_FLUSH_INTERVAL seconds, whichever comes first.
+MESSAGE_FLUSH_SIZE = 500
+MESSAGE_FLUSH_INTERVAL = 1.0
+
+# A flush that failed on the database itself (an OperationalError, like a busy or failing disk)
+# keeps its writes for the next one, which waits this many seconds first, doubling after each
+# consecutive failure up to MESSAGE_FLUSH_MAX_RETRY_DELAY.
+MESSAGE_FLUSH_RETRY_DELAY = 1.0
+MESSAGE_FLUSH_MAX_RETRY_DELAY = 60.0
+
+# While an index in MESSAGE_INDEXES is built, SQLite's only writer is busy with it for the whole build,
+# so no flush can commit. Live messages are kept in memory meanwhile, and only wait for the build
+# once this many writes are pending. Backfills wait from MESSAGE_FLUSH_SIZE as usual.
+MESSAGE_INDEX_BUILD_MAX_PENDING = 50000
+
+# Keys that the data of every stored message needs. Writes of data without them are dropped
+# when they're queued, rather than failing the flush they would be part of.
+REQUIRED_MESSAGE_KEYS = ('id', 'channel_id', 'author', 'pinned', 'content', 'attachments', 'embeds')
+
+# discord.py fetches history in pages of this many messages.
+HISTORY_PAGE_SIZE = 100
+
+# While fetching a channel's history, its checkpoint is moved at least this often (in seconds),
+# even if a page takes longer than that to get through.
+CHECKPOINT_INTERVAL = 5.0
+
+# A failed attachment download is attempted this many times in total,
+# waiting ATTACHMENT_RETRY_DELAY seconds before the first retry and doubling that each time.
+ATTACHMENT_DOWNLOAD_ATTEMPTS = 4
+ATTACHMENT_RETRY_DELAY = 2.0
+
+# Attachments found by the index_media command are recorded in batches of this many.
+MEDIA_INDEX_BATCH_SIZE = 1000
+
+# When converting the database to a new layout, rows are written in batches of this many.
+MIGRATION_BATCH_SIZE = 1000
+
+# A compression dictionary is trained on up to this many stored messages,
+# and only once at least MIN_DICTIONARY_SAMPLES messages are stored.
+DICTIONARY_SAMPLES = 5000
+MIN_DICTIONARY_SAMPLES = 500
+
+# The history compact command re-encodes this many rows per transaction.
+COMPACTION_BATCH_SIZE = 500
+
+# When writing messages, the stored versions of this many messages are looked up per query.
+LATEST_VERSIONS_QUERY_SIZE = 500
+
+# At most this many writes can wait for the database thread at once.
+MAX_PENDING_DATABASE_WRITES = 16
+
+# A stored user profile older than this many seconds is refreshed from Discord when it's needed.
+USER_PROFILE_TTL = 7 * 24 * 60 * 60
+
+# When building the search index of messages stored before it existed, this many rows are indexed per transaction.
+SEARCH_INDEX_BATCH_SIZE = 2000
+
+# History.iter_messages reads this many messages per query.
+MESSAGE_RANGE_PAGE_SIZE = 500
+
+# Exports read this many messages per query, which bounds how much of an export is in memory at once.
+EXPORT_PAGE_SIZE = 1000
+
+# How many results "b!history search" shows at once, small enough to fit in one message.
+SEARCH_PAGE_SIZE = 5
+
+_INGESTED_HELP = 'Messages queued to be stored: from the gateway (socket), built by discord.py from a fetch (hook), or fetched as history (backfill, also counted by hook).'
+SOCKET_MESSAGES = REGISTRY.counter('history_messages_ingested_total', _INGESTED_HELP, path='socket')
+HOOK_MESSAGES = REGISTRY.counter('history_messages_ingested_total', _INGESTED_HELP, path='hook')
+BACKFILL_MESSAGES = REGISTRY.counter('history_messages_ingested_total', _INGESTED_HELP, path='backfill')
+ATTACHMENT_BYTES = REGISTRY.counter('history_attachment_download_bytes_total', 'Bytes of attachments downloaded.')
+ATTACHMENT_FAILURES = REGISTRY.counter('history_attachment_download_failures_total', 'Attachments that could not be downloaded.')
+ATTACHMENT_SECONDS = REGISTRY.histogram('history_attachment_download_seconds', 'Time each successful attachment download took, including retries.')
+
+# 'create': add the message, unless it is already stored.
+# 'update': add the message, or a new version of it if anything has changed.
+# 'edit': add a new version of the message unconditionally (or the message, if it isn't stored).
+WriteMode = Literal['create', 'update', 'edit']
+
+class UserProfile(TypedDict):
+    """What a user looked like when they were last seen, for when they can't be looked up anymore."""
+    user_id: int
+    display_name: str
+    avatar_url: str
+    # The colour of their roles when they were last seen leaving a server, if they were
+    colour: int | None
+    # Unix time of when this was last known to be up to date
+    updated_at: float
+
+class ExportFlags(commands.FlagConverter):
+    """Options of "b!history export". Only messages of the server are exported, all of them without channel or author."""
+    channel: Optional[discord.abc.GuildChannel] = None
+    author: Optional[discord.User] = None
+    # Resume an export from after this message ID
+    after: int = 0
+    compression: str = 'gzip'
+    # Also bundle the downloaded attachments of the exported messages
+    media: bool = False
+
+class SearchQuery(TypedDict):
+    """A parsed "b!history search" query (see _parse_search_query)."""
+    terms: list[str]
+    author_id: int | None
+    channel_id: int | None
+    # Only messages with IDs strictly between these match
+    after_id: int
+    before_id: int
 
 class History(commands.Cog):
     def __init__(self, bot: BotClient):
         self.bot = bot
         self._fetching_channel_ids: set[int] = set()
-        self._channel_ids_queue: asyncio.Queue[int] = asyncio.Queue()
-        self._channel_fetch_task = self.bot.loop.create_task(self._channel_fetch_worker())
+        self._channel_ids_queue = ChannelFetchQueue()
+        self._history_rate_limiter = RateLimiter(self.bot.history_fetch_requests_per_second())
+        self._channel_fetch_tasks = [
+            self.bot.loop.create_task(self._channel_fetch_worker())
+            for _ in range(self.bot.history_fetch_workers())
+        ]
+
+        self._pending_writes: list[tuple[WriteMode, dict[str, Any]]] = []
+        # Latest pending data of each message in _pending_writes, so lookups see it before it's flushed.
+        self._pending_messages: dict[int, dict[str, Any]] = {}
+        # Same, for writes handed to the database but not committed yet.
+        self._flushing_messages: dict[int, dict[str, Any]] = {}
+        # Channel checkpoints are committed in the same transaction as the messages before them.
+        self._pending_checkpoints: dict[int, int] = {}
+        self._flush_lock = asyncio.Lock()
+        self._failed_flushes = 0
+        self._flush_requested = asyncio.Event()
+        # Recently written and read messages, so lookups of them skip the database.
+        # Writes replace the cached data, so it's always the latest version.
+        self._message_cache = MessageCache(self.bot.history_message_cache_size())
+        self._message_flush_task = self.bot.loop.create_task(self._message_flush_worker())
+
+        self._attachment_queue: asyncio.Queue[tuple[int, int, int, discord.Attachment]] = asyncio.Queue()
+        self._queued_attachment_ids: set[int] = set()
+        # Attachments to record in "pending_attachments" with the next flush, so that
+        # downloads that haven't finished when the bot stops are resumed when it starts.
+        self._pending_attachments: list[tuple[int, int, int, int, str]] = []
+        self._attachment_download_tasks = [
+            self.bot.loop.create_task(self._attachment_download_worker())
+            for _ in range(self.bot.attachment_download_workers())
+        ]
+
+        # Replaced with the configured one once the database is ready
+        self._codec = Codec('none')
+        self._compaction_task: asyncio.Task[None] | None = None
+        # Indexes messages stored before the search index existed, if there are any left
+        self._search_index_task: asyncio.Task[None] | None = None
+        # Creates the indexes in MESSAGE_INDEXES that the database doesn't have yet
+        self._message_index_task: asyncio.Task[None] | None = None
+        self._building_message_index = False
+
+        # Users being fetched from Discord, so that lookups of the same user share one request
+        self._user_fetches: dict[int, asyncio.Task[UserProfile | None]] = {}
+
+        # The last edit of each message that get_and_update_message is handling, which the next edit of it waits for
+        self._message_edits: dict[int, asyncio.Future[None]] = {}
 
         os.makedirs('databases', exist_ok=True)
-        self._connection = sqlite3.connect('databases/history.sqlite', autocommit=False)
-
-        self._connection.execute('PRAGMA foreign_keys = true;')
-        self._connection.execute("""
-                CREATE TABLE IF NOT EXISTS "messages" (
-                    "message_id" INTEGER NOT NULL,
-                    "channel_id" INTEGER NOT NULL,
-                    "author_id" INTEGER NOT NULL,
-                    "version" INTEGER NOT NULL DEFAULT 0,
-                    "pinned" INTEGER NOT NULL,
-                    "edited_timestamp" TEXT,
-                    "content" TEXT NOT NULL,
-                    "attachments" TEXT NOT NULL,
-                    "embeds" TEXT NOT NULL,
-                    "json" TEXT NOT NULL,
-                    PRIMARY KEY ("message_id", "version")
-                );
-            """,
+        self._db = database.Database(
+            DATABASE_PATH,
+            max_pending=MAX_PENDING_DATABASE_WRITES,
+            on_connect=functools.partial(_configure_connection, profile=self.bot.history_database_profile()),
         )
-        self._connection.execute("""
-                CREATE TABLE IF NOT EXISTS "channels" (
-                    "channel_id" INTEGER PRIMARY KEY NOT NULL,
-                    "last_message_id" INTEGER
-                );
-            """)
-        self._connection.commit()
+        self._maintenance_task = self.bot.loop.create_task(self._database_maintenance_worker())
+
+        REGISTRY.gauge('history_channel_fetch_queue_depth', 'Channels waiting for their history to be fetched.',
+                       function=self._channel_ids_queue.qsize)
+        REGISTRY.gauge('history_channels_fetching', 'Channels queued or being fetched.',
+                       function=lambda: len(self._fetching_channel_ids))
+        REGISTRY.gauge('history_pending_message_writes', 'Message writes waiting for the next flush.',
+                       function=lambda: len(self._pending_writes))
+        REGISTRY.gauge('history_attachment_queue_depth', 'Attachments waiting to be downloaded.',
+                       function=self._attachment_queue.qsize)
+        REGISTRY.gauge('history_message_cache_size', 'Messages in the message cache.',
+                       function=lambda: len(self._message_cache))
+        REGISTRY.counter('history_message_cache_hits_total', 'Message lookups answered by the cache.',
+                         function=lambda: self._message_cache.hits)
+        REGISTRY.counter('history_message_cache_misses_total', 'Message lookups that missed the cache.',
+                         function=lambda: self._message_cache.misses)
 
         def check_before_update_message(data: dict[str, Any], /):
             channel_id: int = int(data['channel_id'])
             channel = self.bot.get_channel(channel_id)
             if isinstance(channel, discord.abc.GuildChannel) and not self.bot.history_enabled(channel.guild.id):
                 return
+            HOOK_MESSAGES.inc()
             self._update_message(data)
         self.bot.register_create_message_hook(check_before_update_message)
 
@@ -63,78 +236,130 @@ class History(commands.Cog):
             self._enqueue_channel_fetch_if_allowed(thread)
 
     async def cog_load(self) -> None:
+        await self._db.write(_create_tables)
+        self._codec = await self._db.write(functools.partial(_load_codec, self.bot.history_compression()))
+        if await self._db.read(_is_search_index_incomplete):
+            self._search_index_task = self.bot.loop.create_task(self._build_search_index())
+        missing_indexes = await self._db.read(_missing_message_indexes)
+        if missing_indexes:
+            self._message_index_task = self.bot.loop.create_task(self._create_message_indexes(missing_indexes))
+
         for guild in self.bot.guilds:
             if self.bot.history_fetching_enabled(guild.id):
                 self._enqueue_all_allowed_channels_in_guild(guild)
 
+        # Downloads that were queued when the bot last stopped
+        for guild_id, channel_id, message_id, data in await self._db.read(_get_pending_attachments):
+            attachment = discord.Attachment(data=json.loads(data), state=self.bot._connection)
+            self._queue_attachment_download(guild_id, channel_id, message_id, attachment)
+
+    async def cog_unload(self) -> None:
+        for task in self._channel_fetch_tasks + self._attachment_download_tasks:
+            task.cancel()
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+        if self._search_index_task is not None:
+            self._search_index_task.cancel()
+        if self._message_index_task is not None:
+            self._message_index_task.cancel()
+        self._maintenance_task.cancel()
+        self._message_flush_task.cancel()
+        await self._flush_messages()
+        await self._db.close()
+
     def _enqueue_channel_fetch_if_allowed(self, channel: discord.abc.Messageable, /) -> None:
         if not isinstance(channel, (discord.abc.GuildChannel, discord.Thread)):
             raise TypeError('channel must also be a GuildChannel or Thread')
 
         permission = channel.permissions_for(channel.guild.me)
         if permission.read_message_history:
-            self._enqueue_channel_fetch(channel.id)
+            self._enqueue_channel_fetch(channel.guild.id, channel.id)
 
-    def _enqueue_channel_fetch(self, channel_id: int, /) -> None:
+    def _enqueue_channel_fetch(self, guild_id: int, channel_id: int, /) -> None:
         if channel_id in self._fetching_channel_ids:
             return
 
         self._fetching_channel_ids.add(channel_id)
-        self._channel_ids_queue.put_nowait(channel_id)
+        self._channel_ids_queue.put(guild_id, channel_id)
 
     async def _channel_fetch_worker(self) -> None:
+        # Each channel is only ever fetched by one worker at a time, so a worker waiting on
+        # a channel's rate limit bucket (which discord.py handles) doesn't hold up the others.
         while True:
             channel_id = await self._channel_ids_queue.get()
             channel = self.bot.get_channel(channel_id)
-            assert(channel is not None and isinstance(channel, discord.abc.Messageable))
 
             try:
-                await self._get_new_messages(channel)
+                if channel is None:
+                    logging.warning('Channel %s disappeared before its messages could be fetched', channel_id)
+                else:
+                    assert(isinstance(channel, discord.abc.Messageable))
+                    await self._get_new_messages(channel)
             except (discord.Forbidden, discord.HTTPException) as e:
                 logging.warning('Error fetching messages for channel %s: %s', channel_id, e)
-
-            self._fetching_channel_ids.remove(channel_id)
-            self._channel_ids_queue.task_done()
+            except Exception:
+                # Anything else is a bug, but it shouldn't stop this worker from fetching other channels
+                logging.exception('Unexpected error fetching messages for channel %s', channel_id)
+            finally:
+                self._fetching_channel_ids.remove(channel_id)
 
     async def _get_new_messages(self, channel: discord.abc.Messageable, /) -> None:
         if not isinstance(channel, (discord.abc.GuildChannel, discord.Thread)):
             raise TypeError('channel must also be a GuildChannel or Thread')
 
-        cursor = self._connection.execute("""
-                SELECT "channel_id", "last_message_id"
-                FROM "channels"
-                WHERE "channel_id" = ?
-            """,
-            (channel.id,),
-        )
-        row: tuple[Optional[int], Optional[int]] | None = cursor.fetchone()
-        db_channel_id, last_message_id = row or (None, None)
-
-        if db_channel_id is None:
-            self._connection.execute("""
-                    INSERT INTO "channels" ("channel_id", "last_message_id")
-                    VALUES (?, ?)
-                """,
-                (channel.id, last_message_id),
-            )
-            self._connection.commit()
-
-        last_message_id = last_message_id or 0
-        async for message in channel.history(after=discord.Object(id=last_message_id), limit=None, oldest_first=True):
-            # all fetched messages trigger _update_message hook
-
-            last_message_id = message.id
-            self._connection.execute("""
-                    UPDATE "channels"
-                    SET "last_message_id" = ?
-                    WHERE "channel_id" = ?
-                """,
-                (last_message_id, channel.id),
-            )
-            self._connection.commit()
+        last_message_id = await self._db.write(functools.partial(_get_or_create_checkpoint, channel.id))
+
+        # The checkpoint is only moved once per page or CHECKPOINT_INTERVAL, and it's written
+        # in the same transaction as the messages before it (or a later one), so it never gets
+        # ahead of what's stored. After a crash, at most the messages since the last committed
+        # checkpoint are fetched again, and those are recognized as unchanged.
+        loop = asyncio.get_running_loop()
+        last_checkpoint_time = loop.time()
+        fetched = 0
+        await self._history_rate_limiter.acquire()
+        try:
+            async for message in channel.history(after=discord.Object(id=last_message_id), limit=None, oldest_first=True):
+                # all fetched messages trigger _update_message hook
+
+                last_message_id = message.id
+                fetched += 1
+                BACKFILL_MESSAGES.inc()
+                end_of_page = fetched % HISTORY_PAGE_SIZE == 0
+
+                # Before the checkpoint moves past the message, so its downloads are flushed with it
+                if message.attachments:
+                    self._enqueue_attachment_downloads(message)
+
+                if end_of_page or loop.time() - last_checkpoint_time >= CHECKPOINT_INTERVAL:
+                    self._pending_checkpoints[channel.id] = last_message_id
+                    last_checkpoint_time = loop.time()
+
+                await self._wait_for_flush_room()
+
+                if end_of_page:
+                    if not self.bot.history_fetching_enabled(channel.guild.id):
+                        # Fetching was disabled by a config reload
+                        break
+                    # The next iteration requests another page
+                    await self._history_rate_limiter.acquire()
+        finally:
+            if fetched:
+                self._pending_checkpoints[channel.id] = last_message_id
 
-            if message.attachments:
-                await self._download_attachments(message)
+    @commands.Cog.listener()
+    async def on_config_reload(self, old_configs: BotConfig) -> None:
+        self._history_rate_limiter.rate = self.bot.history_fetch_requests_per_second()
+
+        for guild_id in self._channel_ids_queue.guild_ids():
+            if not self.bot.history_fetching_enabled(guild_id):
+                for channel_id in self._channel_ids_queue.remove_guild(guild_id):
+                    self._fetching_channel_ids.remove(channel_id)
+
+        # Guilds that fetching was just enabled for catch up right away
+        previously_disabled = {*old_configs['history_disabled_guilds'], *old_configs['history_fetching_disabled_guilds']}
+        for guild in self.bot.guilds:
+            if guild.id in previously_disabled and self.bot.history_fetching_enabled(guild.id):
+                self._enqueue_all_allowed_channels_in_guild(guild)
 
     @commands.Cog.listener()
     async def on_guild_available(self, guild: discord.Guild) -> None:
@@ -220,7 +445,7 @@ class History(commands.Cog):
             return
 
         # Screw it, just assume we're allowed to
-        self._enqueue_channel_fetch(payload.thread_id)
+        self._enqueue_channel_fetch(payload.guild_id, payload.thread_id)
 
     @commands.Cog.listener()
     async def on_thread_member_join(self, member: discord.ThreadMember) -> None:
@@ -240,34 +465,21 @@ class History(commands.Cog):
         (the library doesn't have on_raw_message).
         """
 
-        payload: dict[str, Any] = json.loads(msg)
+        if not _may_be_message_create(msg):
+            return
+
+        payload: dict[str, Any] = _json_loads(msg)
         if payload['t'] == 'MESSAGE_CREATE':
             channel_id = int(payload['d']['channel_id'])
             channel = self.bot.get_channel(channel_id)
             disabled = isinstance(channel, discord.abc.GuildChannel) and not self.bot.history_enabled(channel.guild.id)
             if not disabled:
+                SOCKET_MESSAGES.inc()
                 self._add_new_message(payload['d'])
+                await self._wait_for_flush_room(live=True)
 
-    def _add_new_message(self, data: dict[str, Any], version = 0, /) -> None:
-        message_id: int = data['id']
-        channel_id: int = data['channel_id']
-        author_id: int = data['author']['id']
-        pinned: bool = data['pinned']
-        edited_timestamp: str | None = data.get('edited_timestamp')
-        content: str = data['content']
-        attachments: str = json.dumps(data['attachments'])
-        embeds: str = json.dumps(data['embeds'])
-        raw_json: str = json.dumps(data)
-
-        self._connection.execute("""
-                INSERT INTO "messages"
-                (message_id, channel_id, author_id, version, pinned, edited_timestamp, content, attachments, embeds, json)
-                VALUES
-                (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """,
-            (message_id, channel_id, author_id, version, int(pinned), edited_timestamp, content, attachments, embeds, raw_json),
-        )
-        self._connection.commit()
+    def _add_new_message(self, data: dict[str, Any], /) -> None:
+        self._queue_write('create', data)
 
     def _update_message(self, data: dict[str, Any], /) -> None:
         """Add the message to the database by the following logic:
@@ -276,172 +488,1779 @@ class History(commands.Cog):
         If it has, add a new version of the message with the new content.
         If the message doesn't exist, add it as a new message.
         """
-        message_id: int = int(data['id'])
+        self._queue_write('update', data)
+
+    def _queue_write(self, mode: WriteMode, data: dict[str, Any], /) -> None:
+        missing_keys = [key for key in REQUIRED_MESSAGE_KEYS if key not in data]
+        if 'author' in data and not (isinstance(data['author'], dict) and 'id' in data['author']):
+            missing_keys.append('author.id')
+        if missing_keys:
+            logging.warning('Not storing message %s, its data has no %s', data.get('id'), ', '.join(missing_keys))
+            return
+
+        self._pending_writes.append((mode, data))
+
+        # An update that won't add a version shouldn't hide what the previous write had
+        message_id = int(data['id'])
+        pending = self._pending_messages.get(message_id)
+        if mode != 'update' or pending is None or _tracked_fields(pending) != _tracked_fields(data):
+            self._pending_messages[message_id] = data
+            self._message_cache.put(message_id, data)
+
+        if len(self._pending_writes) >= MESSAGE_FLUSH_SIZE:
+            self._flush_requested.set()
+
+    async def _wait_for_flush_room(self, *, live: bool = False) -> None:
+        """If too many writes are pending, wait until they have been written.
+        This is how a database that can't keep up slows down whoever is producing the writes.
+        Live messages are allowed more pending writes while a message index is built (see MESSAGE_INDEX_BUILD_MAX_PENDING).
+        """
+        limit = MESSAGE_INDEX_BUILD_MAX_PENDING if live and self._building_message_index else MESSAGE_FLUSH_SIZE
+        if len(self._pending_writes) >= limit:
+            await self._flush_messages()
 
-        cursor = self._connection.execute("""
-                SELECT MAX("version"), "pinned", "edited_timestamp", "content", "attachments", "embeds"
-                FROM "messages"
-                WHERE "message_id" = ?
-            """,
-            (message_id,),
-        )
+    async def _message_flush_worker(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), MESSAGE_FLUSH_INTERVAL)
+            except TimeoutError:
+                pass
+            self._flush_requested.clear()
+            try:
+                await self._flush_messages()
+            except Exception:
+                logging.exception('Unexpected error while flushing messages')
 
-        row: tuple[Optional[int], Optional[int], Optional[str], Optional[str], Optional[str], Optional[str]] | None = cursor.fetchone()
-        version, old_pinned, old_edited_timestamp, old_content, old_attachments, old_embeds = row or (None, None, None, None, None, None)
-        if version is None or old_pinned is None or old_content is None or old_attachments is None or old_embeds is None:
-            # Message does not exist, add it
-            self._add_new_message(data)
+    async def _database_maintenance_worker(self) -> None:
+        interval = self.bot.history_maintenance_interval()
+        if interval <= 0:
             return
 
-        pinned: bool = data['pinned']
-        content: str = data['content']
-        edited_timestamp: str | None = data.get('edited_timestamp')
-
-        old_pinned = bool(old_pinned)
-        # Message exists, check if anything has changed
-        if (old_pinned != pinned or
-            old_edited_timestamp != edited_timestamp or
-            old_content != content or
-            json.loads(old_attachments) != data['attachments'] or
-            json.loads(old_embeds) != data['embeds']):
-            self._add_new_message(data, version + 1)
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._db.write(_maintain_database)
+            except sqlite3.Error:
+                logging.exception('History database maintenance failed')
+
+    async def _flush_messages(self) -> None:
+        """Write all pending messages and channel checkpoints in one transaction."""
+        async with self._flush_lock:
+            if not self._pending_writes and not self._pending_checkpoints and not self._pending_attachments:
+                return
+            if self._failed_flushes:
+                await asyncio.sleep(min(MESSAGE_FLUSH_RETRY_DELAY * 2 ** (self._failed_flushes - 1), MESSAGE_FLUSH_MAX_RETRY_DELAY))
+
+            writes = self._pending_writes
+            checkpoints = self._pending_checkpoints
+            attachments = self._pending_attachments
+            self._flushing_messages = self._pending_messages
+            self._pending_writes = []
+            self._pending_messages = {}
+            self._pending_checkpoints = {}
+            self._pending_attachments = []
 
-    def get_message(self, message_id: int, /) -> dict[str, Any] | None:
+            try:
+                # Once handed to the database, the write goes through even if this is cancelled
+                try:
+                    await asyncio.shield(self._db.write(functools.partial(_write_messages, writes, checkpoints, attachments, self._codec)))
+                except sqlite3.OperationalError:
+                    raise
+                except Exception:
+                    # Not the database's fault, so one of the writes can't be stored however often it's retried
+                    logging.exception('Failed to write %s messages, writing them again without the ones that fail', len(writes))
+                    skipped = await asyncio.shield(self._db.write(functools.partial(_write_messages_skipping_failures, writes, checkpoints, attachments, self._codec)))
+                    for _, data in skipped:
+                        self._message_cache.discard(int(data['id']))
+            except Exception:
+                self._failed_flushes += 1
+                logging.exception('Failed to write %s messages, they will be retried', len(writes))
+                # Back in front of whatever was queued since. The checkpoints go with them,
+                # so that no checkpoint is committed before the messages it covers.
+                self._pending_writes = writes + self._pending_writes
+                self._pending_messages = {**self._flushing_messages, **self._pending_messages}
+                self._pending_checkpoints = {**checkpoints, **self._pending_checkpoints}
+                self._pending_attachments = attachments + self._pending_attachments
+            else:
+                self._failed_flushes = 0
+            finally:
+                self._flushing_messages = {}
+
+    async def get_message(self, message_id: int, /) -> dict[str, Any] | None:
         """Get the latest version of a message by its ID, if it exists."""
 
-        cursor = self._connection.execute("""
-                SELECT MAX("version"), "json"
-                FROM "messages"
-                WHERE "message_id" = ?
-            """,
-            (message_id,),
-        )
+        pending = self._pending_messages.get(message_id) or self._flushing_messages.get(message_id)
+        if pending is not None:
+            return pending
 
-        row: tuple[Optional[int], Optional[str]] | None= cursor.fetchone()
-        version, raw_json = row or (None, None)
-        if version is None or raw_json is None:
-            return None
+        cached = self._message_cache.get(message_id)
+        if cached is not None:
+            return cached
 
-        data: dict[str, Any] = json.loads(raw_json)
+        data = await self._db.read(functools.partial(_get_message_data, message_id, self._codec))
+        # If it was written while it was being read, the cache already has the newer data
+        if data is not None and message_id not in self._message_cache:
+            self._message_cache.put(message_id, data)
         return data
 
+    async def get_messages(self, message_ids: Collection[int], /) -> dict[int, dict[str, Any]]:
+        """Get the latest versions of several messages by their IDs, looking up
+        the ones that aren't pending or cached in one query. Messages that don't exist are left out.
+        """
+
+        messages: dict[int, dict[str, Any]] = {}
+        missing_ids: list[int] = []
+        for message_id in message_ids:
+            data = (self._pending_messages.get(message_id)
+                or self._flushing_messages.get(message_id)
+                or self._message_cache.get(message_id))
+            if data is None:
+                missing_ids.append(message_id)
+            else:
+                messages[message_id] = data
+
+        if missing_ids:
+            stored = await self._db.read(functools.partial(_get_messages_data, missing_ids, self._codec))
+            for message_id, data in stored.items():
+                if message_id not in self._message_cache:
+                    self._message_cache.put(message_id, data)
+            messages.update(stored)
+
+        return messages
+
+    async def iter_messages(
+        self, *,
+        channel_id: int | None = None,
+        author_id: int | None = None,
+        after: datetime.datetime | int | None = None,
+        before: datetime.datetime | int | None = None,
+        page_size: int = MESSAGE_RANGE_PAGE_SIZE,
+    ) -> AsyncIterator[tuple[int, dict[str, Any]]]:
+        """Iterate over the latest versions of stored messages in a channel and/or by an author, oldest first.
+        after and before are exclusive bounds, given as times or as message IDs (which encode their time).
+
+        Messages are read page_size at a time, each page starting after the last message of the one
+        before it, so every page is an index lookup however far into the range it is.
+        Unlike get_messages, this doesn't fill the message cache.
+        """
+        after_id = _snowflake_bound(after, 0, high=True)
+        before_id = _snowflake_bound(before, 2 ** 63 - 1, high=False)
+
+        while True:
+            page = await self._db.read(functools.partial(
+                _get_messages_in_range, channel_id, author_id, after_id, before_id, page_size, self._codec,
+            ))
+            for message_id, data in page:
+                yield message_id, self._pending_messages.get(message_id) or self._flushing_messages.get(message_id) or data
+
+            if len(page) < page_size:
+                return
+            after_id = page[-1][0]
+
+    async def _create_message_indexes(self, names: list[str], /) -> None:
+        """Build indexes that an existing database doesn't have yet.
+        SQLite has one writer and builds an index in one statement, so flushes can't commit until
+        each build is done. Reads go on, and live messages are buffered meanwhile (see _wait_for_flush_room).
+        "python -m cogs.history migrate" builds them while the bot is stopped instead.
+        """
+        for name in names:
+            logging.warning('Creating the %s index of stored messages, writes wait until it is done', name)
+            start = time.perf_counter()
+            self._building_message_index = True
+            try:
+                await self._db.write(functools.partial(_create_message_index, name))
+            finally:
+                self._building_message_index = False
+            logging.warning('Created the %s index in %.1f seconds, %s writes are pending', name, time.perf_counter() - start, len(self._pending_writes))
+            self._flush_requested.set()
+
     @commands.Cog.listener()
     async def on_message(self, message: discord.Message) -> None:
         if message.guild is not None and not self.bot.history_enabled(message.guild.id):
             return
 
         if message.attachments:
-            await self._download_attachments(message)
+            self._enqueue_attachment_downloads(message)
 
-    async def _download_attachments(self, message: discord.Message, /) -> None:
+    def _enqueue_attachment_downloads(self, message: discord.Message, /) -> None:
         if message.guild is None:
             return
 
-        downloaded_ids = self._get_downloaded_attachment_ids(message.guild.id, message.channel.id, message.id)
-        path = f'media/{message.guild.id}/{message.channel.id}/{message.id}/'
-        os.makedirs(path, exist_ok=True)
-
         for attachment in message.attachments:
-            if attachment.id in downloaded_ids:
+            if attachment.id in self._queued_attachment_ids:
                 continue
 
-            filename = f'a{attachment.id}-{attachment.filename}'
-            filepath = pathlib.Path(path, filename)
-
-            try:
-                await attachment.save(filepath)
-            except (discord.NotFound, discord.HTTPException) as e:
-                logging.warning('Failed to download attachment %s of message %s: %s', attachment.id, message.id, e)
+            self._pending_attachments.append((attachment.id, message.id, message.channel.id, message.guild.id, json.dumps(attachment.to_dict())))
+            self._queue_attachment_download(message.guild.id, message.channel.id, message.id, attachment)
 
-    def _get_downloaded_attachment_ids(self, guild_id: int, channel_id: int, message_id: int, /) -> list[int]:
-        path = f'media/{guild_id}/{channel_id}/{message_id}/'
-        if not os.path.exists(path):
-            return []
-
-        ids: list[int] = []
+    def _queue_attachment_download(self, guild_id: int, channel_id: int, message_id: int, attachment: discord.Attachment, /) -> None:
+        if attachment.id in self._queued_attachment_ids:
+            return
 
-        for filename in os.listdir(path):
-            if filename.startswith('a'):
-                filename = filename[1:]
-                filename = filename.split('-', 1)[0]
-                attachment_id = int(filename)
-                ids.append(attachment_id)
+        self._queued_attachment_ids.add(attachment.id)
+        self._attachment_queue.put_nowait((guild_id, channel_id, message_id, attachment))
 
-        return ids
+    async def _attachment_download_worker(self) -> None:
+        while True:
+            guild_id, channel_id, message_id, attachment = await self._attachment_queue.get()
+            try:
+                await self._download_attachment(guild_id, channel_id, message_id, attachment)
+            except Exception:
+                # It stays in "pending_attachments", so it's attempted again when the bot restarts
+                logging.exception('Unexpected error downloading attachment %s of message %s', attachment.id, message_id)
+            finally:
+                self._queued_attachment_ids.remove(attachment.id)
+
+    async def _download_attachment(self, guild_id: int, channel_id: int, message_id: int, attachment: discord.Attachment, /) -> None:
+        if await self._db.read(functools.partial(_is_attachment_downloaded, attachment.id)):
+            return
 
-    def get_downloaded_attachments(
-        self, guild_id: int, channel_id: int, message_id: int, /,
-        *, attachment_ids: list[int] | None = None,
-        exclude_ids: list[int] | None = None,
+        path = f'media/{guild_id}/{channel_id}/{message_id}/'
+        filename = f'a{attachment.id}-{attachment.filename}'
+        filepath = pathlib.Path(path, filename)
+
+        # Files downloaded before they were recorded in the database only need recording.
+        # Downloads are written to a partial- file first (which _scan_media_directory skips),
+        # so a file with the final name is complete, unless an older version of the bot left it.
+        if not filepath.exists() or filepath.stat().st_size != attachment.size:
+            os.makedirs(path, exist_ok=True)
+            part_path = pathlib.Path(path, f'partial-{filename}')
+
+            start = time.perf_counter()
+            for attempt in range(ATTACHMENT_DOWNLOAD_ATTEMPTS):
+                try:
+                    ATTACHMENT_BYTES.inc(await attachment.save(part_path))
+                    os.replace(part_path, filepath)
+                    ATTACHMENT_SECONDS.observe(time.perf_counter() - start)
+                    break
+                except (discord.NotFound, discord.Forbidden) as e:
+                    part_path.unlink(missing_ok=True)
+                    logging.warning('Failed to download attachment %s of message %s: %s', attachment.id, message_id, e)
+                    ATTACHMENT_FAILURES.inc()
+                    # It's gone for good, so there's no point in trying again after a restart
+                    await self._db.write(functools.partial(_remove_pending_attachment, attachment.id))
+                    return
+                except (discord.HTTPException, aiohttp.ClientError, OSError) as e:
+                    part_path.unlink(missing_ok=True)
+                    if attempt + 1 == ATTACHMENT_DOWNLOAD_ATTEMPTS:
+                        # It stays in "pending_attachments", so it's attempted again when the bot restarts
+                        logging.warning('Failed to download attachment %s of message %s: %s', attachment.id, message_id, e)
+                        ATTACHMENT_FAILURES.inc()
+                        return
+                    await asyncio.sleep(ATTACHMENT_RETRY_DELAY * 2 ** attempt)
+
+        await self._db.write(functools.partial(_add_attachment, guild_id, channel_id, message_id, attachment, filepath.as_posix()))
+
+    async def get_downloaded_attachments(
+        self, message_id: int, /,
+        *, attachment_ids: set[int] | None = None,
+        exclude_ids: set[int] | None = None,
         descriptions: dict[int, str] | None = None,
     ) -> list[discord.File]:
         """Get the downloaded attachments for a message.
         If attachment_ids is specified, only attachments returned are those with IDs in attachment_ids.
         If exclude_ids is specified, attachments with IDs in exclude_ids are not returned.
-        If an ID has a description in descriptions, the corresponding File will also have that description.
+        If an ID has a description in descriptions, the corresponding File will have that description
+        instead of the one recorded when it was downloaded.
         """
 
-        path = f'media/{guild_id}/{channel_id}/{message_id}/'
-        if not os.path.exists(path):
-            return []
+        rows = await self._db.read(functools.partial(_get_attachments, message_id))
 
         files: list[discord.File] = []
-        descriptions = descriptions or {}
+        for attachment_id, filename, path, description in rows:
+            if attachment_ids is not None and attachment_id not in attachment_ids:
+                continue
+            if exclude_ids is not None and attachment_id in exclude_ids:
+                continue
 
-        for filename in os.listdir(path):
-            if filename.startswith('a'):
-                attachment_id = int(filename[1:].split('-', 1)[0])
-                if attachment_ids is not None and attachment_id not in attachment_ids:
-                    continue
-                if exclude_ids is not None and attachment_id in exclude_ids:
-                    continue
+            file = _open_attachment(message_id, attachment_id, filename, path, description, descriptions)
+            if file is not None:
+                files.append(file)
 
-                filepath = pathlib.Path(path, filename)
-                filename = filename.split('-', 1)[1]
-                files.append(discord.File(filepath, filename, description=descriptions.get(attachment_id)))
+        return files
+
+    async def get_downloaded_attachments_of_messages(
+        self, message_ids: Collection[int], /,
+        *, descriptions: dict[int, str] | None = None,
+    ) -> dict[int, list[discord.File]]:
+        """Get all the downloaded attachments of several messages at once, by message ID.
+        Messages without any downloaded attachments are left out.
+        descriptions works like it does for get_downloaded_attachments.
+        """
+
+        rows = await self._db.read(functools.partial(_get_attachments_of_messages, list(message_ids)))
+
+        files: dict[int, list[discord.File]] = {}
+        for message_id, attachment_id, filename, path, description in rows:
+            file = _open_attachment(message_id, attachment_id, filename, path, description, descriptions)
+            if file is not None:
+                files.setdefault(message_id, []).append(file)
 
         return files
 
-    def get_and_update_message(self, payload: discord.RawMessageUpdateEvent) -> dict[str, Any] | None:
+    @commands.group()
+    async def history(self, ctx: commands.Context[commands.Bot]) -> None:
+        pass
+
+    @commands.is_owner()
+    @history.command()
+    async def index_media(self, ctx: commands.Context[commands.Bot]) -> None:
+        """Record attachments in media/ that were downloaded before they were tracked in the database."""
+        await interface.reply(ctx, 'Indexing media...')
+
+        scan = _scan_media_directory('media')
+        count = 0
+        while rows := await asyncio.to_thread(list, itertools.islice(scan, MEDIA_INDEX_BATCH_SIZE)):
+            count += await self._db.write(functools.partial(_add_scanned_attachments, rows))
+
+        await interface.reply(ctx, f'Indexed {count} previously unrecorded attachments.')
+
+    @commands.is_owner()
+    @history.command()
+    async def compact(self, ctx: commands.Context[commands.Bot]) -> None:
+        """Re-encode stored messages with the configured compression, in the background."""
+        if self._compaction_task is not None and not self._compaction_task.done():
+            await interface.reply(ctx, 'Stored messages are already being compacted.')
+            return
+
+        self._compaction_task = self.bot.loop.create_task(self._compact_messages(ctx))
+        await interface.reply(ctx, f'Compacting stored messages with {self._codec.kind} compression...')
+
+    @commands.is_owner()
+    @history.command()
+    async def cache(self, ctx: commands.Context[commands.Bot]) -> None:
+        """Show how well the message cache is doing, to help choose its size."""
+        cache = self._message_cache
+        lookups = cache.hits + cache.misses
+        hit_rate = cache.hits / lookups if lookups else 0.0
+        await interface.reply(
+            ctx,
+            f'{len(cache)}/{cache.max_size} messages cached. '
+            f'{cache.hits} hits and {cache.misses} misses ({hit_rate:.1%} hit rate).',
+        )
+
+    @commands.guild_only()
+    @commands.has_permissions(manage_messages=True)
+    @history.command()
+    async def search(self, ctx: commands.Context[commands.Bot], *, query: str) -> None:
+        """Search the stored messages of this server, newest first.
+
+        Besides the words to look for (a word ending in * matches anything starting with it),
+        the query can have from:<user>, in:<channel>, after:<date>, before:<date>,
+        and page:<message ID> to continue a previous search.
+        """
+        assert(ctx.guild is not None)
+        assert(isinstance(ctx.author, discord.Member))
+
+        try:
+            search = _parse_search_query(query)
+        except ValueError as e:
+            await interface.reply(ctx, f'Invalid search: {e}')
+            return
+        if not search['terms']:
+            await interface.reply(ctx, 'Give at least one word to search for.')
+            return
+
+        # Only the channels the searcher can read, which also keeps the search within this server
+        channel_ids = [
+            channel.id
+            for channel in (*ctx.guild.channels, *ctx.guild.threads)
+            if isinstance(channel, discord.abc.Messageable)
+            and (search['channel_id'] is None or channel.id == search['channel_id'])
+            and channel.permissions_for(ctx.author).read_message_history
+        ]
+        if not channel_ids:
+            await interface.reply(ctx, "You can't read any channel this search covers.")
+            return
+
+        results = await self._db.read(functools.partial(_search_messages, search, channel_ids, SEARCH_PAGE_SIZE + 1))
+
+        lines: list[str] = []
+        if self._search_index_task is not None and not self._search_index_task.done():
+            lines.append('-# Older messages are still being indexed, so some of them may be missing.')
+        if not results:
+            lines.append('No stored messages match.')
+        for message_id, channel_id, author_id, snippet in results[:SEARCH_PAGE_SIZE]:
+            unix_time = int(discord.utils.snowflake_time(message_id).timestamp())
+            url = f'https://discord.com/channels/{ctx.guild.id}/{channel_id}/{message_id}'
+            lines.append(f'<t:{unix_time}:f> <#{channel_id}> <@{author_id}> [jump]({url})\n> {snippet.replace("\n", " ")}')
+        if len(results) > SEARCH_PAGE_SIZE:
+            next_query = ' '.join(token for token in query.split() if not token.startswith('page:'))
+            lines.append(f'More: `{ctx.clean_prefix}history search {next_query} page:{results[SEARCH_PAGE_SIZE - 1][0]}`')
+
+        await interface.reply(ctx, '\n'.join(lines))
+
+    @commands.is_owner()
+    @commands.guild_only()
+    @history.command()
+    async def export(self, ctx: commands.Context[commands.Bot], *, flags: ExportFlags) -> None:
+        """Export every version of the stored messages of this server, a channel or an author to compressed JSON lines."""
+        assert(ctx.guild is not None)
+        if flags.compression not in ('gzip', 'zstd'):
+            await interface.reply(ctx, 'The compression can be gzip or zstd.')
+            return
+        if flags.compression == 'zstd' and not HAS_ZSTD:
+            await interface.reply(ctx, 'zstd compression needs the zstandard package.')
+            return
+
+        if flags.channel is not None and flags.channel.guild != ctx.guild:
+            await interface.reply(ctx, 'That channel is not in this server.')
+            return
+
+        if flags.channel is not None:
+            channel_ids = [flags.channel.id]
+        else:
+            # An author's messages are only exported from this server too.
+            # Threads that were archived before the bot started aren't known, so they're left out
+            channel_ids = [channel.id for channel in (*ctx.guild.channels, *ctx.guild.threads)]
+        author_id = flags.author.id if flags.author is not None else None
+
+        name = f'{ctx.guild.id}'
+        if flags.channel is not None:
+            name += f'-channel-{flags.channel.id}'
+        if flags.author is not None:
+            name += f'-author-{flags.author.id}'
+        name += f'-after-{flags.after}' if flags.after else f'-{int(time.time())}'
+        os.makedirs(EXPORTS_DIRECTORY, exist_ok=True)
+        path = os.path.join(EXPORTS_DIRECTORY, name)
+        compression: StreamKind = 'zstd' if flags.compression == 'zstd' else 'gzip'
+
+        await interface.reply(ctx, f'Exporting to {path}...')
+        # The export has its own connection and thread, so that it doesn't hold up anything else
+        count, last_message_id = await asyncio.to_thread(
+            _export_to_files, DATABASE_PATH, path, compression, flags.media, channel_ids, author_id, flags.after,
+        )
+        await interface.reply(ctx, f'Exported {count} messages, up to message {last_message_id}.')
+
+    async def _build_search_index(self) -> None:
+        # One batch per transaction, so that new messages don't wait long to be written
+        while await self._db.write(functools.partial(_index_stored_messages, self._codec)):
+            pass
+        logging.warning('Finished indexing stored messages for search')
+
+    async def _compact_messages(self, ctx: commands.Context[commands.Bot]) -> None:
+        codec = self._codec
+        last_rowid: int | None = 0
+        size_before = 0
+        size_after = 0
+        while last_rowid is not None:
+            last_rowid, before, after = await self._db.write(functools.partial(_recompress_messages, codec, last_rowid))
+            size_before += before
+            size_after += after
+
+        await interface.reply(ctx, f'Done compacting, re-encoded messages went from {size_before} to {size_after} bytes.')
+
+    async def get_and_update_message(self, payload: discord.RawMessageUpdateEvent) -> dict[str, Any] | None:
         """Get the latest version of a message by its ID, if it exists.
         Also, add a new version of the message with the updated data.
         Returns the latest version of the message before the update.
+        Edits of the same message are handled in order, so each one returns the version the one before it added,
+        even if reading the message it edited took longer.
         """
 
-        cursor = self._connection.execute("""
-                SELECT MAX("version"), "json"
-                FROM "messages"
-                WHERE "message_id" = ?
-            """,
-            (payload.message_id,),
-        )
+        previous = self._message_edits.get(payload.message_id)
+        done: asyncio.Future[None] = self.bot.loop.create_future()
+        self._message_edits[payload.message_id] = done
+        try:
+            if previous is not None:
+                await previous
 
-        row: tuple[Optional[int], Optional[str]] | None = cursor.fetchone()
-        version, old_json = row or (None, None)
+            old_data = await self.get_message(payload.message_id)
 
-        version = version or 0
-        version += 1
+            data: dict[str, Any] = payload.data # type: ignore # docs say it's a dict
+            if old_data is not None:
+                new_data = {**old_data, **data}
+            else:
+                new_data = data
+            self._queue_write('edit', new_data)
 
-        data: dict[str, Any] = payload.data # type: ignore # docs say it's a dict
-        if old_json is not None:
-            new_data: dict[str, Any] = json.loads(old_json)
-            new_data.update(data)
-        else:
-            new_data = data
-        self._add_new_message(new_data, version)
+            return old_data
+        finally:
+            done.set_result(None)
+            if self._message_edits.get(payload.message_id) is done:
+                del self._message_edits[payload.message_id]
 
-        if version is None or old_json is None:
+    @commands.Cog.listener()
+    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
+        if payload.message.guild is not None and not self.bot.history_enabled(payload.message.guild.id):
+            return
+
+        self._enqueue_attachment_downloads(payload.message)
+
+    async def get_user_profile(self, user_id: int, /) -> UserProfile | None:
+        """Get what a user looks like, for users that aren't in discord.py's cache.
+        The stored profile is used if it's recent enough. Otherwise the user is fetched from Discord
+        (once, however many lookups are waiting on it), falling back to the stored profile if that fails.
+        """
+
+        profile = await self._db.read(functools.partial(_get_user_profile, user_id))
+        if profile is not None and time.time() - profile['updated_at'] < USER_PROFILE_TTL:
+            return profile
+
+        task = self._user_fetches.get(user_id)
+        if task is None:
+            task = self.bot.loop.create_task(self._fetch_user_profile(user_id))
+            self._user_fetches[user_id] = task
+            task.add_done_callback(lambda _: self._user_fetches.pop(user_id, None))
+
+        # One lookup being cancelled shouldn't cancel the fetch for the others
+        fetched = await asyncio.shield(task)
+        if fetched is None:
+            return profile
+        if profile is not None and fetched['colour'] is None:
+            return {**fetched, 'colour': profile['colour']}
+        return fetched
+
+    async def _fetch_user_profile(self, user_id: int, /) -> UserProfile | None:
+        try:
+            user = await self.bot.fetch_user(user_id)
+        except (discord.NotFound, discord.HTTPException):
             return None
 
-        old_data: dict[str, Any] = json.loads(old_json)
-        return old_data
+        profile = _user_profile(user)
+        await self._db.write(functools.partial(_update_user_profiles, [profile]))
+        return profile
 
     @commands.Cog.listener()
-    async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent):
-        if payload.message.guild is not None and not self.bot.history_enabled(payload.message.guild.id):
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        if not self.bot.history_enabled(payload.guild_id):
             return
 
-        await self._download_attachments(payload.message)
+        # Their role colour can't be looked up anymore once they're gone
+        await self._db.write(functools.partial(_update_user_profiles, [_user_profile(payload.user)]))
+
+class ChannelFetchQueue:
+    """A queue of channels to fetch the history of.
+
+    Channels are handed out one guild at a time in turn, so a guild with many
+    channels doesn't make every other guild wait until it's done.
+    """
+
+    def __init__(self):
+        self._channels: dict[int, collections.deque[int]] = {}
+        self._guild_ids: collections.deque[int] = collections.deque()
+        self._not_empty = asyncio.Event()
+
+    def qsize(self) -> int:
+        return sum(len(channel_ids) for channel_ids in self._channels.values())
+
+    def put(self, guild_id: int, channel_id: int, /) -> None:
+        if guild_id not in self._channels:
+            self._channels[guild_id] = collections.deque()
+            self._guild_ids.append(guild_id)
+        self._channels[guild_id].append(channel_id)
+        self._not_empty.set()
+
+    def guild_ids(self) -> list[int]:
+        """The guilds with channels in the queue."""
+        return list(self._channels)
+
+    def remove_guild(self, guild_id: int, /) -> list[int]:
+        """Take every channel of a guild out of the queue, and return their IDs."""
+        channel_ids = self._channels.pop(guild_id, None)
+        if channel_ids is None:
+            return []
+        self._guild_ids.remove(guild_id)
+        return list(channel_ids)
+
+    async def get(self) -> int:
+        while not self._guild_ids:
+            self._not_empty.clear()
+            await self._not_empty.wait()
+
+        guild_id = self._guild_ids.popleft()
+        channel_ids = self._channels[guild_id]
+        channel_id = channel_ids.popleft()
+        if channel_ids:
+            self._guild_ids.append(guild_id)
+        else:
+            del self._channels[guild_id]
+
+        return channel_id
+
+class RateLimiter:
+    """Spaces out requests evenly so that no more than rate of them start per second."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self._next_start = 0.0
+
+    async def acquire(self) -> None:
+        now = asyncio.get_running_loop().time()
+        start = max(now, self._next_start)
+        self._next_start = start + 1 / self.rate
+        if start > now:
+            await asyncio.sleep(start - now)
+
+class MessageCache:
+    """The latest data of up to max_size messages, dropping the least recently used ones first."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._messages: collections.OrderedDict[int, dict[str, Any]] = collections.OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._messages)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._messages
+
+    def get(self, message_id: int, /) -> dict[str, Any] | None:
+        data = self._messages.get(message_id)
+        if data is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._messages.move_to_end(message_id)
+        return data
+
+    def put(self, message_id: int, data: dict[str, Any], /) -> None:
+        if self.max_size <= 0:
+            return
+
+        self._messages[message_id] = data
+        self._messages.move_to_end(message_id)
+        if len(self._messages) > self.max_size:
+            self._messages.popitem(last=False)
+
+    def discard(self, message_id: int, /) -> None:
+        self._messages.pop(message_id, None)
+
+def _may_be_message_create(msg: str, /) -> bool:
+    """Cheaply rule out gateway frames that aren't MESSAGE_CREATE, without parsing them.
+    Discord sends compact JSON with "t" first, so most frames are decided by their first few characters.
+    Frames laid out any other way fall back to looking for the event name anywhere in them.
+    """
+    if msg.startswith('{"t":"MESSAGE_CREATE"'):
+        return True
+    if msg.startswith('{"t":"') or msg.startswith('{"t":null'):
+        return False
+    return 'MESSAGE_CREATE' in msg
+
+def _open_attachment(
+    message_id: int, attachment_id: int, filename: str, path: str,
+    description: str | None, descriptions: dict[int, str] | None, /,
+) -> discord.File | None:
+    if descriptions is not None:
+        description = descriptions.get(attachment_id, description)
+    try:
+        return discord.File(path, filename, description=description)
+    except FileNotFoundError:
+        logging.warning('Downloaded attachment %s of message %s is missing from %s', attachment_id, message_id, path)
+        return None
+
+def _configure_connection(connection: sqlite3.Connection, /, profile: database.Profile | None = None) -> None:
+    if profile is not None:
+        database.apply_profile(connection, profile)
+    connection.execute('PRAGMA foreign_keys = true;')
+
+def _maintain_database(connection: sqlite3.Connection, /) -> None:
+    # A checkpoint can't run while this connection has a transaction open
+    connection.autocommit = True
+    try:
+        # Write the whole WAL back into the database and empty it, so it doesn't keep growing
+        # while there are always readers. Does nothing outside of WAL mode.
+        connection.execute('PRAGMA wal_checkpoint(TRUNCATE);')
+        connection.execute('PRAGMA optimize;')
+    finally:
+        connection.autocommit = False
+
+# The layout of the database, stored in its user_version.
+# 0: every version of a message stored in full, with its content, attachments and embeds also stored separately.
+# 1: the first version of a message stored in full, later ones as the changes from the version before.
+# 2: the "content" column ignores compressed rows.
+# 3: the "fingerprint" column.
+# 4: the "users" table.
+# 5: the "messages_search" index.
+SCHEMA_VERSION = 5
+
+# The first (normally 0) version of a message has the full payload in "json". Every later version
+# only has the top-level keys that changed since the version before it in "json",
+# and the keys that were removed in "removed_keys" (a JSON list, or NULL if there are none).
+# "json" is either text or, if it's compressed, a blob (see the compression module).
+# "content" is the content of the message as of that version if it was changed by that version
+# (and if the row isn't compressed).
+# "fingerprint" identifies the tracked fields of the message as of that version (see _fingerprint),
+# so that an unchanged message can be recognised without decoding anything.
+# It's NULL for versions stored before schema version 3.
+MESSAGES_TABLE = """
+        CREATE TABLE IF NOT EXISTS "messages" (
+            "message_id" INTEGER NOT NULL,
+            "version" INTEGER NOT NULL DEFAULT 0,
+            "channel_id" INTEGER NOT NULL,
+            "author_id" INTEGER NOT NULL,
+            "json" TEXT NOT NULL,
+            "removed_keys" TEXT,
+            "content" TEXT GENERATED ALWAYS AS (
+                CASE WHEN typeof("json") = 'text' THEN json_extract("json", '$.content') END
+            ) VIRTUAL,
+            "fingerprint" BLOB,
+            PRIMARY KEY ("message_id", "version")
+        );
+    """
+
+# The search index has one row per message, with the message ID as its rowid, so that results
+# come out newest first and time ranges are rowid ranges. "content" has the content of every
+# version of the message, one after the other. Messages stored before the index existed are
+# added by _index_stored_messages, from the message after the one in "search_index_progress".
+SEARCH_TABLE = """
+        CREATE VIRTUAL TABLE IF NOT EXISTS "messages_search" USING fts5(
+            "content",
+            "channel_id" UNINDEXED,
+            "author_id" UNINDEXED,
+            tokenize = 'unicode61 remove_diacritics 2'
+        );
+    """
+
+# Indexes for finding the messages of a channel or an author, see History.iter_messages.
+# They aren't part of the layout, since existing databases get them in the background
+# rather than while the bot starts (see _missing_message_indexes).
+MESSAGE_INDEXES = {
+    'messages_channel_id': """
+            CREATE INDEX IF NOT EXISTS "messages_channel_id"
+            ON "messages" ("channel_id", "message_id");
+        """,
+    'messages_author_id': """
+            CREATE INDEX IF NOT EXISTS "messages_author_id"
+            ON "messages" ("author_id", "message_id");
+        """,
+}
+
+def _create_tables(connection: sqlite3.Connection, /) -> None:
+    schema_version: int = connection.execute('PRAGMA user_version;').fetchone()[0]
+    is_new = not _table_exists('messages', connection)
+    if schema_version < 1 and _table_exists('messages', connection):
+        _migrate_to_message_changes(connection)
+    elif schema_version < 2 and _table_exists('messages', connection):
+        _migrate_content_column(connection)
+    elif schema_version < 3 and _table_exists('messages', connection):
+        # Fingerprints of existing versions are filled in as they're needed, see _resolve_writes
+        connection.execute('ALTER TABLE "messages" ADD COLUMN "fingerprint" BLOB;')
+
+    connection.execute(MESSAGES_TABLE)
+    if is_new:
+        # Nothing to index yet, so they're quick to create
+        for index in MESSAGE_INDEXES.values():
+            connection.execute(index)
+    connection.execute("""
+            CREATE TABLE IF NOT EXISTS "channels" (
+                "channel_id" INTEGER PRIMARY KEY NOT NULL,
+                "last_message_id" INTEGER
+            );
+        """)
+    connection.execute("""
+            CREATE TABLE IF NOT EXISTS "attachments" (
+                "attachment_id" INTEGER PRIMARY KEY NOT NULL,
+                "message_id" INTEGER NOT NULL,
+                "channel_id" INTEGER NOT NULL,
+                "guild_id" INTEGER NOT NULL,
+                "filename" TEXT NOT NULL,
+                "path" TEXT NOT NULL,
+                "size" INTEGER NOT NULL,
+                "content_type" TEXT,
+                "description" TEXT
+            );
+        """)
+    connection.execute("""
+            CREATE INDEX IF NOT EXISTS "attachments_message_id"
+            ON "attachments" ("message_id");
+        """)
+    connection.execute("""
+            CREATE TABLE IF NOT EXISTS "pending_attachments" (
+                "attachment_id" INTEGER PRIMARY KEY NOT NULL,
+                "message_id" INTEGER NOT NULL,
+                "channel_id" INTEGER NOT NULL,
+                "guild_id" INTEGER NOT NULL,
+                "data" TEXT NOT NULL
+            );
+        """)
+    connection.execute("""
+            CREATE TABLE IF NOT EXISTS "compression_dictionaries" (
+                "dictionary_id" INTEGER PRIMARY KEY NOT NULL,
+                "kind" TEXT NOT NULL,
+                "data" BLOB NOT NULL
+            );
+        """)
+    connection.execute("""
+            CREATE TABLE IF NOT EXISTS "users" (
+                "user_id" INTEGER PRIMARY KEY NOT NULL,
+                "display_name" TEXT NOT NULL,
+                "avatar_url" TEXT NOT NULL,
+                "colour" INTEGER,
+                "updated_at" REAL NOT NULL
+            );
+        """)
+    if schema_version < 4 and _table_exists('messages', connection):
+        _add_users_from_messages(connection)
+
+    connection.execute(SEARCH_TABLE)
+    connection.execute("""
+            CREATE TABLE IF NOT EXISTS "search_index_progress" (
+                "message_id" INTEGER NOT NULL,
+                "version" INTEGER NOT NULL
+            );
+        """)
+    if schema_version < 5 and not is_new:
+        # Indexed in the background, see History._build_search_index
+        connection.execute('INSERT INTO "search_index_progress" VALUES (0, -1);')
+
+    connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION};')
+
+def _missing_message_indexes(connection: sqlite3.Connection, /) -> list[str]:
+    cursor = connection.execute("""
+            SELECT "name"
+            FROM "sqlite_schema"
+            WHERE "type" = 'index' AND "tbl_name" = 'messages'
+        """)
+    existing = {name for name, in cursor}
+    return [name for name in MESSAGE_INDEXES if name not in existing]
+
+def _create_message_index(name: str, connection: sqlite3.Connection, /) -> None:
+    connection.execute(MESSAGE_INDEXES[name])
+
+def _table_exists(name: str, connection: sqlite3.Connection, /) -> bool:
+    cursor = connection.execute("""
+            SELECT 1
+            FROM "sqlite_schema"
+            WHERE "type" = 'table' AND "name" = ?
+        """,
+        (name,),
+    )
+    return cursor.fetchone() is not None
+
+def _migrate_to_message_changes(connection: sqlite3.Connection, /) -> None:
+    """Convert the messages table from schema version 0, where every version was stored in full."""
+    logging.warning('Converting stored messages to the new layout, this can take a while for large databases')
+
+    connection.execute('ALTER TABLE "messages" RENAME TO "messages_v0";')
+    connection.execute(MESSAGES_TABLE)
+
+    cursor = connection.execute("""
+            SELECT "message_id", "json"
+            FROM "messages_v0"
+            ORDER BY "message_id", "version"
+        """)
+
+    previous_message_id: int | None = None
+    previous: tuple[int, dict[str, Any]] | None = None
+    rows: list[tuple[Any, ...]] = []
+    for message_id, raw_json in cursor:
+        if message_id != previous_message_id:
+            previous = None
+        data: dict[str, Any] = _json_loads(raw_json)
+        version = 0 if previous is None else previous[0] + 1
+        rows.append(_message_row(data, version, previous[1] if previous else None, _fingerprint(data), Codec('none')))
+        previous_message_id = message_id
+        previous = (version, data)
+
+        if len(rows) >= MIGRATION_BATCH_SIZE:
+            _insert_message_rows(rows, connection)
+            rows.clear()
+    _insert_message_rows(rows, connection)
+
+    connection.execute('DROP TABLE "messages_v0";')
+
+def _migrate_content_column(connection: sqlite3.Connection, /) -> None:
+    """Rebuild the messages table from schema version 1, since generated columns can't be altered."""
+    connection.execute('ALTER TABLE "messages" RENAME TO "messages_v1";')
+    connection.execute(MESSAGES_TABLE)
+    connection.execute("""
+            INSERT INTO "messages"
+            (message_id, version, channel_id, author_id, json, removed_keys)
+            SELECT message_id, version, channel_id, author_id, json, removed_keys
+            FROM "messages_v1"
+        """)
+    connection.execute('DROP TABLE "messages_v1";')
+
+def _add_users_from_messages(connection: sqlite3.Connection, /) -> None:
+    """Fill the users table from the latest stored message of each author, for databases from before it existed."""
+    cursor = connection.execute("""
+            SELECT "dictionary_id", "kind", "data"
+            FROM "compression_dictionaries"
+        """)
+    reader = Codec('none', {dictionary_id: (kind, data) for dictionary_id, kind, data in cursor})
+
+    cursor = connection.execute("""
+            SELECT "json"
+            FROM "messages"
+            WHERE "version" = 0 AND "message_id" IN (
+                SELECT MAX("message_id")
+                FROM "messages"
+                WHERE "version" = 0
+                GROUP BY "author_id"
+            )
+        """)
+    while rows := cursor.fetchmany(MIGRATION_BATCH_SIZE):
+        _update_user_profiles([_message_author_profile(_json_loads(reader.decode(value))) for value, in rows], connection)
+
+def _load_codec(configured_kind: str, connection: sqlite3.Connection, /) -> Codec:
+    """Make the codec for the configured compression, training its dictionary first if there isn't one yet."""
+    cursor = connection.execute("""
+            SELECT "dictionary_id", "kind", "data"
+            FROM "compression_dictionaries"
+        """)
+    dictionaries: dict[int, tuple[CompressionKind, bytes]] = {
+        dictionary_id: (COMPRESSION_KINDS[dictionary_kind], data) for dictionary_id, dictionary_kind, data in cursor
+    }
+
+    kind = COMPRESSION_KINDS.get(configured_kind)
+    if kind is None:
+        logging.warning('Unknown history compression %r, not compressing', configured_kind)
+        kind = 'none'
+    if kind == 'zstd' and not HAS_ZSTD:
+        logging.warning('zstd compression needs the zstandard package, using zlib instead')
+        kind = 'zlib'
+    if kind == 'none':
+        return Codec('none', dictionaries)
+
+    matching_ids = [dictionary_id for dictionary_id, (dictionary_kind, _) in dictionaries.items() if dictionary_kind == kind]
+    if matching_ids:
+        return Codec(kind, dictionaries, max(matching_ids))
+
+    cursor = connection.execute("""
+            SELECT "json"
+            FROM "messages"
+            WHERE "version" = 0
+            ORDER BY "rowid" DESC
+            LIMIT ?
+        """,
+        (DICTIONARY_SAMPLES,),
+    )
+    reader = Codec('none', dictionaries)
+    samples = [reader.decode(value) for value, in cursor]
+    if len(samples) < MIN_DICTIONARY_SAMPLES:
+        # Not enough to train on yet, a dictionary will be trained after a restart
+        return Codec(kind, dictionaries)
+
+    data = train_dictionary(kind, samples)
+    cursor = connection.execute("""
+            INSERT INTO "compression_dictionaries" ("kind", "data")
+            VALUES (?, ?)
+        """,
+        (kind, data),
+    )
+    assert(cursor.lastrowid is not None)
+    dictionaries[cursor.lastrowid] = (kind, data)
+    return Codec(kind, dictionaries, cursor.lastrowid)
+
+def _recompress_messages(codec: Codec, after_rowid: int, connection: sqlite3.Connection, /) -> tuple[int | None, int, int]:
+    """Re-encode a batch of rows that aren't encoded with codec's current settings.
+    Returns the last rowid of the batch (None if there were no rows left),
+    and the total size of the re-encoded values before and after.
+    """
+    cursor = connection.execute("""
+            SELECT "rowid", "json"
+            FROM "messages"
+            WHERE "rowid" > ?
+            ORDER BY "rowid"
+            LIMIT ?
+        """,
+        (after_rowid, COMPACTION_BATCH_SIZE),
+    )
+    rows: list[tuple[int, str | bytes]] = cursor.fetchall()
+    if not rows:
+        return None, 0, 0
+
+    updates: list[tuple[str | bytes, int]] = []
+    size_before = 0
+    size_after = 0
+    for rowid, value in rows:
+        if codec.is_current(value):
+            continue
+        encoded = codec.encode(codec.decode(value))
+        updates.append((encoded, rowid))
+        size_before += _stored_size(value)
+        size_after += _stored_size(encoded)
+
+    connection.executemany("""
+            UPDATE "messages"
+            SET "json" = ?
+            WHERE "rowid" = ?
+        """,
+        updates,
+    )
+    return rows[-1][0], size_before, size_after
+
+def _stored_size(value: str | bytes, /) -> int:
+    return len(value.encode() if isinstance(value, str) else value)
+
+# The functions below run on the database threads, with the connection they're given.
+
+def _get_or_create_checkpoint(channel_id: int, connection: sqlite3.Connection, /) -> int:
+    """Get the ID of the last fetched message of a channel, or 0 if none were fetched yet."""
+    cursor = connection.execute("""
+            SELECT "channel_id", "last_message_id"
+            FROM "channels"
+            WHERE "channel_id" = ?
+        """,
+        (channel_id,),
+    )
+    row: tuple[Optional[int], Optional[int]] | None = cursor.fetchone()
+    db_channel_id, last_message_id = row or (None, None)
+
+    if db_channel_id is None:
+        connection.execute("""
+                INSERT INTO "channels" ("channel_id", "last_message_id")
+                VALUES (?, ?)
+            """,
+            (channel_id, last_message_id),
+        )
+
+    return last_message_id or 0
+
+def _write_messages(
+    writes: list[tuple[WriteMode, dict[str, Any]]],
+    checkpoints: dict[int, int],
+    attachments: list[tuple[int, int, int, int, str]],
+    codec: Codec,
+    connection: sqlite3.Connection, /,
+) -> None:
+    rows, texts = _resolve_writes(writes, codec, connection)
+    _insert_message_rows(rows, connection)
+    _index_message_texts(texts, connection)
+
+    # The author of each message, as of the most recent of their messages
+    authors: dict[int, UserProfile] = {}
+    for _, data in writes:
+        profile = _message_author_profile(data)
+        if profile['user_id'] not in authors or authors[profile['user_id']]['updated_at'] < profile['updated_at']:
+            authors[profile['user_id']] = profile
+    _update_user_profiles(list(authors.values()), connection)
+
+    connection.executemany("""
+            UPDATE "channels"
+            SET "last_message_id" = ?
+            WHERE "channel_id" = ?
+        """,
+        [(last_message_id, channel_id) for channel_id, last_message_id in checkpoints.items()],
+    )
+
+    # Attachments that were downloaded before this flush don't need to be pending
+    connection.executemany("""
+            INSERT OR IGNORE INTO "pending_attachments"
+            ("attachment_id", "message_id", "channel_id", "guild_id", "data")
+            SELECT ?, ?, ?, ?, ?
+            WHERE NOT EXISTS (
+                SELECT 1
+                FROM "attachments"
+                WHERE "attachment_id" = ?
+            )
+        """,
+        [(*row, row[0]) for row in attachments],
+    )
+
+def _write_messages_skipping_failures(
+    writes: list[tuple[WriteMode, dict[str, Any]]],
+    checkpoints: dict[int, int],
+    attachments: list[tuple[int, int, int, int, str]],
+    codec: Codec,
+    connection: sqlite3.Connection, /,
+) -> list[tuple[WriteMode, dict[str, Any]]]:
+    """Like _write_messages, but leave out the writes that fail, and return them.
+    Each part of the writes is tried in a savepoint, and parts that fail are split in half
+    until the writes that fail on their own are found. An OperationalError isn't caused
+    by the writes, so it's raised rather than splitting them.
+    """
+    skipped: list[tuple[WriteMode, dict[str, Any]]] = []
+    parts = [writes]
+    while parts:
+        part = parts.pop()
+        if not part:
+            continue
+        connection.execute('SAVEPOINT "write_part"')
+        try:
+            _write_messages(part, {}, [], codec, connection)
+        except sqlite3.OperationalError:
+            raise
+        except Exception:
+            connection.execute('ROLLBACK TO "write_part"')
+            connection.execute('RELEASE "write_part"')
+            if len(part) == 1:
+                logging.exception('Could not store message %s, leaving it out', part[0][1].get('id'))
+                skipped.append(part[0])
+            else:
+                # Popped from the end, so the first half is written first
+                parts.append(part[len(part) // 2:])
+                parts.append(part[:len(part) // 2])
+        else:
+            connection.execute('RELEASE "write_part"')
+
+    _write_messages([], checkpoints, attachments, codec, connection)
+    return skipped
+
+def _insert_message_rows(rows: list[tuple[Any, ...]], connection: sqlite3.Connection, /) -> None:
+    connection.executemany("""
+            INSERT INTO "messages"
+            (message_id, version, channel_id, author_id, json, removed_keys, fingerprint)
+            VALUES
+            (?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+
+def _resolve_writes(
+    writes: list[tuple[WriteMode, dict[str, Any]]],
+    codec: Codec,
+    connection: sqlite3.Connection, /,
+) -> tuple[list[tuple[Any, ...]], list[tuple[int, int, int, str]]]:
+    """Turn pending writes into rows to insert, deciding the version of each one.
+    Writes are resolved in order, so later writes of a message see the earlier ones.
+    Also returns the message ID, channel ID, author ID and content of the new versions
+    that changed the content, to be added to the search index.
+
+    Whether a message is stored, and whether it changed, is decided from the fingerprint of its
+    latest version, which is looked up for all the messages at once. Stored versions are only
+    decoded when a new version has to be stored as the changes from them.
+    """
+    # The latest version of each message, its fingerprint, and its data if it has been decoded
+    latest: dict[int, tuple[int, bytes | None, dict[str, Any] | None]] = {}
+    message_ids = list({int(data['id']): None for _, data in writes})
+    for batch in itertools.batched(message_ids, LATEST_VERSIONS_QUERY_SIZE):
+        for message_id, version, fingerprint in _get_latest_fingerprints(batch, connection):
+            latest[message_id] = (version, fingerprint, None)
+
+    rows: list[tuple[Any, ...]] = []
+    texts: list[tuple[int, int, int, str]] = []
+    found_fingerprints: list[tuple[bytes, int, int]] = []
+
+    for mode, data in writes:
+        message_id = int(data['id'])
+        fingerprint = _fingerprint(data)
+        stored = latest.get(message_id)
+
+        if stored is None:
+            rows.append(_message_row(data, 0, None, fingerprint, codec))
+            texts.append((message_id, int(data['channel_id']), int(data['author']['id']), data['content']))
+            latest[message_id] = (0, fingerprint, data)
+            continue
+        if mode == 'create':
+            # Already stored, most likely fetched before the gateway event arrived.
+            continue
+
+        version, stored_fingerprint, previous = stored
+        if stored_fingerprint is None:
+            # Stored before fingerprints were, so work it out once
+            previous = _get_message_data(message_id, codec, connection)
+            assert(previous is not None)
+            stored_fingerprint = _fingerprint(previous)
+            found_fingerprints.append((stored_fingerprint, message_id, version))
+            latest[message_id] = (version, stored_fingerprint, previous)
+
+        if mode == 'update' and stored_fingerprint == fingerprint:
+            continue
+
+        if previous is None:
+            previous = _get_message_data(message_id, codec, connection)
+            assert(previous is not None)
+        rows.append(_message_row(data, version + 1, previous, fingerprint, codec))
+        if previous.get('content') != data['content']:
+            texts.append((message_id, int(data['channel_id']), int(data['author']['id']), data['content']))
+        latest[message_id] = (version + 1, fingerprint, data)
+
+    connection.executemany("""
+            UPDATE "messages"
+            SET "fingerprint" = ?
+            WHERE "message_id" = ? AND "version" = ?
+        """,
+        found_fingerprints,
+    )
+    return rows, texts
+
+def _index_message_texts(texts: list[tuple[int, int, int, str]], connection: sqlite3.Connection, /) -> None:
+    """Add content to the search index entries of messages, given their message ID, channel ID, author ID and content.
+    Content that's already in a message's entry isn't added again, so indexing the same version twice does nothing.
+    """
+    new_texts: dict[int, tuple[int, int, list[str]]] = {}
+    for message_id, channel_id, author_id, content in texts:
+        if content:
+            new_texts.setdefault(message_id, (channel_id, author_id, []))[2].append(content)
+    if not new_texts:
+        return
+
+    indexed: dict[int, str] = {}
+    for batch in itertools.batched(new_texts, LATEST_VERSIONS_QUERY_SIZE):
+        placeholders = ', '.join('?' * len(batch))
+        cursor = connection.execute(f"""
+                SELECT "rowid", "content"
+                FROM "messages_search"
+                WHERE "rowid" IN ({placeholders})
+            """,
+            batch,
+        )
+        indexed.update(cursor)
+
+    rows: list[tuple[int, str, int, int]] = []
+    for message_id, (channel_id, author_id, contents) in new_texts.items():
+        text = indexed.get(message_id)
+        for content in contents:
+            if text is None:
+                text = content
+            elif content not in text:
+                text += '\n' + content
+        if text is not None and text != indexed.get(message_id):
+            rows.append((message_id, text, channel_id, author_id))
+
+    # FTS5 tables can't be upserted into
+    connection.executemany("""
+            DELETE FROM "messages_search"
+            WHERE "rowid" = ?
+        """,
+        [(message_id,) for message_id, *_ in rows if message_id in indexed],
+    )
+    connection.executemany("""
+            INSERT INTO "messages_search"
+            ("rowid", "content", "channel_id", "author_id")
+            VALUES
+            (?, ?, ?, ?)
+        """,
+        rows,
+    )
+
+def _is_search_index_incomplete(connection: sqlite3.Connection, /) -> bool:
+    cursor = connection.execute('SELECT 1 FROM "search_index_progress";')
+    return cursor.fetchone() is not None
+
+def _index_stored_messages(codec: Codec, connection: sqlite3.Connection, /) -> bool:
+    """Add the next batch of messages stored before the search index existed to it.
+    Returns whether there are more left.
+    """
+    progress = connection.execute('SELECT "message_id", "version" FROM "search_index_progress";').fetchone()
+    if progress is None:
+        return False
+
+    cursor = connection.execute("""
+            SELECT "message_id", "version", "channel_id", "author_id", "json"
+            FROM "messages"
+            WHERE ("message_id", "version") > (?, ?)
+            ORDER BY "message_id", "version"
+            LIMIT ?
+        """,
+        (*progress, SEARCH_INDEX_BATCH_SIZE),
+    )
+    rows: list[tuple[int, int, int, int, str | bytes]] = cursor.fetchall()
+
+    texts: list[tuple[int, int, int, str]] = []
+    for message_id, _, channel_id, author_id, value in rows:
+        # Later versions only have the content if they changed it
+        changes: dict[str, Any] = _json_loads(codec.decode(value))
+        content = changes.get('content')
+        if isinstance(content, str):
+            texts.append((message_id, channel_id, author_id, content))
+    _index_message_texts(texts, connection)
+
+    if len(rows) < SEARCH_INDEX_BATCH_SIZE:
+        connection.execute('DELETE FROM "search_index_progress";')
+        return False
+
+    connection.execute('UPDATE "search_index_progress" SET "message_id" = ?, "version" = ?;', rows[-1][:2])
+    return True
+
+def _search_messages(search: SearchQuery, channel_ids: list[int], limit: int, connection: sqlite3.Connection, /) -> list[tuple[int, int, int, str]]:
+    """Find messages in the given channels that match search, newest first.
+    Returns the message ID, channel ID, author ID and a snippet of the content of each one.
+    """
+    # Every term is quoted, so that nothing in it is taken as FTS5 query syntax
+    match = ' '.join(
+        f'"{term[:-1].replace('"', '""')}"*' if term.endswith('*') and len(term) > 1 else f'"{term.replace('"', '""')}"'
+        for term in search['terms']
+    )
+
+    conditions = ['"messages_search" MATCH ?', '"rowid" > ?', '"rowid" < ?']
+    parameters: list[Any] = [match, search['after_id'], search['before_id']]
+    if search['author_id'] is not None:
+        conditions.append('"author_id" = ?')
+        parameters.append(search['author_id'])
+    conditions.append(f'"channel_id" IN ({', '.join('?' * len(channel_ids))})')
+    parameters.extend(channel_ids)
+
+    cursor = connection.execute(f"""
+            SELECT "rowid", "channel_id", "author_id", snippet("messages_search", 0, '**', '**', '…', 16)
+            FROM "messages_search"
+            WHERE {' AND '.join(conditions)}
+            ORDER BY "rowid" DESC
+            LIMIT ?
+        """,
+        (*parameters, limit),
+    )
+    return cursor.fetchall()
+
+def _parse_search_query(query: str, /) -> SearchQuery:
+    """Split a search query into the words to look for and the filters. Raises ValueError if a filter is invalid."""
+    search: SearchQuery = {
+        'terms': [],
+        'author_id': None,
+        'channel_id': None,
+        'after_id': 0,
+        'before_id': 2 ** 63 - 1,
+    }
+    for token in query.split():
+        key, _, value = token.partition(':')
+        if not value or key not in ('from', 'in', 'after', 'before', 'page'):
+            search['terms'].append(token)
+        elif key == 'from':
+            search['author_id'] = _parse_id(value)
+        elif key == 'in':
+            search['channel_id'] = _parse_id(value)
+        elif key == 'after':
+            search['after_id'] = max(search['after_id'], discord.utils.time_snowflake(_parse_date(value)) - 1)
+        elif key == 'before':
+            search['before_id'] = min(search['before_id'], discord.utils.time_snowflake(_parse_date(value)))
+        else:
+            search['before_id'] = min(search['before_id'], _parse_id(value))
+    return search
+
+def _parse_id(value: str, /) -> int:
+    """An ID, given as is or as a mention."""
+    digits = value.strip('<@!#&>')
+    if not digits.isdigit():
+        raise ValueError(f'{value} is not an ID or a mention')
+    return int(digits)
+
+def _parse_date(value: str, /) -> datetime.datetime:
+    """A date or time in ISO 8601 format, in UTC unless it says otherwise."""
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{value} is not a date like 2024-01-31') from None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+def _get_latest_fingerprints(message_ids: tuple[int, ...], connection: sqlite3.Connection, /) -> list[tuple[int, int, bytes | None]]:
+    """Get the latest version of each of the stored messages, with its fingerprint, in one query."""
+    placeholders = ', '.join('?' * len(message_ids))
+    # With MAX(), SQLite takes the other columns from the row that has the maximum
+    cursor = connection.execute(f"""
+            SELECT "message_id", MAX("version"), "fingerprint"
+            FROM "messages"
+            WHERE "message_id" IN ({placeholders})
+            GROUP BY "message_id"
+        """,
+        message_ids,
+    )
+    return cursor.fetchall()
+
+def _get_latest_version(message_id: int, codec: Codec, connection: sqlite3.Connection, /) -> tuple[int, dict[str, Any]] | None:
+    """Get the number and the full data of the latest version of a message, if it exists."""
+    cursor = connection.execute("""
+            SELECT "version", "json", "removed_keys"
+            FROM "messages"
+            WHERE "message_id" = ?
+            ORDER BY "version"
+        """,
+        (message_id,),
+    )
+
+    version: int | None = None
+    data: dict[str, Any] = {}
+    for version, raw_json, removed_keys in cursor:
+        _apply_changes(data, codec.decode(raw_json), removed_keys)
+
+    if version is None:
+        return None
+    return version, data
+
+def _get_message_data(message_id: int, codec: Codec, connection: sqlite3.Connection, /) -> dict[str, Any] | None:
+    latest = _get_latest_version(message_id, codec, connection)
+    return latest[1] if latest else None
+
+def _get_messages_data(message_ids: list[int], codec: Codec, connection: sqlite3.Connection, /) -> dict[int, dict[str, Any]]:
+    messages: dict[int, dict[str, Any]] = {}
+    for batch in itertools.batched(message_ids, LATEST_VERSIONS_QUERY_SIZE):
+        placeholders = ', '.join('?' * len(batch))
+        cursor = connection.execute(f"""
+                SELECT "message_id", "json", "removed_keys"
+                FROM "messages"
+                WHERE "message_id" IN ({placeholders})
+                ORDER BY "message_id", "version"
+            """,
+            batch,
+        )
+        for message_id, raw_json, removed_keys in cursor:
+            _apply_changes(messages.setdefault(message_id, {}), codec.decode(raw_json), removed_keys)
+    return messages
+
+def _get_messages_in_range(
+    channel_id: int | None, author_id: int | None, after_id: int, before_id: int, limit: int,
+    codec: Codec, connection: sqlite3.Connection, /,
+) -> list[tuple[int, dict[str, Any]]]:
+    """Get up to limit messages with IDs strictly between after_id and before_id, oldest first."""
+    channel_ids = None if channel_id is None else [channel_id]
+    message_ids = _get_message_ids_in_range(channel_ids, author_id, after_id, before_id, limit, connection)
+    messages = _get_messages_data(message_ids, codec, connection)
+    return [(message_id, messages[message_id]) for message_id in message_ids]
+
+def _get_message_ids_in_range(
+    channel_ids: list[int] | None, author_id: int | None, after_id: int, before_id: int, limit: int,
+    connection: sqlite3.Connection, /,
+) -> list[int]:
+    conditions = ['"message_id" > ?', '"message_id" < ?']
+    parameters: list[Any] = [after_id, before_id]
+    if channel_ids is not None and len(channel_ids) == 1:
+        conditions.append('"channel_id" = ?')
+        parameters.append(channel_ids[0])
+    elif channel_ids is not None:
+        # Going through the index of each channel would mean sorting all of their messages for every
+        # page. The unary + keeps SQLite from doing that, so it goes through the messages in order instead.
+        conditions.append(f'+"channel_id" IN ({', '.join('?' * len(channel_ids))})')
+        parameters.extend(channel_ids)
+    if author_id is not None:
+        conditions.append('"author_id" = ?')
+        parameters.append(author_id)
+
+    # With only one of channel and author, this only reads its index
+    cursor = connection.execute(f"""
+            SELECT DISTINCT "message_id"
+            FROM "messages"
+            WHERE {' AND '.join(conditions)}
+            ORDER BY "message_id"
+            LIMIT ?
+        """,
+        (*parameters, limit),
+    )
+    return [message_id for message_id, in cursor]
+
+def _get_message_versions(message_ids: list[int], codec: Codec, connection: sqlite3.Connection, /) -> dict[int, list[dict[str, Any]]]:
+    """Get the full data of every version of several messages, oldest version first."""
+    versions: dict[int, list[dict[str, Any]]] = {}
+    for batch in itertools.batched(message_ids, LATEST_VERSIONS_QUERY_SIZE):
+        placeholders = ', '.join('?' * len(batch))
+        cursor = connection.execute(f"""
+                SELECT "message_id", "json", "removed_keys"
+                FROM "messages"
+                WHERE "message_id" IN ({placeholders})
+                ORDER BY "message_id", "version"
+            """,
+            batch,
+        )
+        for message_id, raw_json, removed_keys in cursor:
+            message_versions = versions.setdefault(message_id, [])
+            data = dict(message_versions[-1]) if message_versions else {}
+            _apply_changes(data, codec.decode(raw_json), removed_keys)
+            message_versions.append(data)
+    return versions
+
+def _export_to_files(
+    database_path: str, path: str, compression: StreamKind, include_media: bool,
+    channel_ids: list[int] | None, author_id: int | None, after_id: int, /,
+) -> tuple[int, int]:
+    """Export messages to {path}.jsonl.gz (or .zst), and their attachments to {path}.media.tar if include_media.
+    See _export_messages.
+    """
+    extension = 'gz' if compression == 'gzip' else 'zst'
+    connection = sqlite3.connect(f'file:{database_path}?mode=ro', uri=True, autocommit=True)
+    try:
+        with open_compressed(f'{path}.jsonl.{extension}', compression) as out:
+            if not include_media:
+                return _export_messages(connection, out, None, channel_ids, author_id, after_id)
+            with tarfile.open(f'{path}.media.tar', 'w') as media:
+                return _export_messages(connection, out, media, channel_ids, author_id, after_id)
+    finally:
+        connection.close()
+
+def _export_messages(
+    connection: sqlite3.Connection, out: BinaryIO, media: tarfile.TarFile | None,
+    channel_ids: list[int] | None, author_id: int | None, after_id: int, /,
+) -> tuple[int, int]:
+    """Write every version of the matching messages after after_id to out, one message per line
+    as JSON like {"message_id": ..., "versions": [...]}, and add their downloaded attachments to media.
+
+    Messages are read EXPORT_PAGE_SIZE at a time, oldest first, each page in its own short read
+    so that a long export doesn't keep the write-ahead log from being checkpointed.
+    Returns how many messages were exported, and the ID of the last one (to resume after).
+    """
+    # Can decode stored messages, whatever they were compressed with
+    codec = _load_codec('none', connection)
+
+    count = 0
+    while message_ids := _get_message_ids_in_range(channel_ids, author_id, after_id, 2 ** 63 - 1, EXPORT_PAGE_SIZE, connection):
+        versions = _get_message_versions(message_ids, codec, connection)
+        out.write(''.join(
+            _json_dumps({'message_id': message_id, 'versions': versions[message_id]}) + '\n'
+            for message_id in message_ids
+        ).encode())
+
+        if media is not None:
+            for message_id, attachment_id, _, path, _ in _get_attachments_of_messages(message_ids, connection):
+                try:
+                    media.add(path)
+                except FileNotFoundError:
+                    logging.warning('Downloaded attachment %s of message %s is missing from %s', attachment_id, message_id, path)
+
+        count += len(message_ids)
+        after_id = message_ids[-1]
+
+    return count, after_id
+
+def _get_user_profile(user_id: int, connection: sqlite3.Connection, /) -> UserProfile | None:
+    cursor = connection.execute("""
+            SELECT "display_name", "avatar_url", "colour", "updated_at"
+            FROM "users"
+            WHERE "user_id" = ?
+        """,
+        (user_id,),
+    )
+    row: tuple[str, str, int | None, float] | None = cursor.fetchone()
+    if row is None:
+        return None
+
+    display_name, avatar_url, colour, updated_at = row
+    return {'user_id': user_id, 'display_name': display_name, 'avatar_url': avatar_url, 'colour': colour, 'updated_at': updated_at}
+
+def _update_user_profiles(profiles: list[UserProfile], connection: sqlite3.Connection, /) -> None:
+    """Store profiles, except where what's stored is more recent. A known colour is kept
+    if the new profile doesn't have one, since users only have one while they're in a server.
+    """
+    connection.executemany("""
+            INSERT INTO "users" ("user_id", "display_name", "avatar_url", "colour", "updated_at")
+            VALUES (:user_id, :display_name, :avatar_url, :colour, :updated_at)
+            ON CONFLICT ("user_id") DO UPDATE SET
+                "display_name" = "excluded"."display_name",
+                "avatar_url" = "excluded"."avatar_url",
+                "colour" = coalesce("excluded"."colour", "users"."colour"),
+                "updated_at" = "excluded"."updated_at"
+            WHERE "excluded"."updated_at" >= "users"."updated_at"
+        """,
+        profiles,
+    )
+
+def _is_attachment_downloaded(attachment_id: int, connection: sqlite3.Connection, /) -> bool:
+    cursor = connection.execute("""
+            SELECT 1
+            FROM "attachments"
+            WHERE "attachment_id" = ?
+        """,
+        (attachment_id,),
+    )
+    return cursor.fetchone() is not None
+
+def _add_attachment(
+    guild_id: int, channel_id: int, message_id: int,
+    attachment: discord.Attachment, path: str,
+    connection: sqlite3.Connection, /,
+) -> None:
+    connection.execute("""
+            INSERT OR REPLACE INTO "attachments"
+            (attachment_id, message_id, channel_id, guild_id, filename, path, size, content_type, description)
+            VALUES
+            (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (attachment.id, message_id, channel_id, guild_id, attachment.filename, path,
+         attachment.size, attachment.content_type, attachment.description),
+    )
+    _remove_pending_attachment(attachment.id, connection)
+
+def _remove_pending_attachment(attachment_id: int, connection: sqlite3.Connection, /) -> None:
+    connection.execute("""
+            DELETE FROM "pending_attachments"
+            WHERE "attachment_id" = ?
+        """,
+        (attachment_id,),
+    )
+
+def _get_pending_attachments(connection: sqlite3.Connection, /) -> list[tuple[int, int, int, str]]:
+    cursor = connection.execute("""
+            SELECT "guild_id", "channel_id", "message_id", "data"
+            FROM "pending_attachments"
+            ORDER BY "attachment_id"
+        """)
+    return cursor.fetchall()
+
+def _get_attachments(message_id: int, connection: sqlite3.Connection, /) -> list[tuple[int, str, str, str | None]]:
+    cursor = connection.execute("""
+            SELECT "attachment_id", "filename", "path", "description"
+            FROM "attachments"
+            WHERE "message_id" = ?
+        """,
+        (message_id,),
+    )
+    return cursor.fetchall()
+
+def _get_attachments_of_messages(message_ids: list[int], connection: sqlite3.Connection, /) -> list[tuple[int, int, str, str, str | None]]:
+    rows: list[tuple[int, int, str, str, str | None]] = []
+    for batch in itertools.batched(message_ids, LATEST_VERSIONS_QUERY_SIZE):
+        placeholders = ', '.join('?' * len(batch))
+        cursor = connection.execute(f"""
+                SELECT "message_id", "attachment_id", "filename", "path", "description"
+                FROM "attachments"
+                WHERE "message_id" IN ({placeholders})
+                ORDER BY "message_id", "attachment_id"
+            """,
+            batch,
+        )
+        rows.extend(cursor)
+    return rows
+
+def _scan_media_directory(root: str, /) -> Iterator[tuple[Any, ...]]:
+    """Find downloaded attachments, which are stored as {root}/{guild}/{channel}/{message}/a{attachment}-{filename}."""
+    if not os.path.isdir(root):
+        return
+
+    for guild_entry in os.scandir(root):
+        if not guild_entry.is_dir() or not guild_entry.name.isdigit():
+            continue
+        for channel_entry in os.scandir(guild_entry.path):
+            if not channel_entry.is_dir() or not channel_entry.name.isdigit():
+                continue
+            for message_entry in os.scandir(channel_entry.path):
+                if not message_entry.is_dir() or not message_entry.name.isdigit():
+                    continue
+                for entry in os.scandir(message_entry.path):
+                    attachment_id, _, filename = entry.name[1:].partition('-')
+                    if not entry.name.startswith('a') or not attachment_id.isdigit() or not entry.is_file():
+                        continue
+
+                    content_type, _ = mimetypes.guess_type(filename)
+                    yield (
+                        int(attachment_id), int(message_entry.name), int(channel_entry.name), int(guild_entry.name),
+                        filename, pathlib.Path(entry.path).as_posix(), entry.stat().st_size, content_type, None,
+                    )
+
+def _add_scanned_attachments(rows: list[tuple[Any, ...]], connection: sqlite3.Connection, /) -> int:
+    """Record attachments found on disk, leaving the ones already recorded alone."""
+    cursor = connection.executemany("""
+            INSERT OR IGNORE INTO "attachments"
+            (attachment_id, message_id, channel_id, guild_id, filename, path, size, content_type, description)
+            VALUES
+            (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        rows,
+    )
+    added = cursor.rowcount
+    connection.executemany("""
+            DELETE FROM "pending_attachments"
+            WHERE "attachment_id" = ?
+        """,
+        [(row[0],) for row in rows],
+    )
+    return added
+
+def _user_profile(user: discord.User | discord.Member, /) -> UserProfile:
+    colour = user.colour.value if isinstance(user, discord.Member) and user.colour != discord.Colour.default() else None
+    return {
+        'user_id': user.id,
+        'display_name': user.global_name or user.name,
+        'avatar_url': user.display_avatar.url,
+        'colour': colour,
+        'updated_at': time.time(),
+    }
+
+def _message_author_profile(data: dict[str, Any], /) -> UserProfile:
+    """The profile of the author of a message, as of when the message was sent."""
+    author: dict[str, Any] = data['author']
+    user_id = int(author['id'])
+    avatar: str | None = author.get('avatar')
+    if avatar is not None:
+        extension = 'gif' if avatar.startswith('a_') else 'png'
+        avatar_url = f'https://cdn.discordapp.com/avatars/{user_id}/{avatar}.{extension}?size=1024'
+    elif author.get('discriminator', '0') == '0':
+        avatar_url = f'https://cdn.discordapp.com/embed/avatars/{(user_id >> 22) % 6}.png'
+    else:
+        avatar_url = f'https://cdn.discordapp.com/embed/avatars/{int(author['discriminator']) % 5}.png'
+
+    return {
+        'user_id': user_id,
+        'display_name': author.get('global_name') or author.get('username', str(user_id)),
+        'avatar_url': avatar_url,
+        'colour': None,
+        'updated_at': discord.utils.snowflake_time(int(data['id'])).timestamp(),
+    }
+
+def _tracked_fields(data: dict[str, Any], /) -> tuple[Any, ...]:
+    """The fields of a message that cause a new version to be stored when they change."""
+    return (data['pinned'], data.get('edited_timestamp'), data['content'], data['attachments'], data['embeds'])
+
+def _fingerprint(data: dict[str, Any], /) -> bytes:
+    """A hash of the tracked fields of a message, which is the same whenever they're equal."""
+    canonical = json.dumps(_tracked_fields(data), separators=(',', ':'), ensure_ascii=False, sort_keys=True)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).digest()
+
+def _message_row(
+    data: dict[str, Any], version: int, previous: dict[str, Any] | None,
+    fingerprint: bytes, codec: Codec, /,
+) -> tuple[Any, ...]:
+    """Make a row of the messages table, storing only what changed if there's a previous version."""
+    message_id: int = data['id']
+    channel_id: int = data['channel_id']
+    author_id: int = data['author']['id']
+
+    if previous is None:
+        changes = data
+        removed_keys = None
+    else:
+        changes = {key: value for key, value in data.items() if key not in previous or previous[key] != value}
+        removed = [key for key in previous if key not in data]
+        removed_keys = _json_dumps(removed) if removed else None
+
+    return (message_id, version, channel_id, author_id, codec.encode(_json_dumps(changes)), removed_keys, fingerprint)
+
+def _apply_changes(data: dict[str, Any], raw_json: str, removed_keys: str | None, /) -> None:
+    """Turn data from one version of a message into the next one, given the row of the next one."""
+    data.update(_json_loads(raw_json))
+    if removed_keys is not None:
+        for key in _json_loads(removed_keys):
+            data.pop(key, None)
+
+def _snowflake_bound(value: datetime.datetime | int | None, default: int, /, *, high: bool) -> int:
+    """A message ID to compare others against, for a time or a message ID.
+    With high, it's the last possible ID at that time, otherwise the first one.
+    """
+    if value is None:
+        return default
+    if isinstance(value, datetime.datetime):
+        return discord.utils.time_snowflake(value, high=high)
+    return value
+
+def _json_dumps(value: Any, /) -> str:
+    return json.dumps(value, separators=(',', ':'), ensure_ascii=False)
 
 async def setup(bot: BotClient):
     await bot.add_cog(History(bot))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m cogs.history',
+        description='Maintenance of the history database. Stop the bot before running this.',
+    )
+    parser.add_argument('--database', default=DATABASE_PATH, help='path of the database (default: %(default)s)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('migrate', help='convert the database to the current layout, then reclaim the space that frees up')
+    export_parser = subparsers.add_parser('export', help='export every version of stored messages to compressed JSON lines')
+    export_parser.add_argument('path', help='where to write the export, without an extension')
+    export_parser.add_argument('--channel', type=int, action='append', help='only export this channel (can be given several times)')
+    export_parser.add_argument('--author', type=int, help='only export the messages of this user')
+    export_parser.add_argument('--after', type=int, default=0, help='resume an export from after this message ID')
+    export_parser.add_argument('--compression', choices=('gzip', 'zstd'), default='gzip')
+    export_parser.add_argument('--media', action='store_true', help='also bundle downloaded attachments into PATH.media.tar')
+    args = parser.parse_args()
+
+    if args.command == 'migrate':
+        connection = sqlite3.connect(args.database, autocommit=False)
+        _configure_connection(connection)
+        _create_tables(connection)
+        connection.commit()
+
+        for name in _missing_message_indexes(connection):
+            _create_message_index(name, connection)
+            connection.commit()
+
+        # Can decode stored messages, whatever they were compressed with
+        codec = _load_codec('none', connection)
+        while _index_stored_messages(codec, connection):
+            connection.commit()
+        connection.commit()
+
+        connection.autocommit = True
+        connection.execute('VACUUM;')
+        connection.close()
+
+    elif args.command == 'export':
+        count, last_message_id = _export_to_files(
+            args.database, args.path, args.compression, args.media, args.channel, args.author, args.after,
+        )
+        print(f'Exported {count} messages, up to message {last_message_id}.')
@@ -1,15 +1,48 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import asyncio
+import collections
+import database
 import datetime
 import discord
+import functools
 import interface
+import io
 import json
+import logging
 import os
+import sqlite3
+import time
 from discord.ext import commands
 from .history import History
+from metrics import REGISTRY
 from typing import Any, Optional
 
 
+# Discord allows at most this many files and embeds per message, and this many characters
+# of content and of all the embeds together.
+MAX_FILES_PER_MESSAGE = 10
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_CONTENT_LENGTH = 2000
+MAX_EMBEDS_LENGTH = 6000
+
+# Log messages are held back for this many seconds, so that the ones queued for the same
+# channel in the meantime can be sent together.
+LOG_BATCH_DELAY = 0.5
+
+# Log config changes are saved this many seconds after the first one,
+# together with any others made in the meantime.
+LOG_CONFIG_SAVE_DELAY = 1.0
+
+# At most this many log messages are being sent at once, across all log channels.
+LOG_SEND_CONCURRENCY = 4
+
+# When the cog unloads, queued log messages get this many seconds to be sent before they are dropped.
+LOG_CLOSE_TIMEOUT = 10.0
+
+# The log queue command reports on the send latency of this many of the latest log messages.
+LOG_LATENCY_SAMPLES = 1000
+
 VALID_LOG_ITEMS = (
     'message_delete',
     'message_edit',
@@ -20,8 +53,111 @@ VALID_LOG_ITEMS = (
 class Logs(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        # Only has the guilds whose configs have been loaded from the database (see _load_log_config)
         self.configs: dict[int, dict[int, dict[str, bool]]] = {}
-        self.load_log_configs()
+        # Log item -> guild ID -> the log channels that have it enabled, worked out from configs
+        # whenever they change, so events don't have to go through every log channel of a guild.
+        self._routes: dict[str, dict[int, tuple[discord.TextChannel, ...]]] = {item: {} for item in VALID_LOG_ITEMS}
+        self._log_sender = LogSender()
+
+        self._loaded_guild_ids: set[int] = set()
+        self._config_loads: dict[int, asyncio.Task[None]] = {}
+        self._unsaved_guild_ids: set[int] = set()
+        self._config_save_task: asyncio.Task[None] | None = None
+
+        os.makedirs('databases', exist_ok=True)
+        self._db = database.Database('databases/logs.sqlite', readers=1)
+
+    async def cog_load(self) -> None:
+        await self._db.write(_create_tables)
+        imported = await self._db.write(functools.partial(_import_json_configs, 'logs'))
+        for path in imported:
+            # Renamed rather than deleted, so nothing is lost if something went wrong
+            os.replace(path, f'{path}.imported')
+
+    async def cog_unload(self) -> None:
+        await self._log_sender.close()
+        if self._config_save_task is not None:
+            self._config_save_task.cancel()
+        await self._save_log_configs()
+        await self._db.close()
+
+    async def cog_before_invoke(self, ctx: commands.Context[commands.Bot | commands.AutoShardedBot]) -> None:
+        if ctx.guild is not None:
+            await self._load_log_config(ctx.guild.id)
+
+    async def _log_channels(self, guild_id: int, item: str, /) -> tuple[discord.TextChannel, ...]:
+        """The log channels of a guild that have item enabled."""
+        if guild_id not in self._loaded_guild_ids:
+            await self._load_log_config(guild_id)
+        return self._routes[item].get(guild_id, ())
+
+    async def _load_log_config(self, guild_id: int, /) -> None:
+        """Load the config of a guild the first time it's needed. Concurrent loads of the same guild share one query."""
+        if guild_id in self._loaded_guild_ids:
+            return
+
+        task = self._config_loads.get(guild_id)
+        if task is None:
+            task = asyncio.get_running_loop().create_task(self._read_log_config(guild_id))
+            self._config_loads[guild_id] = task
+            task.add_done_callback(lambda _: self._config_loads.pop(guild_id, None))
+        await asyncio.shield(task)
+
+    async def _read_log_config(self, guild_id: int, /) -> None:
+        config = await self._db.read(functools.partial(_get_log_config, guild_id))
+        if config:
+            self.configs[guild_id] = config
+        self._loaded_guild_ids.add(guild_id)
+        self._update_routes(guild_id)
+
+    def _update_routes(self, guild_id: int, /) -> None:
+        """Work out which log channels of a guild each log item goes to, after its config changed."""
+        log_channels: dict[str, list[discord.TextChannel]] = {item: [] for item in VALID_LOG_ITEMS}
+        for log_channel_id, log_channel_config in self.configs.get(guild_id, {}).items():
+            log_channel = self.bot.get_channel(log_channel_id)
+            if not isinstance(log_channel, discord.TextChannel):
+                continue
+            if log_channel.guild.id != guild_id:
+                continue
+
+            for item, enabled in log_channel_config.items():
+                if enabled and item in log_channels:
+                    log_channels[item].append(log_channel)
+
+        for item, routes in self._routes.items():
+            if log_channels[item]:
+                routes[guild_id] = tuple(log_channels[item])
+            else:
+                routes.pop(guild_id, None)
+
+    @commands.Cog.listener()
+    async def on_guild_channel_delete(self, channel: discord.abc.GuildChannel):
+        if channel.guild.id in self._loaded_guild_ids:
+            self._update_routes(channel.guild.id)
+
+    @commands.Cog.listener()
+    async def on_guild_available(self, guild: discord.Guild):
+        # Its channels may be new objects, or may only now be known
+        if guild.id in self._loaded_guild_ids:
+            self._update_routes(guild.id)
+
+    async def _send_log(
+        self, log_channels: tuple[discord.TextChannel, ...], content: str, /,
+        *, embed: discord.Embed | None = None,
+        files: list[discord.File] | None = None,
+    ) -> None:
+        """Queue the same log message for every one of log_channels.
+        A File can only be sent once, so every channel after the first gets its own copies.
+        Making them doesn't await anything, so log messages are queued in the order they were logged.
+        """
+        if files and len(log_channels) > 1:
+            copies = copy_files(files, len(log_channels))
+        else:
+            copies = [files or []] * len(log_channels)
+
+        for log_channel, channel_files in zip(log_channels, copies):
+            self._log_sender.send(log_channel, content, embed=embed, files=channel_files)
 
     @commands.Cog.listener()
     async def on_message_delete(self, message: discord.Message):
@@ -29,23 +165,13 @@ class Logs(commands.Cog):
             return
         if message.guild is None:
             return
-        if message.guild.id not in self.configs:
+        log_channels = await self._log_channels(message.guild.id, 'message_delete')
+        if not log_channels:
             return
 
-        guild_config = self.configs[message.guild.id]
-
-        for log_channel_id, log_channel_config in guild_config.items():
-            if not log_channel_config.get('message_delete', False):
-                continue
-            log_channel = self.bot.get_channel(log_channel_id)
-            if not isinstance(log_channel, discord.TextChannel):
-                continue
-            if log_channel.guild != message.guild:
-                continue
-
-            await self._log_cached_message_delete(log_channel, message)
+        await self._log_cached_message_delete(log_channels, message)
 
-    async def _log_cached_message_delete(self, log_channel: discord.TextChannel, message: discord.Message, /) -> None:
+    async def _log_cached_message_delete(self, log_channels: tuple[discord.TextChannel, ...], message: discord.Message, /) -> None:
         embed = discord.Embed(
             colour=get_colour(message.author),
             description=message.content,
@@ -61,33 +187,35 @@ class Logs(commands.Cog):
         )
         reltime = relative_time(message.created_at)
 
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             '**\N{WASTEBASKET} MESSAGE DELETED**\n'
             f'Sent {reltime} by {message.author.mention} in <#{message.channel.id}>',
             embed=embed,
         )
 
         if message.attachments:
-            ids = [attachment.id for attachment in message.attachments]
-            assert(message.guild)
+            ids = {attachment.id for attachment in message.attachments}
             history: History = self.bot.get_cog('History') # type: ignore
             assert(history)
 
             descriptions = {attachment.id: attachment.description for attachment in message.attachments if attachment.description}
 
-            files = history.get_downloaded_attachments(
-                message.guild.id, message.channel.id, message.id,
+            files = await history.get_downloaded_attachments(
+                message.id,
                 attachment_ids=ids,
                 descriptions=descriptions,
             )
 
             if files:
-                await log_channel.send(
+                await self._send_log(
+                    log_channels,
                     f'\N{PAPERCLIP} _Attachments of message {message.id}:_',
                     files=files,
                 )
             else:
-                await log_channel.send(
+                await self._send_log(
+                    log_channels,
                     f'\N{PAPERCLIP} _Attachments of message {message.id} could not be found._',
                 )
 
@@ -101,30 +229,20 @@ class Logs(commands.Cog):
             return
         if payload.guild_id is None:
             return
-        if payload.guild_id not in self.configs:
+        log_channels = await self._log_channels(payload.guild_id, 'message_delete')
+        if not log_channels:
             return
 
-        guild_config = self.configs[payload.guild_id]
-
-        for log_channel_id, log_channel_config in guild_config.items():
-            if not log_channel_config.get('message_delete', False):
-                continue
-            log_channel = self.bot.get_channel(log_channel_id)
-            if not isinstance(log_channel, discord.TextChannel):
-                continue
-            if log_channel.guild.id != payload.guild_id:
-                continue
-
-            history: History = self.bot.get_cog('History') # type: ignore
-            assert(history)
+        history: History = self.bot.get_cog('History') # type: ignore
+        assert(history)
 
-            data = history.get_message(payload.message_id)
-            if data is None:
-                await self._log_uncached_message_delete(log_channel, payload)
-            else:
-                await self._log_historical_message_delete(log_channel, payload, data)
+        data = await history.get_message(payload.message_id)
+        if data is None:
+            await self._log_uncached_message_delete(log_channels, payload)
+        else:
+            await self._log_historical_message_delete(log_channels, payload, data)
 
-    async def _log_uncached_message_delete(self, log_channel: discord.TextChannel, payload: discord.RawMessageDeleteEvent, /) -> None:
+    async def _log_uncached_message_delete(self, log_channels: tuple[discord.TextChannel, ...], payload: discord.RawMessageDeleteEvent, /) -> None:
         embed = discord.Embed(
             colour=discord.Colour.red(),
             title='Uncached message',
@@ -136,7 +254,8 @@ class Logs(commands.Cog):
             ),
         )
 
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             '**\N{WASTEBASKET} MESSAGE DELETED**\n'
             f'In <#{payload.channel_id}>',
             embed=embed,
@@ -145,35 +264,41 @@ class Logs(commands.Cog):
         # I don't think it's possible that we have the attachments of a message even though it's uncached, but just in case
         history: History = self.bot.get_cog('History') # type: ignore
         assert(history)
-        files = history.get_downloaded_attachments(payload.guild_id or 0, payload.channel_id, payload.message_id)
+        files = await history.get_downloaded_attachments(payload.message_id)
         if files:
-            await log_channel.send(
+            await self._send_log(
+                log_channels,
                 f'\N{PAPERCLIP} _Attachments of message {payload.message_id}:_',
                 files=files,
             )
 
-    async def _log_historical_message_delete(self, log_channel: discord.TextChannel, payload: discord.RawMessageDeleteEvent, data: dict[str, Any], /) -> None:
+    async def _log_historical_message_delete(self, log_channels: tuple[discord.TextChannel, ...], payload: discord.RawMessageDeleteEvent, data: dict[str, Any], /) -> None:
         author_id: int = int(data['author']['id'])
         content: str = data['content']
         timestamp: str = data['timestamp']
         attachments: list[dict[str, Any]] = data['attachments']
-        try:
-            author = (log_channel.guild.get_member(author_id)
-                or self.bot.get_user(author_id)
-                or await self.bot.fetch_user(author_id))
-        except (discord.NotFound, discord.HTTPException):
-            author = None
+
+        history: History = self.bot.get_cog('History') # type: ignore
+        assert(history)
 
         embed = discord.Embed(
-            colour=get_colour(author) if author else None,
             description=content,
         )
 
+        author = log_channels[0].guild.get_member(author_id) or self.bot.get_user(author_id)
+        profile = await history.get_user_profile(author_id) if author is None else None
         if author:
+            embed.colour = get_colour(author)
             embed.set_author(
                 name=author.display_name,
                 icon_url=author.display_avatar.url,
             )
+        elif profile:
+            embed.colour = profile['colour']
+            embed.set_author(
+                name=profile['display_name'],
+                icon_url=profile['avatar_url'],
+            )
         else:
             embed.set_author(
                 name=f'User {author_id}',
@@ -188,66 +313,95 @@ class Logs(commands.Cog):
         )
         reltime = relative_time(discord.utils.parse_time(timestamp))
 
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             '**\N{WASTEBASKET} MESSAGE DELETED**\n'
             f'Sent {reltime} by <@{author_id}> in <#{payload.channel_id}>',
             embed=embed,
         )
 
         if attachments:
-            ids: list[int] = [int(attachment['id']) for attachment in attachments]
-            history: History = self.bot.get_cog('History') # type: ignore
-            assert(history)
+            ids: set[int] = {int(attachment['id']) for attachment in attachments}
 
             descriptions: dict[int, str] = {int(attachment['id']): attachment['description'] for attachment in attachments if 'description' in attachment}
 
-            files = history.get_downloaded_attachments(
-                payload.guild_id or 0, payload.channel_id, payload.message_id,
+            files = await history.get_downloaded_attachments(
+                payload.message_id,
                 attachment_ids=ids,
                 descriptions=descriptions,
             )
 
             if files:
-                await log_channel.send(
+                await self._send_log(
+                    log_channels,
                     f'\N{PAPERCLIP} _Attachments of message {payload.message_id}:_',
                     files=files,
                 )
             else:
-                await log_channel.send(
+                await self._send_log(
+                    log_channels,
                     f'\N{PAPERCLIP} _Attachments of message {payload.message_id} could not be found._',
                 )
 
     @commands.Cog.listener()
-    async def on_message_edit(self, before: discord.Message, after: discord.Message):
-        if not isinstance(before.channel, discord.abc.GuildChannel):
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent) -> None:
+        message_channel = self.bot.get_channel(payload.channel_id)
+        if not isinstance(message_channel, discord.abc.GuildChannel):
             return
-        if before.guild is None:
+        if payload.guild_id is None:
             return
-        if before.guild.id not in self.configs:
+        log_channels = await self._log_channels(payload.guild_id, 'message_delete')
+        if not log_channels:
             return
 
-        guild_config = self.configs[before.guild.id]
+        # Everything is looked up once for all the deleted messages, rather than once per message
+        history: History = self.bot.get_cog('History') # type: ignore
+        assert(history)
 
-        for log_channel_id, log_channel_config in guild_config.items():
-            if not log_channel_config.get('message_edit', False):
-                continue
-            log_channel = self.bot.get_channel(log_channel_id)
-            if not isinstance(log_channel, discord.TextChannel):
-                continue
-            if log_channel.guild != before.guild:
-                continue
+        cached = {message.id: message for message in payload.cached_messages}
+        stored = await history.get_messages(payload.message_ids - cached.keys())
+        transcript = bulk_delete_transcript(sorted(payload.message_ids), cached, stored)
+
+        descriptions: dict[int, str] = {}
+        for data in stored.values():
+            descriptions.update({int(attachment['id']): attachment['description'] for attachment in data['attachments'] if 'description' in attachment})
+        for message in cached.values():
+            descriptions.update({attachment.id: attachment.description for attachment in message.attachments if attachment.description})
+
+        await self._log_bulk_message_delete(log_channels, payload, transcript, len(cached) + len(stored), descriptions)
+
+    async def _log_bulk_message_delete(self, log_channels: tuple[discord.TextChannel, ...], payload: discord.RawBulkMessageDeleteEvent, transcript: str, known_count: int, descriptions: dict[int, str], /) -> None:
+        file = discord.File(io.BytesIO(transcript.encode()), f'deleted-messages-{payload.channel_id}.txt')
 
-            await self._dispatch_message_edit(log_channel, before, after)
+        await self._send_log(
+            log_channels,
+            f'**\N{WASTEBASKET} {len(payload.message_ids)} MESSAGES DELETED**\n'
+            f'In <#{payload.channel_id}>, {known_count} of them are in the attached transcript.',
+            files=[file],
+        )
+
+        history: History = self.bot.get_cog('History') # type: ignore
+        assert(history)
 
-    async def _dispatch_message_edit(self, log_channel: discord.TextChannel, before: discord.Message, after: discord.Message, /) -> None:
+        attachments = await history.get_downloaded_attachments_of_messages(payload.message_ids, descriptions=descriptions)
+        files = [file for message_id in sorted(attachments) for file in attachments[message_id]]
+        batches = pack_files(files, log_channels[0].guild.filesize_limit)
+        for i, batch in enumerate(batches, 1):
+            await self._send_log(
+                log_channels,
+                f'\N{PAPERCLIP} _Attachments of the deleted messages ({i}/{len(batches)}):_',
+                files=batch,
+            )
+
+    async def _dispatch_message_edit(self, log_channels: tuple[discord.TextChannel, ...], before: discord.Message, after: discord.Message, /) -> None:
         if before.content != after.content:
-            await self._log_cached_message_edit(log_channel, before, after)
+            await self._log_cached_message_edit(log_channels, before, after)
 
-        removed_attachment_ids = [attachment.id for attachment in before.attachments if attachment not in after.attachments]
+        removed_attachment_ids = {attachment.id for attachment in before.attachments if attachment not in after.attachments}
         if removed_attachment_ids:
-            await self._log_cached_removed_attachments(log_channel, before, removed_attachment_ids)
+            await self._log_cached_removed_attachments(log_channels, before, removed_attachment_ids)
 
-    async def _log_cached_message_edit(self, log_channel: discord.TextChannel, before: discord.Message, after: discord.Message, /) -> None:
+    async def _log_cached_message_edit(self, log_channels: tuple[discord.TextChannel, ...], before: discord.Message, after: discord.Message, /) -> None:
         embed = discord.Embed(
             colour=get_colour(before.author),
         )
@@ -278,21 +432,21 @@ class Logs(commands.Cog):
         )
 
         reltime = relative_time(before.created_at)
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             '**\N{MEMO} MESSAGE EDITED**\n'
             f'Sent {reltime} by {before.author.mention} at {before.jump_url}',
             embed=embed,
         )
 
-    async def _log_cached_removed_attachments(self, log_channel: discord.TextChannel, before: discord.Message, removed_attachment_ids: list[int], /) -> None:
-        assert(before.guild)
+    async def _log_cached_removed_attachments(self, log_channels: tuple[discord.TextChannel, ...], before: discord.Message, removed_attachment_ids: set[int], /) -> None:
         history: History = self.bot.get_cog('History') # type: ignore
         assert(history)
 
         descriptions = {attachment.id: attachment.description for attachment in before.attachments if attachment.description}
 
-        files = history.get_downloaded_attachments(
-            before.guild.id, before.channel.id, before.id,
+        files = await history.get_downloaded_attachments(
+            before.id,
             attachment_ids=removed_attachment_ids,
             descriptions=descriptions,
         )
@@ -318,48 +472,39 @@ class Logs(commands.Cog):
         ]
         if files:
             text.append(f'\N{PAPERCLIP} _Removed attachments are attached._')
-            await log_channel.send('\n'.join(text), embed=embed, files=files)
+            await self._send_log(log_channels, '\n'.join(text), embed=embed, files=files)
         else:
             text.append(f'\N{PAPERCLIP} _Removed attachments could not be found._')
-            await log_channel.send('\n'.join(text), embed=embed)
+            await self._send_log(log_channels, '\n'.join(text), embed=embed)
 
     @commands.Cog.listener()
     async def on_raw_message_edit(self, payload: discord.RawMessageUpdateEvent) -> None:
         # We have to handle this rather than the history cog in order to avoid
         # a race condition where the history cog could update the message before
         # we grab the latest (older) version.
+        # The stored version is used even for messages in discord.py's cache, which has
+        # already been updated by a later edit if two of them arrive close together.
         history: History = self.bot.get_cog('History') # type: ignore
         assert(history)
-        data = history.get_and_update_message(payload)
-
-        if payload.cached_message is not None:
-            return
+        data = await history.get_and_update_message(payload)
 
         message_channel = self.bot.get_channel(payload.channel_id)
         if not isinstance(message_channel, discord.abc.GuildChannel):
             return
         if payload.guild_id is None:
             return
-        if payload.guild_id not in self.configs:
+        log_channels = await self._log_channels(payload.guild_id, 'message_edit')
+        if not log_channels:
             return
 
-        guild_config = self.configs[payload.guild_id]
-
-        for log_channel_id, log_channel_config in guild_config.items():
-            if not log_channel_config.get('message_edit', False):
-                continue
-            log_channel = self.bot.get_channel(log_channel_id)
-            if not isinstance(log_channel, discord.TextChannel):
-                continue
-            if log_channel.guild.id != payload.guild_id:
-                continue
-
-            if data is None:
-                await self._log_uncached_message_edit(log_channel, payload)
-            else:
-                await self._dispatch_historical_message_edit(log_channel, payload, data)
+        if data is not None:
+            await self._dispatch_historical_message_edit(log_channels, payload, data)
+        elif payload.cached_message is not None:
+            await self._dispatch_message_edit(log_channels, payload.cached_message, payload.message)
+        else:
+            await self._log_uncached_message_edit(log_channels, payload)
 
-    async def _log_uncached_message_edit(self, log_channel: discord.TextChannel, payload: discord.RawMessageUpdateEvent, /) -> None:
+    async def _log_uncached_message_edit(self, log_channels: tuple[discord.TextChannel, ...], payload: discord.RawMessageUpdateEvent, /) -> None:
         embed = discord.Embed(
             title='Uncached message',
             colour=get_colour(payload.message.author),
@@ -376,35 +521,38 @@ class Logs(commands.Cog):
         )
 
         reltime = relative_time(payload.message.created_at)
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             '**\N{MEMO} MESSAGE EDITED**\n'
             f'Sent {reltime} by {payload.message.author.mention} at {payload.message.jump_url}',
             embed=embed,
         )
 
         # I don't think it's possible that we have the attachments of a message even though it's uncached, but just in case
-        exclude_ids = [attachment.id for attachment in payload.message.attachments]
+        exclude_ids = {attachment.id for attachment in payload.message.attachments}
         history: History = self.bot.get_cog('History') # type: ignore
         assert(history)
-        files = history.get_downloaded_attachments(payload.guild_id or 0, payload.channel_id, payload.message_id, exclude_ids=exclude_ids)
+        files = await history.get_downloaded_attachments(payload.message_id, exclude_ids=exclude_ids)
         if files:
-            await log_channel.send(
+            await self._send_log(
+                log_channels,
                 f'\N{PAPERCLIP} _Previous attachments of message {payload.message_id}:_',
                 files=files,
             )
 
-    async def _dispatch_historical_message_edit(self, log_channel: discord.TextChannel, payload: discord.RawMessageUpdateEvent, data: dict[str, Any], /) -> None:
+    async def _dispatch_historical_message_edit(self, log_channels: tuple[discord.TextChannel, ...], payload: discord.RawMessageUpdateEvent, data: dict[str, Any], /) -> None:
         before_content: str = data['content']
 
         if before_content != payload.message.content:
-            await self._log_historical_message_edit(log_channel, payload, before_content)
+            await self._log_historical_message_edit(log_channels, payload, before_content)
 
         before_attachments: list[dict[str, Any]] = data['attachments']
-        removed_attachment_ids = [int(attachment['id']) for attachment in before_attachments if attachment not in payload.message.attachments]
+        after_attachment_ids = {attachment.id for attachment in payload.message.attachments}
+        removed_attachment_ids = {int(attachment['id']) for attachment in before_attachments} - after_attachment_ids
         if removed_attachment_ids:
-            await self._log_historical_removed_attachments(log_channel, payload, before_content, before_attachments, removed_attachment_ids)
+            await self._log_historical_removed_attachments(log_channels, payload, before_content, before_attachments, removed_attachment_ids)
 
-    async def _log_historical_message_edit(self, log_channel: discord.TextChannel, payload: discord.RawMessageUpdateEvent, before_content: str, /) -> None:
+    async def _log_historical_message_edit(self, log_channels: tuple[discord.TextChannel, ...], payload: discord.RawMessageUpdateEvent, before_content: str, /) -> None:
         embed = discord.Embed(
             colour=get_colour(payload.message.author),
         )
@@ -435,20 +583,21 @@ class Logs(commands.Cog):
         )
 
         reltime = relative_time(payload.message.created_at)
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             '**\N{MEMO} MESSAGE EDITED**\n'
             f'Sent {reltime} by {payload.message.author.mention} at {payload.message.jump_url}',
             embed=embed,
         )
 
-    async def _log_historical_removed_attachments(self, log_channel: discord.TextChannel, payload: discord.RawMessageUpdateEvent, before_content: str, before_attachments: list[dict[str, Any]], removed_attachment_ids: list[int], /) -> None:
+    async def _log_historical_removed_attachments(self, log_channels: tuple[discord.TextChannel, ...], payload: discord.RawMessageUpdateEvent, before_content: str, before_attachments: list[dict[str, Any]], removed_attachment_ids: set[int], /) -> None:
         history: History = self.bot.get_cog('History') # type: ignore
         assert(history)
 
         descriptions: dict[int, str] = {int(attachment['id']): attachment['description'] for attachment in before_attachments if 'description' in attachment}
 
-        files = history.get_downloaded_attachments(
-            payload.guild_id or 0, payload.channel_id, payload.message_id,
+        files = await history.get_downloaded_attachments(
+            payload.message_id,
             attachment_ids=removed_attachment_ids,
             descriptions=descriptions,
         )
@@ -474,30 +623,20 @@ class Logs(commands.Cog):
         ]
         if files:
             text.append(f'\N{PAPERCLIP} _Removed attachments are attached._')
-            await log_channel.send('\n'.join(text), embed=embed, files=files)
+            await self._send_log(log_channels, '\n'.join(text), embed=embed, files=files)
         else:
             text.append(f'\N{PAPERCLIP} _Removed attachments could not be found._')
-            await log_channel.send('\n'.join(text), embed=embed)
+            await self._send_log(log_channels, '\n'.join(text), embed=embed)
 
     @commands.Cog.listener()
     async def on_member_join(self, member: discord.Member):
-        if member.guild.id not in self.configs:
+        log_channels = await self._log_channels(member.guild.id, 'member_join')
+        if not log_channels:
             return
 
-        guild_config = self.configs[member.guild.id]
-
-        for log_channel_id, log_channel_config in guild_config.items():
-            if not log_channel_config.get('member_join', False):
-                continue
-            log_channel = self.bot.get_channel(log_channel_id)
-            if not isinstance(log_channel, discord.TextChannel):
-                continue
-            if log_channel.guild != member.guild:
-                continue
-
-            await self._log_member_join(log_channel, member)
+        await self._log_member_join(log_channels, member)
 
-    async def _log_member_join(self, log_channel: discord.TextChannel, member: discord.Member, /):
+    async def _log_member_join(self, log_channels: tuple[discord.TextChannel, ...], member: discord.Member, /):
         embed = discord.Embed(
             colour=id_colour(member.id),
         ).set_author(
@@ -520,7 +659,8 @@ class Logs(commands.Cog):
         else:
             header = '\N{WAVING HAND SIGN} MEMBER JOINED'
 
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             f'**{header}**\n'
             f'{member.mention}',
             embed=embed,
@@ -528,23 +668,13 @@ class Logs(commands.Cog):
 
     @commands.Cog.listener()
     async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent) -> None:
-        if payload.guild_id not in self.configs:
+        log_channels = await self._log_channels(payload.guild_id, 'member_remove')
+        if not log_channels:
             return
 
-        guild_config = self.configs[payload.guild_id]
-
-        for log_channel_id, log_channel_config in guild_config.items():
-            if not log_channel_config.get('member_remove', False):
-                continue
-            log_channel = self.bot.get_channel(log_channel_id)
-            if not isinstance(log_channel, discord.TextChannel):
-                continue
-            if log_channel.guild.id != payload.guild_id:
-                continue
-
-            await self._log_member_remove(log_channel, payload.user)
+        await self._log_member_remove(log_channels, payload.user)
 
-    async def _log_member_remove(self, log_channel: discord.TextChannel, user: discord.User | discord.Member, /):
+    async def _log_member_remove(self, log_channels: tuple[discord.TextChannel, ...], user: discord.User | discord.Member, /):
         embed = discord.Embed(
             colour=id_colour(user.id),
         ).set_author(
@@ -562,7 +692,7 @@ class Logs(commands.Cog):
 
         embed.add_field(
             name='Server now has',
-            value=f'{log_channel.guild.member_count} members',
+            value=f'{log_channels[0].guild.member_count} members',
         ).set_footer(
             text=id_tags(user_id=user.id),
         )
@@ -572,31 +702,44 @@ class Logs(commands.Cog):
         else:
             header = '\N{DOOR} MEMBER REMOVED'
 
-        await log_channel.send(
+        await self._send_log(
+            log_channels,
             f'**{header}**\n'
             f'{user.mention}',
             embed=embed,
         )
 
-    def load_log_configs(self):
-        """Load log configurations for each guild."""
-        for filename in os.listdir('logs/'):
-            if filename.endswith('.json'):
-                with open(f'logs/{filename}', 'r') as file:
-                    json_data: dict[str, dict[str, bool]] = json.load(file)
+    def save_log_config(self, guild_id: int, /):
+        """Start logging by the log configurations of a guild, and save them shortly."""
+        self._update_routes(guild_id)
 
-                config = {int(key): value for key, value in json_data.items()}
+        self._unsaved_guild_ids.add(guild_id)
+        if self._config_save_task is None or self._config_save_task.done():
+            self._config_save_task = asyncio.get_running_loop().create_task(self._save_log_configs_later())
 
-                guild_id = int(filename[:-5])
-                self.configs[guild_id] = config
+    async def _save_log_configs_later(self) -> None:
+        await asyncio.sleep(LOG_CONFIG_SAVE_DELAY)
+        await self._save_log_configs()
 
-    def save_log_config(self, guild_id: int, /):
-        """Save log configurations for a guild."""
-        config = self.configs[guild_id]
-        json_data = {str(key): value for key, value in config.items()}
+    async def _save_log_configs(self) -> None:
+        """Save the configs of every guild that changed since the last save, in one transaction."""
+        if not self._unsaved_guild_ids:
+            return
+
+        guild_ids = self._unsaved_guild_ids
+        self._unsaved_guild_ids = set()
+        # Serialised now, since the configs can keep changing while they're being written
+        rows = [
+            (channel_id, guild_id, json.dumps(items))
+            for guild_id in guild_ids
+            for channel_id, items in self.configs.get(guild_id, {}).items()
+        ]
 
-        with open(f'logs/{guild_id}.json', 'w') as file:
-            json.dump(json_data, file, indent=4)
+        try:
+            await self._db.write(functools.partial(_replace_log_configs, list(guild_ids), rows))
+        except sqlite3.Error:
+            logging.exception('Failed to save the log configs of %s guilds', len(guild_ids))
+            self._unsaved_guild_ids |= guild_ids
 
     @commands.guild_only()
     #@commands.hybrid_group()
@@ -765,6 +908,187 @@ class Logs(commands.Cog):
 
         await interface.reply(ctx, f'Enabled logs for {channel.mention}: {', '.join(items)}.')
 
+    @log.command()
+    @commands.is_owner()
+    async def queue(self, ctx: commands.Context[commands.Bot]) -> None:
+        """Show how many log messages are waiting to be sent, and how long they have been taking."""
+        sender = self._log_sender
+        latencies = sorted(sender.latencies)
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[int(len(latencies) * 0.95)]
+            latency = f'Latency of the last {len(latencies)} log messages: {p50:.2f}s median, {p95:.2f}s 95th percentile.'
+        else:
+            latency = 'No log messages sent yet.'
+
+        await interface.reply(
+            ctx,
+            f'{sender.depth()} log messages queued in {sender.busy_channels()} channels. '
+            f'{sender.sent_entries} log messages sent in {sender.sent_messages} messages. {latency}',
+        )
+
+class LogSender:
+    """Sends log messages in the background, with a queue for each log channel.
+
+    Log messages without files that are queued close together are packed into
+    as few Discord messages as possible, so a burst of events doesn't cost a send each.
+    Only log messages that all have an embed, or that all have none, are packed together,
+    so the headers in a packed message are in the same order as its embeds.
+    Up to LOG_SEND_CONCURRENCY log channels are sent to at once, a failed send only
+    affects its own channel, and nothing that queues a log message waits on Discord's rate limits.
+    """
+
+    def __init__(self):
+        # Each entry is the content, embed and files of a log message, and when it was queued.
+        self._queues: dict[int, collections.deque[tuple[str, discord.Embed | None, list[discord.File], float]]] = {}
+        self._tasks: dict[int, asyncio.Task[None]] = {}
+        self._send_slots = asyncio.Semaphore(LOG_SEND_CONCURRENCY)
+
+        self.sent_messages = 0
+        self.sent_entries = 0
+        # Seconds from queueing a log message until it was sent
+        self.latencies: collections.deque[float] = collections.deque(maxlen=LOG_LATENCY_SAMPLES)
+
+        REGISTRY.counter('logs_sent_messages_total', 'Discord messages sent to log channels.',
+                         function=lambda: self.sent_messages)
+        REGISTRY.counter('logs_sent_entries_total', 'Log messages sent, several of which can share a Discord message.',
+                         function=lambda: self.sent_entries)
+        REGISTRY.gauge('logs_queue_depth', 'Log messages waiting to be sent.', function=self.depth)
+        REGISTRY.gauge('logs_busy_channels', 'Log channels with log messages waiting to be sent.', function=self.busy_channels)
+        self._send_failures = REGISTRY.counter('logs_send_failures_total', 'Discord messages to log channels that failed to send.')
+        self._delivery_seconds = REGISTRY.histogram('logs_delivery_seconds', 'Time from queueing each log message until it was sent.')
+
+    def depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def busy_channels(self) -> int:
+        return sum(1 for queue in self._queues.values() if queue)
+
+    def send(
+        self, channel: discord.TextChannel, content: str, /,
+        *, embed: discord.Embed | None = None,
+        files: list[discord.File] | None = None,
+    ) -> None:
+        """Queue a log message to be sent to channel."""
+        queue = self._queues.setdefault(channel.id, collections.deque())
+        queue.append((content, embed, files or [], time.monotonic()))
+
+        task = self._tasks.get(channel.id)
+        if task is None or task.done():
+            self._tasks[channel.id] = asyncio.get_running_loop().create_task(self._send_worker(channel, queue))
+
+    async def close(self) -> None:
+        """Send the queued log messages, waiting at most LOG_CLOSE_TIMEOUT seconds, and drop the rest."""
+        tasks = [task for task in self._tasks.values() if not task.done()]
+        if tasks:
+            _, pending = await asyncio.wait(tasks, timeout=LOG_CLOSE_TIMEOUT)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        dropped = 0
+        for queue in self._queues.values():
+            for _, _, files, _ in queue:
+                for file in files:
+                    file.close()
+            dropped += len(queue)
+            queue.clear()
+        if dropped:
+            logging.warning('Dropped %s log messages that could not be sent in time', dropped)
+
+    async def _send_worker(self, channel: discord.TextChannel, queue: collections.deque[tuple[str, discord.Embed | None, list[discord.File], float]], /) -> None:
+        # Stops once the queue is empty, send() starts a new one when it's needed again
+        while queue:
+            await asyncio.sleep(LOG_BATCH_DELAY)
+            while queue:
+                batch = _take_log_batch(queue)
+                content = '\n'.join(entry[0] for entry in batch)
+                embeds = [entry[1] for entry in batch if entry[1] is not None]
+                files = [file for entry in batch for file in entry[2]]
+
+                try:
+                    async with self._send_slots:
+                        await channel.send(content, embeds=embeds, files=files)
+                except discord.HTTPException as e:
+                    logging.warning('Failed to send %s log messages to channel %s: %s', len(batch), channel.id, e)
+                    self._send_failures.inc()
+                    continue
+                except Exception:
+                    logging.exception('Unexpected error sending %s log messages to channel %s', len(batch), channel.id)
+                    self._send_failures.inc()
+                    continue
+                finally:
+                    # discord.py doesn't close them if the send fails before its request, or is cancelled waiting for a slot
+                    for file in files:
+                        file.close()
+
+                now = time.monotonic()
+                self.sent_messages += 1
+                self.sent_entries += len(batch)
+                for entry in batch:
+                    self.latencies.append(now - entry[3])
+                    self._delivery_seconds.observe(now - entry[3])
+
+
+def _create_tables(connection: sqlite3.Connection, /) -> None:
+    connection.execute("""
+            CREATE TABLE IF NOT EXISTS "log_channels" (
+                "channel_id" INTEGER PRIMARY KEY NOT NULL,
+                "guild_id" INTEGER NOT NULL,
+                "items" TEXT NOT NULL
+            );
+        """)
+    connection.execute("""
+            CREATE INDEX IF NOT EXISTS "log_channels_guild_id"
+            ON "log_channels" ("guild_id");
+        """)
+
+def _import_json_configs(directory: str, connection: sqlite3.Connection, /) -> list[str]:
+    """Import the configs that used to be stored as {directory}/{guild}.json. Returns the paths of the imported files."""
+    if not os.path.isdir(directory):
+        return []
+
+    paths: list[str] = []
+    rows: list[tuple[int, int, str]] = []
+    guild_ids: list[int] = []
+    for filename in os.listdir(directory):
+        guild_id, extension = os.path.splitext(filename)
+        if extension != '.json' or not guild_id.isdigit():
+            continue
+
+        path = os.path.join(directory, filename)
+        with open(path, 'r') as file:
+            json_data: dict[str, dict[str, bool]] = json.load(file)
+        rows.extend((int(channel_id), int(guild_id), json.dumps(items)) for channel_id, items in json_data.items())
+        guild_ids.append(int(guild_id))
+        paths.append(path)
+
+    _replace_log_configs(guild_ids, rows, connection)
+    return paths
+
+def _get_log_config(guild_id: int, connection: sqlite3.Connection, /) -> dict[int, dict[str, bool]]:
+    cursor = connection.execute("""
+            SELECT "channel_id", "items"
+            FROM "log_channels"
+            WHERE "guild_id" = ?
+        """,
+        (guild_id,),
+    )
+    return {channel_id: json.loads(items) for channel_id, items in cursor}
+
+def _replace_log_configs(guild_ids: list[int], rows: list[tuple[int, int, str]], connection: sqlite3.Connection, /) -> None:
+    connection.executemany("""
+            DELETE FROM "log_channels"
+            WHERE "guild_id" = ?
+        """,
+        [(guild_id,) for guild_id in guild_ids],
+    )
+    connection.executemany("""
+            INSERT OR REPLACE INTO "log_channels" ("channel_id", "guild_id", "items")
+            VALUES (?, ?, ?)
+        """,
+        rows,
+    )
 
 def id_tags(
     *,
@@ -781,6 +1105,102 @@ def id_tags(
         ids.append(f'\N{TELEVISION}{channel_id}')
     return ' '.join(ids)
 
+def _take_log_batch(queue: collections.deque[tuple[str, discord.Embed | None, list[discord.File], float]], /) -> list[tuple[str, discord.Embed | None, list[discord.File], float]]:
+    """Take as many log messages from the front of queue as fit in one Discord message.
+    Log messages with files are always sent on their own. The others are only taken together with
+    log messages that also have an embed, or that also have none, so each header goes with the embed in its place.
+    """
+    batch = [queue.popleft()]
+    if batch[0][2]:
+        return batch
+
+    content_length = len(batch[0][0])
+    embed_count = 1 if batch[0][1] is not None else 0
+    embeds_length = len(batch[0][1]) if batch[0][1] is not None else 0
+    while queue:
+        content, embed, files, _ = queue[0]
+        if files:
+            break
+        if (embed is None) != (batch[0][1] is None):
+            break
+        if content_length + 1 + len(content) > MAX_CONTENT_LENGTH:
+            break
+        if embed is not None and (embed_count >= MAX_EMBEDS_PER_MESSAGE or embeds_length + len(embed) > MAX_EMBEDS_LENGTH):
+            break
+
+        batch.append(queue.popleft())
+        content_length += 1 + len(content)
+        if embed is not None:
+            embed_count += 1
+            embeds_length += len(embed)
+
+    return batch
+
+def bulk_delete_transcript(message_ids: list[int], cached: dict[int, discord.Message], stored: dict[int, dict[str, Any]], /) -> str:
+    """Write out deleted messages as plain text, from either discord.py's cache or the history."""
+    lines: list[str] = []
+    for message_id in message_ids:
+        sent_at = discord.utils.snowflake_time(message_id).strftime('%Y-%m-%d %H:%M:%S UTC')
+
+        if message_id in cached:
+            message = cached[message_id]
+            author = f'{message.author.display_name} ({message.author.id})'
+            content = message.content
+            attachments = [(attachment.id, attachment.filename) for attachment in message.attachments]
+        elif message_id in stored:
+            data = stored[message_id]
+            author_data: dict[str, Any] = data['author']
+            author = f'{author_data.get('global_name') or author_data['username']} ({author_data['id']})'
+            stored_content: str = data['content']
+            content = stored_content
+            attachments = [(int(attachment['id']), attachment['filename']) for attachment in data['attachments']]
+        else:
+            lines.append(f'[{sent_at}] Unknown author, message {message_id}: content unknown')
+            lines.append('')
+            continue
+
+        lines.append(f'[{sent_at}] {author}, message {message_id}:')
+        if content:
+            lines.append(content)
+        for attachment_id, filename in attachments:
+            lines.append(f'  Attachment {attachment_id}: {filename}')
+        lines.append('')
+
+    return '\n'.join(lines)
+
+def copy_files(files: list[discord.File], count: int, /) -> list[list[discord.File]]:
+    """Make count separate sets of files, each of which can be sent on its own, in the same order.
+    Files on disk are opened again for each set instead of being read into memory,
+    and the sets share one copy of the contents of the others. The originals are closed.
+    """
+    copies: list[list[discord.File]] = [[] for _ in range(count)]
+    for file in files:
+        path = getattr(file.fp, 'name', None)
+        if isinstance(path, str):
+            for copy in copies:
+                copy.append(discord.File(path, file.filename, description=file.description))
+        else:
+            file.reset()
+            # Every BytesIO made from the same bytes shares them until it's written to
+            data = file.fp.read()
+            for copy in copies:
+                copy.append(discord.File(io.BytesIO(data), file.filename, description=file.description))
+        file.close()
+    return copies
+
+def pack_files(files: list[discord.File], size_limit: int, /) -> list[list[discord.File]]:
+    """Split files into as few messages' worth as possible, in order, keeping within Discord's limits."""
+    batches: list[list[discord.File]] = []
+    batch_size = 0
+    for file in files:
+        size = os.fstat(file.fp.fileno()).st_size
+        if not batches or len(batches[-1]) >= MAX_FILES_PER_MESSAGE or batch_size + size > size_limit:
+            batches.append([])
+            batch_size = 0
+        batches[-1].append(file)
+        batch_size += size
+    return batches
+
 def get_colour(user: discord.User | discord.Member, /) -> discord.Colour | None:
     if user.colour == discord.Colour.default():
         return None
@@ -0,0 +1,129 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+import asyncio
+import interface
+import logging
+from discord.ext import commands
+from main import BotClient, BotConfig
+from metrics import REGISTRY
+
+# Longest "b!stats" reply, leaving room for the code block around it
+MAX_STATS_LENGTH = 1900
+
+RATE_LIMITED = REGISTRY.counter('discord_rate_limited_total', '429 responses from Discord, across every route.', scope='route')
+GLOBAL_RATE_LIMITED = REGISTRY.counter('discord_rate_limited_total', '429 responses from Discord, across every route.', scope='global')
+
+class RateLimitCounter(logging.Filter):
+    """Counts the 429 responses that discord.py logs on the discord.http logger.
+    discord.py retries them on its own, so its log is the only place they show up.
+
+    Every 429 is logged as "responded with 429", and a global one is then logged again as
+    "Global rate limit" without an await in between. So a route 429 is only counted once the
+    event loop gets to run something else, unless the global record came first and took its place.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._route_count: asyncio.Handle | None = None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if isinstance(record.msg, str):
+            if 'Global rate limit' in record.msg:
+                if self._route_count is not None:
+                    self._route_count.cancel()
+                    self._route_count = None
+                GLOBAL_RATE_LIMITED.inc()
+            elif 'responded with 429' in record.msg:
+                try:
+                    self._route_count = asyncio.get_running_loop().call_soon(self._count_route)
+                except RuntimeError:
+                    # Not logged from the event loop, so there's no global record to wait for
+                    RATE_LIMITED.inc()
+        return True
+
+    def _count_route(self) -> None:
+        self._route_count = None
+        RATE_LIMITED.inc()
+
+class Stats(commands.Cog):
+    def __init__(self, bot: BotClient):
+        self.bot = bot
+        self._rate_limit_counter = RateLimitCounter()
+        self._server: asyncio.Server | None = None
+
+        REGISTRY.gauge('discord_gateway_latency_seconds', 'Time between a gateway heartbeat and its acknowledgement.',
+                       function=lambda: self.bot.latency)
+
+    async def cog_load(self) -> None:
+        logging.getLogger('discord.http').addFilter(self._rate_limit_counter)
+        await self._start_server()
+
+    async def cog_unload(self) -> None:
+        logging.getLogger('discord.http').removeFilter(self._rate_limit_counter)
+        await self._stop_server()
+
+    async def _start_server(self) -> None:
+        port = self.bot.metrics_port()
+        if not port:
+            return
+
+        try:
+            self._server = await asyncio.start_server(_serve_metrics, '127.0.0.1', port)
+        except OSError as e:
+            logging.warning('Could not serve metrics on port %s: %s', port, e)
+
+    async def _stop_server(self) -> None:
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    @commands.Cog.listener()
+    async def on_config_reload(self, old_configs: BotConfig) -> None:
+        if old_configs['metrics_port'] != self.bot.metrics_port():
+            await self._stop_server()
+            await self._start_server()
+
+    @commands.is_owner()
+    @commands.command()
+    async def stats(self, ctx: commands.Context[commands.Bot]) -> None:
+        """Show the bot's metrics: what it has stored and sent, its queues, and how long things take."""
+        text = ''
+        for line in REGISTRY.summary():
+            if len(text) + len(line) + 1 > MAX_STATS_LENGTH:
+                text += '...\n'
+                break
+            text += line + '\n'
+        await interface.reply(ctx, f'```\n{text}```')
+
+async def _serve_metrics(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answer a single HTTP request for /metrics in the Prometheus text format."""
+    try:
+        request_line = await reader.readline()
+        # The headers don't matter, but they have to be read before answering
+        while (await reader.readline()).strip():
+            pass
+
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status = '200 OK'
+            body = REGISTRY.prometheus_text().encode()
+        else:
+            status = '404 Not Found'
+            body = b'Not found\n'
+
+        writer.write(
+            f'HTTP/1.1 {status}\r\n'
+            f'Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+            f'Content-Length: {len(body)}\r\n'
+            f'Connection: close\r\n\r\n'.encode()
+            + body
+        )
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+async def setup(bot: BotClient):
+    await bot.add_cog(Stats(bot))
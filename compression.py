@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module compresses small, repetitive strings (like stored message JSON)
+using dictionaries trained on samples of them, and writes compressed streams.
+"""
+
+import collections
+import gzip
+import json
+import struct
+import threading
+import zlib
+from typing import Any, BinaryIO, Literal
+
+try:
+    import zstandard
+except ModuleNotFoundError:
+    zstandard = None # type: ignore
+    HAS_ZSTD = False
+else:
+    HAS_ZSTD = True
+
+
+CompressionKind = Literal['none', 'zlib', 'zstd']
+# For turning configured and stored names into a CompressionKind
+COMPRESSION_KINDS: dict[str, CompressionKind] = {'none': 'none', 'zlib': 'zlib', 'zstd': 'zstd'}
+StreamKind = Literal['gzip', 'zstd']
+
+# zlib only looks back this far, so a bigger dictionary is of no use to it.
+ZLIB_DICTIONARY_SIZE = 32 * 1024
+ZSTD_DICTIONARY_SIZE = 112 * 1024
+
+# Encoded values start with one of these, followed by the ID of the dictionary (0 for none).
+_ZLIB_MARKER = b'z'
+_ZSTD_MARKER = b's'
+_HEADER = struct.Struct('<cI')
+
+class Codec:
+    """Encodes strings to compressed bytes, and decodes them back.
+
+    Strings are compressed with the current dictionary, if there is one.
+    Values compressed with any of the known dictionaries can be decoded, and
+    values that were stored uncompressed (as strings) are returned unchanged.
+    A Codec can be shared between threads.
+    """
+
+    def __init__(
+        self, kind: CompressionKind, /,
+        dictionaries: dict[int, tuple[CompressionKind, bytes]] | None = None,
+        current_dictionary_id: int = 0,
+    ):
+        if kind == 'zstd' and zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package')
+
+        self.kind: CompressionKind = kind
+        self.current_dictionary_id = current_dictionary_id
+        self._dictionaries = dictionaries or {}
+        # zstandard's (de)compressors can't be used by several threads at once
+        self._local = threading.local()
+
+    def encode(self, text: str, /) -> str | bytes:
+        if self.kind == 'none':
+            return text
+
+        raw = text.encode()
+        dictionary_id = self.current_dictionary_id
+        if self.kind == 'zlib':
+            compressor = zlib.compressobj(level=9, zdict=self._dictionary(dictionary_id))
+            return _HEADER.pack(_ZLIB_MARKER, dictionary_id) + compressor.compress(raw) + compressor.flush()
+        else:
+            return _HEADER.pack(_ZSTD_MARKER, dictionary_id) + self._zstd_compressor(dictionary_id).compress(raw)
+
+    def decode(self, value: str | bytes, /) -> str:
+        if isinstance(value, str):
+            return value
+
+        marker, dictionary_id = _HEADER.unpack_from(value)
+        payload = memoryview(value)[_HEADER.size:]
+        if marker == _ZLIB_MARKER:
+            decompressor = zlib.decompressobj(zdict=self._dictionary(dictionary_id))
+            raw = decompressor.decompress(payload) + decompressor.flush()
+        elif marker == _ZSTD_MARKER:
+            if zstandard is None:
+                raise RuntimeError('decoding zstd compressed data needs the zstandard package')
+            raw = self._zstd_decompressor(dictionary_id).decompress(payload)
+        else:
+            raise ValueError(f'unknown compression marker {marker!r}')
+
+        return raw.decode()
+
+    def is_current(self, value: str | bytes, /) -> bool:
+        """Whether value is already encoded the way encode() would encode it now."""
+        if isinstance(value, str):
+            return self.kind == 'none'
+
+        marker, dictionary_id = _HEADER.unpack_from(value)
+        expected_marker = {'zlib': _ZLIB_MARKER, 'zstd': _ZSTD_MARKER}.get(self.kind)
+        return marker == expected_marker and dictionary_id == self.current_dictionary_id
+
+    def _dictionary(self, dictionary_id: int, /) -> bytes:
+        if dictionary_id == 0:
+            return b''
+        return self._dictionaries[dictionary_id][1]
+
+    def _zstd_compressor(self, dictionary_id: int, /) -> Any:
+        compressors: dict[int, Any] = self._local.__dict__.setdefault('compressors', {})
+        if dictionary_id not in compressors:
+            dictionary = zstandard.ZstdCompressionDict(self._dictionary(dictionary_id)) if dictionary_id else None # type: ignore
+            compressors[dictionary_id] = zstandard.ZstdCompressor(level=9, dict_data=dictionary) # type: ignore
+        return compressors[dictionary_id]
+
+    def _zstd_decompressor(self, dictionary_id: int, /) -> Any:
+        decompressors: dict[int, Any] = self._local.__dict__.setdefault('decompressors', {})
+        if dictionary_id not in decompressors:
+            dictionary = zstandard.ZstdCompressionDict(self._dictionary(dictionary_id)) if dictionary_id else None # type: ignore
+            decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dictionary) # type: ignore
+        return decompressors[dictionary_id]
+
+def train_dictionary(kind: CompressionKind, samples: list[str], /) -> bytes:
+    """Make a compression dictionary out of samples of the strings that will be compressed."""
+    if kind == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package')
+        encoded: list[Any] = [sample.encode() for sample in samples]
+        return zstandard.train_dictionary(ZSTD_DICTIONARY_SIZE, encoded).as_bytes()
+
+    if kind == 'zlib':
+        return _train_zlib_dictionary(samples)
+
+    raise ValueError(f'{kind} compression does not use dictionaries')
+
+def open_compressed(path: str, kind: StreamKind, /) -> BinaryIO:
+    """Create a file to write a compressed stream to. Closing it finishes the stream."""
+    if kind == 'gzip':
+        return gzip.open(path, 'wb', compresslevel=6) # type: ignore
+    if kind == 'zstd':
+        if zstandard is None:
+            raise RuntimeError('zstd compression needs the zstandard package')
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'), closefd=True)
+
+    raise ValueError(f'unknown stream compression {kind!r}')
+
+def _train_zlib_dictionary(samples: list[str], /) -> bytes:
+    """zlib has no dictionary training of its own. Instead, the dictionary is made of the
+    JSON fragments that are repeated most across samples, with the most common ones last
+    (zlib finds matches near the end of the dictionary with the shortest back-references).
+    """
+    counts: collections.Counter[str] = collections.Counter()
+    for sample in samples:
+        counts.update(set(_json_fragments(json.loads(sample))))
+
+    fragments: list[bytes] = []
+    size = 0
+    for fragment, count in counts.most_common():
+        if count < 2:
+            break
+        encoded = fragment.encode()
+        if size + len(encoded) > ZLIB_DICTIONARY_SIZE:
+            continue
+        fragments.append(encoded)
+        size += len(encoded)
+
+    return b''.join(reversed(fragments))
+
+def _json_fragments(value: Any, /) -> list[str]:
+    """The "key":value pairs of every object in value, as they appear in compact JSON."""
+    fragments: list[str] = []
+    if isinstance(value, dict):
+        for key, item in value.items(): # type: ignore
+            fragments.append(json.dumps({key: item}, separators=(',', ':'), ensure_ascii=False)[1:-1])
+            fragments.extend(_json_fragments(item))
+    elif isinstance(value, list):
+        for item in value: # type: ignore
+            fragments.extend(_json_fragments(item))
+    return fragments
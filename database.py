@@ -0,0 +1,155 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module runs blocking SQLite work on dedicated threads,
+so the event loop never waits on the database.
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import queue
+import sqlite3
+import threading
+import time
+from typing import Callable, TypedDict, TypeVar
+
+from metrics import REGISTRY
+
+T = TypeVar('T')
+
+class Profile(TypedDict):
+    """Performance settings for every connection to a database (see https://sqlite.org/pragma.html)."""
+    # "wal" lets reads go on while a write is committing, "delete" is SQLite's default.
+    journal_mode: str
+    # "normal" only syncs to disk at WAL checkpoints, "full" syncs on every commit.
+    synchronous: str
+    # Pages kept in memory by each connection.
+    cache_size_mib: int
+    # How much of the file each connection reads through a memory map instead of read calls. 0 to disable.
+    mmap_size_mib: int
+
+JOURNAL_MODES = ('delete', 'truncate', 'persist', 'memory', 'wal', 'off')
+SYNCHRONOUS_LEVELS = ('off', 'normal', 'full', 'extra')
+
+def apply_profile(connection: sqlite3.Connection, profile: Profile, /) -> None:
+    """Apply profile to connection, which must not be in a transaction."""
+    if profile['journal_mode'] not in JOURNAL_MODES:
+        raise ValueError(f'unknown journal mode {profile["journal_mode"]!r}')
+    if profile['synchronous'] not in SYNCHRONOUS_LEVELS:
+        raise ValueError(f'unknown synchronous level {profile["synchronous"]!r}')
+
+    connection.execute(f'PRAGMA journal_mode = {profile["journal_mode"]};')
+    connection.execute(f'PRAGMA synchronous = {profile["synchronous"]};')
+    # A negative cache size is in KiB rather than pages
+    connection.execute(f'PRAGMA cache_size = {-int(profile["cache_size_mib"]) * 1024};')
+    connection.execute(f'PRAGMA mmap_size = {int(profile["mmap_size_mib"]) * 1024 * 1024};')
+
+class Database:
+    """A SQLite database with a single writer thread and a pool of reader threads.
+
+    Writes run one at a time on the writer connection, in the order they were
+    submitted, and each one is its own transaction. Reads run on separate
+    connections, so they only see committed data.
+
+    At most max_pending writes can be waiting for the writer at once. Beyond
+    that, write() waits for room, so callers slow down instead of queueing an
+    unbounded amount of work.
+    """
+
+    def __init__(
+        self, path: str, /, *,
+        readers: int = 4,
+        max_pending: int = 64,
+        on_connect: Callable[[sqlite3.Connection], None] | None = None,
+    ):
+        self._path = path
+        self._on_connect = on_connect
+
+        name = os.path.basename(path)
+        self._transaction_seconds = REGISTRY.histogram(
+            'database_transaction_seconds', 'Time each write took to run and commit.', database=name)
+        self._read_seconds = REGISTRY.histogram(
+            'database_read_seconds', 'Time each read took, including waiting for a reader.', database=name)
+
+        self._write_slots = asyncio.Semaphore(max_pending)
+        self._writes: queue.SimpleQueue[tuple[Callable[[sqlite3.Connection], object], concurrent.futures.Future[object]] | None] = queue.SimpleQueue()
+        self._writer = threading.Thread(target=self._write_worker, name=f'sqlite writer {path}', daemon=True)
+        self._writer.start()
+        REGISTRY.gauge('database_pending_writes', 'Writes waiting for the writer thread.',
+                       function=self._writes.qsize, database=name)
+
+        self._reader_connections: list[sqlite3.Connection] = []
+        self._reader_lock = threading.Lock()
+        self._local = threading.local()
+        self._readers = concurrent.futures.ThreadPoolExecutor(
+            max_workers=readers,
+            thread_name_prefix=f'sqlite reader {path}',
+            initializer=self._open_reader,
+        )
+
+    def _connect(self, *, autocommit: bool) -> sqlite3.Connection:
+        # Outside of autocommit, a transaction is always open, and some PRAGMAs
+        # (like foreign_keys and journal_mode) do nothing or fail inside one.
+        connection = sqlite3.connect(self._path, autocommit=True, check_same_thread=False)
+        if self._on_connect is not None:
+            self._on_connect(connection)
+        connection.autocommit = autocommit
+        return connection
+
+    def _write_worker(self) -> None:
+        connection = self._connect(autocommit=False)
+        try:
+            while (item := self._writes.get()) is not None:
+                function, future = item
+                if not future.set_running_or_notify_cancel():
+                    continue
+
+                start = time.perf_counter()
+                try:
+                    result = function(connection)
+                    connection.commit()
+                except BaseException as e:
+                    connection.rollback()
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+                self._transaction_seconds.observe(time.perf_counter() - start)
+        finally:
+            connection.close()
+
+    def _open_reader(self) -> None:
+        connection = self._connect(autocommit=True)
+        self._local.connection = connection
+        with self._reader_lock:
+            self._reader_connections.append(connection)
+
+    def _run_read(self, function: Callable[[sqlite3.Connection], T], /) -> T:
+        return function(self._local.connection)
+
+    async def write(self, function: Callable[[sqlite3.Connection], T], /) -> T:
+        """Run function with the writer connection and commit, or roll back if it raises."""
+        async with self._write_slots:
+            future: concurrent.futures.Future[T] = concurrent.futures.Future()
+            self._writes.put((function, future)) # type: ignore
+            return await asyncio.wrap_future(future)
+
+    async def read(self, function: Callable[[sqlite3.Connection], T], /) -> T:
+        """Run function with one of the reader connections."""
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._readers, self._run_read, function)
+        finally:
+            self._read_seconds.observe(time.perf_counter() - start)
+
+    async def close(self) -> None:
+        """Finish all submitted work, then close every connection."""
+        self._writes.put(None)
+        await asyncio.to_thread(self._writer.join)
+        await asyncio.to_thread(self._readers.shutdown)
+
+        with self._reader_lock:
+            for connection in self._reader_connections:
+                connection.close()
+            self._reader_connections.clear()
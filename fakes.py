@@ -0,0 +1,195 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module fakes Discord for the tests and benchmarks: gateway payloads of
+a generated guild, and a stub that answers the API requests the cogs make.
+Install the stub with interface.stub_http, and nothing goes over the network.
+"""
+
+import asyncio
+import bisect
+import collections
+import datetime
+import discord
+import discord.http
+import random
+from typing import Any
+
+BOT_USER_ID = 900000000000000001
+GUILD_ID = 900000000000000002
+LOG_CHANNEL_ID = 900000000000000003
+FIRST_CHANNEL_ID = 900000000000001000
+FIRST_USER_ID = 900000000000100000
+
+WORDS = 'the a discord bot message log history moderation server channel user hello lol ok yes no thanks please'.split()
+
+class _Response:
+    """Enough of an aiohttp response for discord.HTTPException."""
+
+    def __init__(self, status: int, reason: str):
+        self.status = status
+        self.reason = reason
+
+class StubHTTP:
+    """Answers the requests the cogs make the way Discord would, after latency seconds.
+
+    History fetches are served from backfill (channel ID -> messages, oldest first).
+    Sent messages are counted and echoed back, and user lookups find nobody.
+    Attachments are downloaded from cdn (URL -> contents), and any other URL isn't found.
+    """
+
+    def __init__(self, latency: float, backfill: dict[int, list[dict[str, Any]]]):
+        self.latency = latency
+        self.requests: collections.Counter[str] = collections.Counter()
+        self._backfill = backfill
+        self._backfill_ids = {channel_id: [int(data['id']) for data in messages] for channel_id, messages in backfill.items()}
+        self._next_message_id = discord.utils.time_snowflake(datetime.datetime.now(datetime.timezone.utc))
+        self.cdn: dict[str, bytes] = {}
+
+    async def request(self, route: discord.http.Route, **kwargs: Any) -> Any:
+        self.requests[route.key] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if route.method == 'GET' and route.path == '/channels/{channel_id}/messages':
+            params: dict[str, Any] = kwargs.get('params', {})
+            channel_id = int(route.channel_id) # type: ignore
+            start = bisect.bisect_right(self._backfill_ids.get(channel_id, []), int(params.get('after', 0)))
+            # Discord returns the messages right after "after", newest first
+            return self._backfill.get(channel_id, [])[start:start + params['limit']][::-1]
+
+        if route.method == 'POST' and route.path == '/channels/{channel_id}/messages':
+            self._next_message_id += 1
+            return message_data(self._next_message_id, int(route.channel_id), user_data(BOT_USER_ID), '') # type: ignore
+
+        if route.path == '/users/{user_id}':
+            raise discord.NotFound(_Response(404, 'Not Found'), {'code': 10013, 'message': 'Unknown User'}) # type: ignore
+
+        return {}
+
+    async def get_from_cdn(self, url: str) -> bytes:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if url not in self.cdn:
+            raise discord.NotFound(_Response(404, 'Not Found'), 'Not Found') # type: ignore
+        return self.cdn[url]
+
+def user_data(user_id: int, /) -> dict[str, Any]:
+    return {
+        'id': str(user_id),
+        'username': f'user{user_id % 100000}',
+        'global_name': None,
+        'discriminator': '0',
+        'avatar': None,
+        'bot': user_id == BOT_USER_ID,
+    }
+
+def member_data(user_id: int, /) -> dict[str, Any]:
+    return {
+        'user': user_data(user_id),
+        'roles': [],
+        'joined_at': '2024-01-01T00:00:00+00:00',
+        'deaf': False,
+        'mute': False,
+        'flags': 0,
+    }
+
+def message_data(message_id: int, channel_id: int, author: dict[str, Any], content: str, /) -> dict[str, Any]:
+    return {
+        'id': str(message_id),
+        'channel_id': str(channel_id),
+        'author': author,
+        'content': content,
+        'timestamp': discord.utils.snowflake_time(message_id).isoformat(),
+        'edited_timestamp': None,
+        'tts': False,
+        'mention_everyone': False,
+        'mentions': [],
+        'mention_roles': [],
+        'attachments': [],
+        'embeds': [],
+        'pinned': False,
+        'type': 0,
+        'flags': 0,
+    }
+
+def gateway_frame(event: str, data: dict[str, Any], /) -> dict[str, Any]:
+    # Discord puts "t" first, which History relies on to skip most frames cheaply
+    return {'t': event, 's': None, 'op': 0, 'd': data}
+
+def synthetic_traffic(
+    messages: int, channels: int, users: int, backfill: int, seed: int, /,
+) -> tuple[list[dict[str, Any]], dict[int, list[dict[str, Any]]]]:
+    """Generate gateway traffic for one guild, and the history of its channels from before it."""
+    rng = random.Random(seed)
+    channel_ids = [FIRST_CHANNEL_ID + i for i in range(channels)]
+    user_ids = [FIRST_USER_ID + i for i in range(users)]
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def content() -> str:
+        return ' '.join(rng.choices(WORDS, k=rng.randint(3, 30)))
+
+    history: dict[int, list[dict[str, Any]]] = {channel_id: [] for channel_id in channel_ids}
+    for i in range(backfill):
+        message_id = discord.utils.time_snowflake(start + datetime.timedelta(seconds=i))
+        channel_id = rng.choice(channel_ids)
+        history[channel_id].append(message_data(message_id, channel_id, user_data(rng.choice(user_ids)), content()))
+
+    frames = [gateway_frame('GUILD_CREATE', {
+        'id': str(GUILD_ID),
+        'name': 'Replay',
+        'owner_id': str(BOT_USER_ID),
+        'roles': [{
+            'id': str(GUILD_ID),
+            'name': '@everyone',
+            'permissions': str(discord.Permissions.all().value),
+            'position': 0,
+            'color': 0,
+            'hoist': False,
+            'managed': False,
+            'mentionable': False,
+            'flags': 0,
+        }],
+        'channels': [
+            {'id': str(channel_id), 'type': 0, 'name': f'channel-{channel_id}', 'position': i, 'permission_overwrites': []}
+            for i, channel_id in enumerate([LOG_CHANNEL_ID, *channel_ids])
+        ],
+        'members': [member_data(BOT_USER_ID), *(member_data(user_id) for user_id in user_ids)],
+        'member_count': users + 1,
+        'large': False,
+        'threads': [],
+        'emojis': [],
+        'stickers': [],
+        'features': [],
+        'presences': [],
+        'voice_states': [],
+    })]
+
+    live_start = start + datetime.timedelta(seconds=backfill + 1)
+    recent: dict[int, collections.deque[dict[str, Any]]] = {channel_id: collections.deque(maxlen=200) for channel_id in channel_ids}
+    for i in range(messages):
+        message_id = discord.utils.time_snowflake(live_start + datetime.timedelta(milliseconds=10 * i))
+        channel_id = rng.choice(channel_ids)
+        data = message_data(message_id, channel_id, user_data(rng.choice(user_ids)), content())
+        frames.append(gateway_frame('MESSAGE_CREATE', {**data, 'guild_id': str(GUILD_ID), 'member': member_data(int(data['author']['id']))}))
+        recent[channel_id].append(data)
+
+        roll = rng.random()
+        if roll < 0.10:
+            edited = rng.choice(recent[channel_id])
+            edited['content'] = content()
+            edited['edited_timestamp'] = discord.utils.snowflake_time(message_id).isoformat()
+            frames.append(gateway_frame('MESSAGE_UPDATE', {**edited, 'guild_id': str(GUILD_ID)}))
+        elif roll < 0.15 and len(recent[channel_id]) > 1:
+            deleted = recent[channel_id].popleft()
+            frames.append(gateway_frame('MESSAGE_DELETE', {'id': deleted['id'], 'channel_id': str(channel_id), 'guild_id': str(GUILD_ID)}))
+        elif roll < 0.152:
+            deleted_ids = [recent[channel_id].popleft()['id'] for _ in range(min(50, len(recent[channel_id]) - 1))]
+            if deleted_ids:
+                frames.append(gateway_frame('MESSAGE_DELETE_BULK', {'ids': deleted_ids, 'channel_id': str(channel_id), 'guild_id': str(GUILD_ID)}))
+        elif roll < 0.16:
+            user_id = rng.choice(user_ids)
+            frames.append(gateway_frame('GUILD_MEMBER_REMOVE', {'guild_id': str(GUILD_ID), 'user': user_data(user_id)}))
+            frames.append(gateway_frame('GUILD_MEMBER_ADD', {**member_data(user_id), 'guild_id': str(GUILD_ID)}))
+
+    return frames, history
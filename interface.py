@@ -5,7 +5,38 @@ This module is a wrapper around all discord.py functions,
 so it can be mocked for testing.
 """
 
+import contextvars
+import discord
+import functools
 from discord.ext import commands
+from typing import Any
+
+# True while one of our own messages is being sent. discord.py builds a Message
+# out of the API response of a send, and hooks on message creation use this to
+# tell those apart from messages that were fetched.
+sending_message: contextvars.ContextVar[bool] = contextvars.ContextVar('sending_message', default=False)
+
+def mark_sends() -> None:
+    """Wrap discord.abc.Messageable.send so that sending_message is set while it runs.
+
+    Every way of sending a message in discord.py (including Context.send and
+    Message.reply) goes through Messageable.send. Calling this more than once
+    has no further effect.
+    """
+    original_send = discord.abc.Messageable.send
+    if getattr(original_send, '__marks_sending__', False):
+        return
+
+    @functools.wraps(original_send)
+    async def marked_send(self: discord.abc.Messageable, *args: Any, **kwargs: Any) -> discord.Message:
+        token = sending_message.set(True)
+        try:
+            return await original_send(self, *args, **kwargs)
+        finally:
+            sending_message.reset(token)
+
+    marked_send.__marks_sending__ = True # type: ignore
+    discord.abc.Messageable.send = marked_send # type: ignore
 
 async def send(ctx: commands.Context[commands.Bot], content: str) -> None:
     """Sends a message to the given context with only text content."""
@@ -13,4 +44,11 @@ async def send(ctx: commands.Context[commands.Bot], content: str) -> None:
 
 async def reply(ctx: commands.Context[commands.Bot], content: str) -> None:
     """Sends a reply to the given context with only text content."""
-    await ctx.send(content, reference=ctx.message)
\ No newline at end of file
+    await ctx.send(content, reference=ctx.message)
+
+def stub_http(bot: commands.Bot, stub: Any, /) -> None:
+    """Answer the Discord API requests and CDN downloads of bot with the request and get_from_cdn
+    methods of stub (like fakes.StubHTTP's), instead of over the network.
+    """
+    bot.http.request = stub.request # type: ignore
+    bot.http.get_from_cdn = stub.get_from_cdn # type: ignore
@@ -1,19 +1,56 @@
 # SPDX-License-Identifier: AGPL-3.0-only
 
+import database
 import discord
-import inspect
+import interface
 import json
 from discord.ext import commands
 from typing import Any, Callable, TypedDict
 
 
 class BotConfig(TypedDict):
+    # Read from config.json, and again on "b!config reload". Settings that start
+    # workers or open databases only take effect when the bot restarts.
+
     # All history is disabled for these guilds.
     history_disabled_guilds: list[int]
 
     # History fetching is disabled, but new messages will still be recorded.
     history_fetching_disabled_guilds: list[int]
 
+    # How many channels can have their history fetched at the same time.
+    history_fetch_workers: int
+
+    # How many history requests can be made per second, across all channels.
+    # This should stay well below Discord's global rate limit of 50 requests per second,
+    # so that history fetching doesn't starve everything else.
+    history_fetch_requests_per_second: float
+
+    # How many attachments can be downloaded at the same time.
+    attachment_download_workers: int
+
+    # How stored message JSON is compressed: "none", "zlib" or "zstd" (needs the zstandard package).
+    # Only new messages are affected, the "history compact" command converts the rest.
+    history_compression: str
+
+    # How many recently written or looked up messages are kept in memory for quick lookups.
+    # "b!history cache" shows how often lookups find what they need there.
+    history_message_cache_size: int
+
+    # SQLite settings of the history database, see database.Profile.
+    history_journal_mode: str
+    history_synchronous: str
+    history_cache_size_mib: int
+    history_mmap_size_mib: int
+
+    # How often (in seconds) the history database's write-ahead log is written back
+    # into it and its query planner statistics are refreshed. 0 to never do it.
+    history_maintenance_interval: float
+
+    # Port on 127.0.0.1 that serves the metrics shown by "b!stats" at /metrics,
+    # in the Prometheus text format. 0 to not serve them.
+    metrics_port: int
+
 class BotClient(commands.Bot):
     def __init__(self):
         intents = discord.Intents.all()
@@ -25,20 +62,19 @@ class BotClient(commands.Bot):
             enable_debug_events=True, # needed for on_socket_raw_receive
         )
 
-        self._configs: BotConfig = {
-            'history_disabled_guilds': [],
-            'history_fetching_disabled_guilds': [],
-        }
-
         try:
-            with open('config.json', 'r') as file:
-                self._configs = json.load(file)
+            self._configs: BotConfig = self._configs_from(self._read_config_file())
         except FileNotFoundError:
+            self._configs = self._configs_from({})
             with open('config.json', 'w') as file:
                 json.dump(self._configs, file, indent=4)
+        self._check_configs(self._configs)
+        self._update_guild_sets()
 
         self._create_message_hooks: list[Callable[[dict[str, Any]], None]] = []
 
+        interface.mark_sends()
+
         original_create_message = self._connection.create_message
         def interdicted_create_message(self2, *, channel, data):
             """Intercept the create_message function internally used in discord.py.
@@ -47,34 +83,105 @@ class BotClient(commands.Bot):
             we send a message. But we make sure our hooks don't run when
             the call is the result of us sending a message.
             """
-            stack = inspect.stack()
-            caller = stack[1]
-            # https://github.com/Rapptz/discord.py/blob/master/discord/abc.py
-            is_send = caller.function == 'send' and caller.filename.endswith('abc.py')
-
-            if not is_send:
+            if not interface.sending_message.get():
                 for hook in self._create_message_hooks:
                     hook(data)
 
             return original_create_message.__get__(self2)(channel=channel, data=data)
         self._connection.create_message = interdicted_create_message.__get__(self._connection)
 
+    @staticmethod
+    def _configs_from(settings: dict[str, Any], /) -> BotConfig:
+        """The settings read from config.json, with the defaults of the ones it doesn't have."""
+        return {
+            'history_disabled_guilds': settings.get('history_disabled_guilds', []),
+            'history_fetching_disabled_guilds': settings.get('history_fetching_disabled_guilds', []),
+            'history_fetch_workers': settings.get('history_fetch_workers', 4),
+            'history_fetch_requests_per_second': settings.get('history_fetch_requests_per_second', 20.0),
+            'attachment_download_workers': settings.get('attachment_download_workers', 4),
+            'history_compression': settings.get('history_compression', 'none'),
+            'history_message_cache_size': settings.get('history_message_cache_size', 10000),
+            'history_journal_mode': settings.get('history_journal_mode', 'wal'),
+            'history_synchronous': settings.get('history_synchronous', 'normal'),
+            'history_cache_size_mib': settings.get('history_cache_size_mib', 64),
+            'history_mmap_size_mib': settings.get('history_mmap_size_mib', 256),
+            'history_maintenance_interval': settings.get('history_maintenance_interval', 3600.0),
+            'metrics_port': settings.get('metrics_port', 0),
+        }
+
+    @staticmethod
+    def _read_config_file() -> dict[str, Any]:
+        with open('config.json', 'r') as file:
+            return json.load(file)
+
+    @staticmethod
+    def _check_configs(configs: BotConfig, /) -> None:
+        """Raise ValueError if a setting has a value the bot can't run with."""
+        if configs['history_fetch_requests_per_second'] <= 0:
+            raise ValueError('history_fetch_requests_per_second must be greater than 0')
+        if configs['history_fetch_workers'] < 1:
+            raise ValueError('history_fetch_workers must be at least 1')
+
+    def _update_guild_sets(self) -> None:
+        # These are checked for every incoming message, so they're kept as sets rather than the lists in the file.
+        self._history_disabled_guild_ids = frozenset(self._configs['history_disabled_guilds'])
+        self._history_fetching_disabled_guild_ids = self._history_disabled_guild_ids | frozenset(self._configs['history_fetching_disabled_guilds'])
+
+    def reload_configs(self) -> None:
+        """Read config.json again, and dispatch config_reload (with the previous config) so cogs can apply the changes.
+        Raises the error if the file can't be read or has an invalid setting (ValueError), keeping the current config.
+        """
+        configs = self._configs_from(self._read_config_file())
+        self._check_configs(configs)
+        old_configs = self._configs
+        self._configs = configs
+        self._update_guild_sets()
+        self.dispatch('config_reload', old_configs)
+
     def register_create_message_hook(self, hook: Callable[[dict[str, Any]], None], /) -> None:
         self._create_message_hooks.append(hook)
 
     def history_enabled(self, guild_id: int) -> bool:
-        return guild_id not in self._configs['history_disabled_guilds']
+        return guild_id not in self._history_disabled_guild_ids
 
     def history_fetching_enabled(self, guild_id: int) -> bool:
-        if not self.history_enabled(guild_id):
-            return False
+        return guild_id not in self._history_fetching_disabled_guild_ids
+
+    def history_fetch_workers(self) -> int:
+        return self._configs['history_fetch_workers']
+
+    def history_fetch_requests_per_second(self) -> float:
+        return self._configs['history_fetch_requests_per_second']
+
+    def attachment_download_workers(self) -> int:
+        return self._configs['attachment_download_workers']
+
+    def history_compression(self) -> str:
+        return self._configs['history_compression']
+
+    def history_message_cache_size(self) -> int:
+        return self._configs['history_message_cache_size']
+
+    def history_database_profile(self) -> database.Profile:
+        return {
+            'journal_mode': self._configs['history_journal_mode'],
+            'synchronous': self._configs['history_synchronous'],
+            'cache_size_mib': self._configs['history_cache_size_mib'],
+            'mmap_size_mib': self._configs['history_mmap_size_mib'],
+        }
+
+    def history_maintenance_interval(self) -> float:
+        return self._configs['history_maintenance_interval']
 
-        return guild_id not in self._configs['history_fetching_disabled_guilds']
+    def metrics_port(self) -> int:
+        return self._configs['metrics_port']
 
     async def on_ready(self):
         print(f'Logged on as {self.user}.')
 
         await self.load_extension('cogs.test')
+        await self.load_extension('cogs.config')
+        await self.load_extension('cogs.stats')
         await self.load_extension('cogs.logs')
         await self.load_extension('cogs.history')
 
@@ -0,0 +1,161 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+This module keeps counts, current values and latency distributions of what
+the bot is doing. Updating one is a couple of attribute operations, so they
+are always on. They are read with "b!stats", or scraped in the Prometheus
+text format (see cogs/stats.py).
+"""
+
+import bisect
+from typing import Callable, Iterator, TypeVar
+
+# Upper bounds (in seconds) of the buckets of latency histograms
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = tuple[tuple[str, str], ...]
+
+class Counter:
+    """A count that only goes up, either counted here or read from function when it's collected."""
+    kind = 'counter'
+
+    def __init__(self):
+        self.function: Callable[[], float] | None = None
+        self._value = 0.0
+
+    @property
+    def value(self) -> float:
+        return self.function() if self.function is not None else self._value
+
+    def inc(self, amount: float = 1, /) -> None:
+        self._value += amount
+
+class Gauge:
+    """A value that goes up and down, either set here or read from function when it's collected."""
+    kind = 'gauge'
+
+    def __init__(self):
+        self.function: Callable[[], float] | None = None
+        self._value = 0.0
+
+    @property
+    def value(self) -> float:
+        return self.function() if self.function is not None else self._value
+
+    def set(self, value: float, /) -> None:
+        self._value = value
+
+class Histogram:
+    """How many observed values fell into each bucket, and their count and sum.
+    Only one thread should observe values of a histogram.
+    """
+    kind = 'histogram'
+
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # The last one is for values above every bucket
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float, /) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, fraction: float, /) -> float:
+        """Estimate a quantile as the upper bound of the bucket it's in (infinity if it's above every bucket)."""
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.bucket_counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float('inf')
+
+Metric = Counter | Gauge | Histogram
+M = TypeVar('M', Counter, Gauge, Histogram)
+
+class Registry:
+    """Metrics by name and labels. Asking for a metric that's already registered returns the
+    existing one, so modules that are reloaded keep counting where they left off.
+    """
+
+    def __init__(self):
+        # Name -> help text, and the metric with each set of labels
+        self._families: dict[str, tuple[str, dict[Labels, Metric]]] = {}
+
+    def counter(self, name: str, help: str, /, *, function: Callable[[], float] | None = None, **labels: str) -> Counter:
+        counter = self._get(name, help, labels, Counter, lambda: Counter())
+        if function is not None:
+            counter.function = function
+        return counter
+
+    def gauge(self, name: str, help: str, /, *, function: Callable[[], float] | None = None, **labels: str) -> Gauge:
+        gauge = self._get(name, help, labels, Gauge, lambda: Gauge())
+        if function is not None:
+            gauge.function = function
+        return gauge
+
+    def histogram(self, name: str, help: str, /, *, buckets: tuple[float, ...] = LATENCY_BUCKETS, **labels: str) -> Histogram:
+        return self._get(name, help, labels, Histogram, lambda: Histogram(buckets))
+
+    def _get(self, name: str, help: str, labels: dict[str, str], kind: type[M], make: Callable[[], M], /) -> M:
+        _, metrics = self._families.setdefault(name, (help, {}))
+        key = tuple(sorted(labels.items()))
+        metric = metrics.get(key)
+        if metric is None:
+            metric = metrics[key] = make()
+        if not isinstance(metric, kind):
+            raise TypeError(f'{name} is already registered as a {metric.kind}')
+        return metric
+
+    def collect(self) -> Iterator[tuple[str, str, Labels, Metric]]:
+        """Every metric with its name, help text and labels, sorted by name."""
+        for name, (help, metrics) in sorted(self._families.items()):
+            for labels, metric in sorted(metrics.items()):
+                yield name, help, labels, metric
+
+    def prometheus_text(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        lines: list[str] = []
+        previous_name = None
+        for name, help, labels, metric in self.collect():
+            if name != previous_name:
+                lines.append(f'# HELP {name} {help}')
+                lines.append(f'# TYPE {name} {metric.kind}')
+                previous_name = name
+
+            if isinstance(metric, Histogram):
+                cumulative = 0
+                for bound, count in zip((*metric.buckets, float('inf')), metric.bucket_counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'{name}_bucket{_format_labels((*labels, ("le", le)))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {metric.sum!r}')
+                lines.append(f'{name}_count{_format_labels(labels)} {metric.count}')
+            else:
+                lines.append(f'{name}{_format_labels(labels)} {float(metric.value)!r}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> list[str]:
+        """One short line per metric, for reading in Discord."""
+        lines: list[str] = []
+        for name, _, labels, metric in self.collect():
+            if isinstance(metric, Histogram):
+                if metric.count:
+                    value = f'{metric.count}, p50 ≤ {metric.quantile(0.5):g}s, p99 ≤ {metric.quantile(0.99):g}s'
+                else:
+                    value = '0'
+            else:
+                value = f'{metric.value:g}'
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+        return lines
+
+def _format_labels(labels: Labels, /) -> str:
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+REGISTRY = Registry()
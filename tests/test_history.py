@@ -0,0 +1,292 @@
+# SPDX-License-Identifier: AGPL-3.0-only
+
+"""
+Tests of History's backfill and edits against a stubbed Discord API (see fakes.py).
+
+    python -m unittest discover tests
+"""
+
+import aiohttp
+import asyncio
+import database
+import discord
+import discord.http
+import interface
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import unittest
+from typing import Any
+from unittest import mock
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from cogs.history import _may_be_message_create
+from fakes import BOT_USER_ID, FIRST_CHANNEL_ID, FIRST_USER_ID, StubHTTP, message_data, synthetic_traffic, user_data
+from main import BotClient
+
+# Seconds to wait for a backfill before failing
+BACKFILL_TIMEOUT = 30.0
+
+# Backfilled messages that have an attachment, in the tests of attachment downloads
+ATTACHMENT_MESSAGES = 20
+
+class FetchInterrupted(Exception):
+    pass
+
+class InterruptingHTTP(StubHTTP):
+    """Raises FetchInterrupted instead of answering the history request after pages of them."""
+
+    def __init__(self, backfill: dict[int, list[dict[str, Any]]], /, *, pages: int | None = None):
+        super().__init__(0.0, backfill)
+        self.pages = pages
+        self.history_requests = 0
+        # The "after" of each history request, by channel ID
+        self.afters: dict[int, list[int]] = {}
+
+    async def request(self, route: discord.http.Route, **kwargs: Any) -> Any:
+        if route.method == 'GET' and route.path == '/channels/{channel_id}/messages':
+            if self.history_requests == self.pages:
+                raise FetchInterrupted
+            self.history_requests += 1
+            self.afters.setdefault(int(route.channel_id), []).append(int(kwargs['params'].get('after', 0))) # type: ignore
+        return await super().request(route, **kwargs)
+
+class FlakyCDNHTTP(StubHTTP):
+    """Raises each of errors for one attachment download, before downloading them from cdn."""
+
+    def __init__(self, backfill: dict[int, list[dict[str, Any]]], cdn: dict[str, bytes], errors: list[Exception], /):
+        super().__init__(0.0, backfill)
+        self.cdn = cdn
+        self.errors = errors
+
+    async def get_from_cdn(self, url: str) -> bytes:
+        if self.errors:
+            raise self.errors.pop()
+        return await super().get_from_cdn(url)
+
+class StalledCDNHTTP(StubHTTP):
+    """Never finishes downloading an attachment."""
+
+    async def get_from_cdn(self, url: str) -> bytes:
+        await asyncio.Event().wait()
+        raise AssertionError
+
+class BackfillTest(unittest.IsolatedAsyncioTestCase):
+    def setUp(self) -> None:
+        self._directory = tempfile.TemporaryDirectory()
+        self._cwd = os.getcwd()
+        os.chdir(self._directory.name)
+        with open('config.json', 'w') as file:
+            file.write('{"history_fetch_requests_per_second": 1000.0}')
+
+        self.guild_create, self.backfill = synthetic_traffic(0, 1, 10, 3000, 1)
+        self.message_ids = [int(data['id']) for data in self.backfill[FIRST_CHANNEL_ID]]
+
+    def tearDown(self) -> None:
+        os.chdir(self._cwd)
+        self._directory.cleanup()
+
+    async def _start(self, http: StubHTTP, /) -> Any:
+        """Start a BotClient that talks to http, with History loaded, and return the History cog."""
+        bot = BotClient()
+        await bot._async_setup_hook()
+        interface.stub_http(bot, http)
+        bot._connection.user = discord.ClientUser(state=bot._connection, data=user_data(BOT_USER_ID)) # type: ignore
+        bot._connection.parsers['GUILD_CREATE'](self.guild_create[0]['d'])
+        await bot.load_extension('cogs.history')
+        # load_extension imports cogs.history anew, so its History isn't the one this module could import
+        cog = bot.get_cog('History')
+        assert(cog is not None)
+        return cog
+
+    async def _wait_for_backfill(self, cog: Any, /) -> None:
+        async with asyncio.timeout(BACKFILL_TIMEOUT):
+            while cog._channel_ids_queue.qsize() or cog._fetching_channel_ids:
+                await asyncio.sleep(0.01)
+
+    async def _wait_for_downloads(self, cog: Any, /) -> None:
+        async with asyncio.timeout(BACKFILL_TIMEOUT):
+            while cog._queued_attachment_ids:
+                await asyncio.sleep(0.01)
+
+    def _add_attachments(self) -> dict[str, bytes]:
+        """Give the first ATTACHMENT_MESSAGES backfilled messages an attachment each, and return their contents by URL."""
+        contents: dict[str, bytes] = {}
+        for data in self.backfill[FIRST_CHANNEL_ID][:ATTACHMENT_MESSAGES]:
+            url = f'https://cdn.example/{data["id"]}.txt'
+            contents[url] = f'attachment of {data["id"]}'.encode()
+            data['attachments'] = [{'id': str(int(data['id']) + 1), 'filename': 'a.txt', 'size': len(contents[url]), 'url': url, 'proxy_url': url}]
+        return contents
+
+    def _downloaded(self) -> tuple[int, int]:
+        """How many attachments are recorded as downloaded, and how many are still pending."""
+        connection = sqlite3.connect('databases/history.sqlite')
+        try:
+            downloaded, = connection.execute('SELECT count(*) FROM "attachments"').fetchone()
+            pending, = connection.execute('SELECT count(*) FROM "pending_attachments"').fetchone()
+            return downloaded, pending
+        finally:
+            connection.close()
+
+    async def _crash(self, cog: Any, /) -> None:
+        """Stop cog like the process died: writes that weren't handed to the database are lost."""
+        for task in [*cog._channel_fetch_tasks, *cog._attachment_download_tasks, cog._message_flush_task, cog._maintenance_task]:
+            task.cancel()
+        cog._pending_writes.clear()
+        cog._pending_checkpoints.clear()
+        await cog._db.close()
+
+    def _stored(self) -> tuple[list[int], int | None]:
+        """The IDs of stored messages in the channel, and its checkpoint."""
+        connection = sqlite3.connect('databases/history.sqlite')
+        try:
+            message_ids = [row[0] for row in connection.execute('SELECT "message_id" FROM "messages" WHERE "channel_id" = ? ORDER BY 1', (FIRST_CHANNEL_ID,))]
+            checkpoint = connection.execute('SELECT "last_message_id" FROM "channels" WHERE "channel_id" = ?', (FIRST_CHANNEL_ID,)).fetchone()
+            return message_ids, checkpoint and checkpoint[0]
+        finally:
+            connection.close()
+
+    async def test_resumes_from_checkpoint(self) -> None:
+        with self.assertLogs(level='ERROR'):
+            cog = await self._start(InterruptingHTTP(self.backfill, pages=17))
+            await self._wait_for_backfill(cog)
+        await self._crash(cog)
+
+        stored_ids, checkpoint = self._stored()
+        self.assertIsNotNone(checkpoint)
+        # Every message up to the checkpoint was committed with it
+        self.assertEqual(stored_ids[:self.message_ids.index(checkpoint) + 1], self.message_ids[:self.message_ids.index(checkpoint) + 1]) # type: ignore
+
+        http = InterruptingHTTP(self.backfill)
+        cog = await self._start(http)
+        await self._wait_for_backfill(cog)
+        await cog.bot.close()
+
+        self.assertEqual(http.afters[FIRST_CHANNEL_ID][0], checkpoint)
+        stored_ids, checkpoint = self._stored()
+        self.assertEqual(stored_ids, self.message_ids)
+        self.assertEqual(checkpoint, self.message_ids[-1])
+
+    async def test_failed_flush_is_retried(self) -> None:
+        write = database.Database.write
+        flushes = 0
+        async def failing_write(db: database.Database, function: Any, /) -> Any:
+            nonlocal flushes
+            if getattr(getattr(function, 'func', None), '__name__', None) == '_write_messages':
+                flushes += 1
+                if flushes == 3:
+                    raise sqlite3.OperationalError('disk I/O error')
+            return await write(db, function)
+
+        with mock.patch.object(database.Database, 'write', failing_write), self.assertLogs(level='ERROR'):
+            cog = await self._start(StubHTTP(0.0, self.backfill))
+            with mock.patch.object(sys.modules[type(cog).__module__], 'MESSAGE_FLUSH_RETRY_DELAY', 0.01):
+                await self._wait_for_backfill(cog)
+                await cog.bot.close()
+
+        self.assertGreater(flushes, 3)
+        stored_ids, checkpoint = self._stored()
+        self.assertEqual(stored_ids, self.message_ids)
+        self.assertEqual(checkpoint, self.message_ids[-1])
+
+    async def test_malformed_write_does_not_block_others(self) -> None:
+        cog = await self._start(StubHTTP(0.0, self.backfill))
+        await self._wait_for_backfill(cog)
+        await cog._flush_messages()
+
+        next_id = self.message_ids[-1] + 1
+        before = message_data(next_id, FIRST_CHANNEL_ID, user_data(FIRST_USER_ID), 'before')
+        # Has every key, but an author ID that isn't a number fails the flush
+        malformed = message_data(next_id + 1, FIRST_CHANNEL_ID, {**user_data(FIRST_USER_ID), 'id': 'someone'}, 'malformed')
+        after = message_data(next_id + 2, FIRST_CHANNEL_ID, user_data(FIRST_USER_ID), 'after')
+        no_author = message_data(next_id + 3, FIRST_CHANNEL_ID, user_data(FIRST_USER_ID), 'no author')
+        del no_author['author']
+
+        with self.assertLogs(level='WARNING') as logs:
+            for data in [before, malformed, after, no_author]:
+                cog._queue_write('create', data)
+            await cog._flush_messages()
+        self.assertEqual(cog._failed_flushes, 0)
+        self.assertTrue(any('no author' in message for message in logs.output))
+
+        later = message_data(next_id + 4, FIRST_CHANNEL_ID, user_data(FIRST_USER_ID), 'later')
+        cog._queue_write('create', later)
+        await cog.bot.close()
+
+        stored_ids, _ = self._stored()
+        self.assertEqual(stored_ids[len(self.message_ids):], [next_id, next_id + 2, next_id + 4])
+
+    async def test_download_errors_are_retried(self) -> None:
+        contents = self._add_attachments()
+        # Neither of these is an OSError or a discord.HTTPException
+        errors: list[Exception] = [aiohttp.ServerDisconnectedError(), aiohttp.ClientPayloadError('truncated')]
+        cog = await self._start(FlakyCDNHTTP(self.backfill, contents, errors))
+        with mock.patch.object(sys.modules[type(cog).__module__], 'ATTACHMENT_RETRY_DELAY', 0.01):
+            await self._wait_for_backfill(cog)
+            await self._wait_for_downloads(cog)
+        await cog.bot.close()
+
+        self.assertEqual(self._downloaded(), (ATTACHMENT_MESSAGES, 0))
+        files = [os.path.join(directory, name) for directory, _, names in os.walk('media') for name in names]
+        self.assertEqual(sorted(open(path, 'rb').read() for path in files), sorted(contents.values()))
+
+    async def test_pending_downloads_resume_after_restart(self) -> None:
+        contents = self._add_attachments()
+        cog = await self._start(StalledCDNHTTP(0.0, self.backfill))
+        await self._wait_for_backfill(cog)
+        await cog._flush_messages()
+        await self._crash(cog)
+        self.assertEqual(self._downloaded(), (0, ATTACHMENT_MESSAGES))
+
+        http = StubHTTP(0.0, self.backfill)
+        http.cdn = contents
+        cog = await self._start(http)
+        await self._wait_for_backfill(cog)
+        await self._wait_for_downloads(cog)
+        await cog.bot.close()
+
+        self.assertEqual(self._downloaded(), (ATTACHMENT_MESSAGES, 0))
+
+    async def test_quick_edits_are_handled_in_order(self) -> None:
+        # Without the message cache, both edits have to read the stored message
+        with open('config.json', 'w') as file:
+            file.write('{"history_fetch_requests_per_second": 1000.0, "history_message_cache_size": 0}')
+        cog = await self._start(StubHTTP(0.0, self.backfill))
+        await self._wait_for_backfill(cog)
+        await cog._flush_messages()
+
+        data = self.backfill[FIRST_CHANNEL_ID][0]
+        channel = cog.bot.get_channel(FIRST_CHANNEL_ID)
+        def edit(content: str) -> discord.RawMessageUpdateEvent:
+            edited = {**data, 'content': content}
+            return discord.RawMessageUpdateEvent(edited, discord.Message(state=cog.bot._connection, channel=channel, data=edited)) # type: ignore
+        first, second = await asyncio.gather(cog.get_and_update_message(edit('first')), cog.get_and_update_message(edit('second')))
+        latest = await cog.get_message(int(data['id']))
+        await cog.bot.close()
+
+        self.assertEqual(first['content'], data['content'])
+        self.assertEqual(second['content'], 'first')
+        self.assertEqual(latest['content'], 'second')
+
+class GatewayPrefilterTest(unittest.TestCase):
+    def _frame(self, event: str | None, /, **dumps_options: Any) -> str:
+        return json.dumps({'t': event, 's': 1, 'op': 0, 'd': {'content': 'hi'}}, **dumps_options)
+
+    def test_compact_frames(self) -> None:
+        self.assertTrue(_may_be_message_create(self._frame('MESSAGE_CREATE', separators=(',', ':'))))
+        self.assertFalse(_may_be_message_create(self._frame('MESSAGE_UPDATE', separators=(',', ':'))))
+        self.assertFalse(_may_be_message_create(self._frame(None, separators=(',', ':'))))
+
+    def test_other_layouts_fall_back(self) -> None:
+        # json.dumps puts a space after ":" by default
+        self.assertTrue(_may_be_message_create(self._frame('MESSAGE_CREATE')))
+        self.assertTrue(_may_be_message_create(self._frame('MESSAGE_CREATE', indent=1)))
+        self.assertTrue(_may_be_message_create(json.dumps({'op': 0, 't': 'MESSAGE_CREATE', 'd': {}})))
+        self.assertFalse(_may_be_message_create(self._frame('MESSAGE_UPDATE')))
+
+if __name__ == '__main__':
+    unittest.main()